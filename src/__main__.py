@@ -1,35 +1,44 @@
-from application.chatbot import ChatBot
-from application.knowledge_base import KnowledgeBase
-from application.chains import DocumentChain, ProductChain, Judge
-from application.models import setup_models
-
-
-def main():
-    """Main function to setup the application and start the chat."""
-    embedding_model, llm = setup_models()
-
-    path_kb = "/path/"
-    path_sql_db = path_kb + "/sqlite_db.db"
-    path_vector_store = path_kb + "/chroma_db"
-    path_email_storage = path_kb + "/email_storage"
-
-    kb = KnowledgeBase(
-        path_sql_db=path_sql_db,
-        path_vector_store=path_vector_store,
-        path_email_storage=path_email_storage,
+from application.memory import MemoryAccountant, memory_profiler
+from application.models import ROUTING_PROFILES, ModelRegistry
+from application.resources import ManagedEmbeddings, ResourceManager
+from application.tenants import TenantConfig, TenantManager
+
+
+def main(
+    tenant_id: str = "default", profile_memory: bool = False, profile: str = "single"
+):
+    """Main function to setup the application and start the chat.
+
+    Args:
+        tenant_id (str): The tenant to chat with. Defaults to "default".
+        profile_memory (bool): Samples the allocations per request stage with tracemalloc. Defaults to False.
+        profile (str): The routing profile of the models, see ROUTING_PROFILES. Defaults to "single".
+    """
+    if profile_memory:
+        memory_profiler.enable()
+    # The models are loaded on first use and unloaded by the resource manager while the bot is idle.
+    embedding_model = ManagedEmbeddings()
+    models = ModelRegistry(routes=ROUTING_PROFILES[profile])
+    ResourceManager(models=models, embeddings=embedding_model).start()
+
+    tenants = TenantManager(
         embedding_model=embedding_model,
+        models=models,
+        tenants={"default": TenantConfig(path_kb="/path/")},
     )
 
-    doc_chain = DocumentChain(retriever=kb.retriever, llm=llm)
-    product_chain = ProductChain(llm=llm)
-    judge = Judge(llm=llm)
-    bot = ChatBot(
-        llm=llm,
-        knowledge_base=kb,
-        document_chain=doc_chain,
-        product_chain=product_chain,
-        judge=judge,
+    # The lease keeps the tenant open for the chat session.
+    bot = tenants.acquire(tenant_id).bot
+    accountant = MemoryAccountant(
+        models=models,
+        embeddings=embedding_model,
+        knowledge_bases=lambda: [
+            state.knowledge_base for state in tenants.open_tenants.values()
+        ],
     )
+    # The models are loaded by the first requests, so the startup report is the baseline without them.
+    accountant.report(label="baseline")
+    models.load_listeners.append(lambda name: accountant.report(label=f"{name} loaded"))
 
     return bot
 
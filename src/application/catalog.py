@@ -0,0 +1,504 @@
+import argparse
+import sqlite3
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+import pandas as pd
+
+from application.product_answers import ProductAnswerTable
+from utils.logging_utils import logger
+from utils.runtime_stats import runtime_stats
+
+# The cleaning steps of the data processing notebook (notebooks/data_collection_processing.ipynb).
+RENAMED_COLUMNS = {
+    "Philips_BestellNr": "Bestell_Nr",
+    "Lichtstrom_(lm)": "Lichtstrom",
+    "Leistung[W]": "Leistung",
+    "Lichtstärke_(cd)": "Lichtstärke",
+    "AusAbstrahlwinkel[°]": "Abstrahlwinkel",
+    "RaWert": "Ra_Wert_Farbwiedergabe",
+    "RotierendeEndkappen": "Rotierende_Endkappen",
+    "Garantie[Jahre]": "Garantie",
+    "Spannung[V]": "Spannung",
+    "Link_eCat_": "eCat_Produktdatenblatt",
+    "Link_Produktdatenblatt_gem_EUVerordnung_": "EU_Verordnung_Produktdatenblatt",
+    "Link_EEL_Label": "EEL_Label",
+    "VE": "Verpackungseinheit_VE",
+    "TOPSELLER": "Topseller",
+    "NEU": "Neu",
+}
+# Only the Bestell_Nr (order number) is stored in the lamps table. The EAN and EOC are kept in the
+# product_code_aliases table, so products asked for by their EAN or EOC are found by their Bestell_Nr.
+DROPPED_COLUMNS = ["EAN1", "GPC", "EOC"]
+ALIAS_COLUMNS = ["EAN1", "EOC"]
+INT_COLUMNS = [
+    "LEDtube_Laenge_in_mm",
+    "Bestell_Nr",
+    "Lichtstrom",
+    "Lichtstaerke",
+    "Nutzlebensdauer",
+    "Abstrahlwinkel",
+    "Ra_Wert_Farbwiedergabe",
+    "Farbtemperatur",
+    "Garantie",
+    "Menge_Palette",
+]
+FLOAT_COLUMNS = ["kWh/1000h", "Leistung"]
+
+
+def normalize_column_names(columns: pd.Index) -> pd.Index:
+    """Renames the spreadsheet columns to the column names of the lamps table."""
+    columns = (
+        columns.str.replace("\n", "", regex=False)
+        .str.replace("-", "", regex=False)
+        .str.replace(" ", "_", regex=False)
+        .str.replace(".", "", regex=False)
+    )
+    columns = columns.map(lambda column: RENAMED_COLUMNS.get(column, column))
+    columns = (
+        columns.str.replace("ä", "ae", regex=False)
+        .str.replace("ö", "oe", regex=False)
+        .str.replace("ü", "ue", regex=False)
+    )
+    return columns.str.replace("PK", "Produktkategorie_PK", regex=False)
+
+
+def to_numbers(frame: pd.DataFrame) -> pd.DataFrame:
+    """Converts columns to float: "-" is 0, decimal commas become points and degree signs are removed."""
+    return (
+        frame.replace("-", 0)
+        .astype(str)
+        .replace({",": ".", "°": ""}, regex=True)
+        .astype(float)
+    )
+
+
+def fill_product_codes(df: pd.DataFrame) -> None:
+    """Fills missing EOC with the EAN and missing Bestell_Nr with the last 8 digits of the EOC."""
+    df["EOC"] = df["EOC"].fillna(df["EAN1"].astype(str) + "00")
+    df["Bestell_Nr"] = df["Bestell_Nr"].fillna(df["EOC"].astype(str).str[-8:])
+
+
+def digit_code(value) -> Optional[str]:
+    """Returns a code read as number or text as digits, None if it is missing or not a number."""
+    text = str(value).strip()
+    if text.endswith(".0"):
+        text = text[:-2]
+    return text if text.isdigit() else None
+
+
+def product_code_aliases(raw: pd.DataFrame) -> pd.DataFrame:
+    """
+    Extracts the EAN and EOC of the products from the product spreadsheet, which clean_catalog drops.
+
+    Args:
+        raw (pd.DataFrame): The product spreadsheet as read by pd.read_excel.
+
+    Returns:
+        pd.DataFrame: The columns code (the EAN or EOC as digits) and Bestell_Nr, one row per code.
+    """
+    df = raw.copy()
+    df.columns = normalize_column_names(df.columns)
+    fill_product_codes(df)
+    bestell_nr = pd.to_numeric(df["Bestell_Nr"], errors="coerce")
+    aliases = pd.concat(
+        [
+            pd.DataFrame({"code": df[column].map(digit_code), "Bestell_Nr": bestell_nr})
+            for column in ALIAS_COLUMNS
+        ]
+    ).dropna()
+    aliases["Bestell_Nr"] = aliases["Bestell_Nr"].astype(int)
+    return aliases.drop_duplicates("code", keep="last").reset_index(drop=True)
+
+
+def clean_catalog(raw: pd.DataFrame) -> pd.DataFrame:
+    """
+    Cleans the product spreadsheet like the data processing notebook, with column operations only.
+
+    Args:
+        raw (pd.DataFrame): The product spreadsheet as read by pd.read_excel.
+
+    Returns:
+        pd.DataFrame: The rows of the lamps table, one per Bestell_Nr.
+    """
+    df = raw.copy()
+    df.columns = normalize_column_names(df.columns)
+
+    # Missing values
+    fill_product_codes(df)
+    df["LEDtube_Laenge_in_mm"] = df["LEDtube_Laenge_in_mm"].fillna(0)
+    df["Menge_Palette"] = df["Menge_Palette"].fillna(500)
+
+    # Binary encoding
+    df["Neu"] = df["Neu"].astype(str).str.strip().eq("NEU").astype(int)
+    df["Topseller"] = (
+        df["Topseller"].astype(str).str.strip().eq("TOPSELLER").astype(int)
+    )
+
+    # Value imputation
+    df["Rotierende_Endkappen"] = df["Rotierende_Endkappen"].replace("-", "nein")
+    df["Ausfuehrung"] = df["Ausfuehrung"].replace("-", "keine Angabe")
+    df["Dimmbar"] = df["Dimmbar"].str.lower().replace("-", "nein")
+    operation = (
+        df["Betrieb_an"]
+        .str.replace(r".*KVG.*VVG.*", "KVG/VVG", regex=True)
+        .str.replace(r"EVG\*", "EVG", regex=True)
+        .str.replace(r".*Universal.*", "Universal", regex=True)
+        .str.replace(r".*220-240.*", "230V", regex=True)
+    )
+    df["Betrieb_an"] = operation.mask(operation == "KVG/EVG/\n230V", "Universal")
+
+    df = df.drop(columns=DROPPED_COLUMNS)
+    df[INT_COLUMNS] = to_numbers(df[INT_COLUMNS]).astype(int)
+    df[FLOAT_COLUMNS] = to_numbers(df[FLOAT_COLUMNS])
+
+    duplicates = df["Bestell_Nr"].duplicated(keep="last")
+    if duplicates.any():
+        logger.warning(
+            f"DUPLICATE PRODUCT CODES IN THE CATALOG, THE LAST ROW IS KEPT: {df.loc[duplicates, 'Bestell_Nr'].tolist()}"
+        )
+    return df[~duplicates].reset_index(drop=True)
+
+
+@dataclass
+class CatalogDiff:
+    """The product codes inserted, updated and deleted by a catalog sync."""
+
+    inserted: List[int] = field(default_factory=list)
+    updated: List[int] = field(default_factory=list)
+    deleted: List[int] = field(default_factory=list)
+    schema_changed: bool = False
+
+    def changes(self) -> Dict[int, str]:
+        """Returns the change per product code."""
+        return {
+            **{code: "insert" for code in self.inserted},
+            **{code: "update" for code in self.updated},
+            **{code: "delete" for code in self.deleted},
+        }
+
+    def __len__(self) -> int:
+        return len(self.inserted) + len(self.updated) + len(self.deleted)
+
+
+class CatalogChangeLog:
+    """Reads the product codes changed by the catalog syncs from the product database.
+
+    Every sync that changes the lamps table or the EAN/EOC aliases adds its changes under a new version in the
+    same transaction, so processes holding product data, e.g. the KnowledgeBase, can pick up the changes of
+    syncs that ran in another process. Products whose aliases changed are logged with the change "alias".
+    """
+
+    def __init__(self, path_sql_db: str):
+        """
+        Initializes a CatalogChangeLog object.
+
+        Args:
+            path_sql_db (str): The path to the SQLite database with the lamps table.
+        """
+        self.path_sql_db = path_sql_db
+
+    @staticmethod
+    def setup_table(conn: sqlite3.Connection) -> None:
+        conn.execute("""CREATE TABLE IF NOT EXISTS catalog_changes (
+                version INTEGER NOT NULL,
+                changed_at TEXT NOT NULL,
+                Bestell_Nr INTEGER NOT NULL,
+                change TEXT NOT NULL
+            );""")
+
+    def latest_version(self) -> int:
+        """Returns the version of the last sync, 0 if there was none."""
+        conn = sqlite3.connect(self.path_sql_db)
+        try:
+            row = conn.execute("SELECT MAX(version) FROM catalog_changes;").fetchone()
+        except sqlite3.OperationalError:
+            return 0
+        finally:
+            conn.close()
+        return row[0] or 0
+
+    def changes_since(self, version: int) -> Tuple[int, Dict[int, str]]:
+        """
+        Returns the changes of the syncs after the given version.
+
+        Args:
+            version (int): The last version already known.
+
+        Returns:
+            Tuple[int, Dict[int, str]]: The latest version and the last change per product code since the given version.
+        """
+        conn = sqlite3.connect(self.path_sql_db)
+        try:
+            rows = conn.execute(
+                "SELECT version, Bestell_Nr, change FROM catalog_changes WHERE version > ? ORDER BY version;",
+                (version,),
+            ).fetchall()
+        except sqlite3.OperationalError:
+            return version, {}
+        finally:
+            conn.close()
+        if not rows:
+            return version, {}
+        return rows[-1][0], {code: change for _, code, change in rows}
+
+
+class CatalogSync:
+    """Synchronizes the lamps table with the product spreadsheet incrementally.
+
+    The cleaned spreadsheet is loaded into a temporary table with the columns of the lamps table, so SQLite
+    compares the rows with the same type affinities it stores them with. Only the inserted, updated and
+    deleted rows are written, together with the change log and the EAN/EOC aliases of the product codes, in
+    one transaction; readers keep seeing the previous catalog until it commits. If the columns changed, the
+    table is recreated in the transaction. Afterwards, the precomputed answers of the changed products are
+    recreated.
+    """
+
+    def __init__(self, path_sql_db: str, table: str = "lamps"):
+        """
+        Initializes a CatalogSync object.
+
+        Args:
+            path_sql_db (str): The path to the SQLite database with the lamps table.
+            table (str): The name of the product table. Defaults to "lamps".
+        """
+        self.path_sql_db = path_sql_db
+        self.table = table
+
+    def table_columns(self, conn: sqlite3.Connection) -> List[str]:
+        return [row[1] for row in conn.execute(f'PRAGMA table_info("{self.table}");')]
+
+    def records(self, catalog: pd.DataFrame) -> List[tuple]:
+        """Returns the rows as tuples of Python values, missing values as None."""
+        values = catalog.astype(object).where(catalog.notna(), None)
+        return list(values.itertuples(index=False, name=None))
+
+    def insert_sql(self, table: str, columns: List[str]) -> str:
+        names = ", ".join(f'"{column}"' for column in columns)
+        placeholders = ", ".join("?" for _ in columns)
+        return f'INSERT INTO "{table}" ({names}) VALUES ({placeholders});'
+
+    def codes(self, conn: sqlite3.Connection, query: str) -> List[int]:
+        return [row[0] for row in conn.execute(query)]
+
+    def diff(self, conn: sqlite3.Connection) -> CatalogDiff:
+        """Compares the temporary table new_catalog with the product table."""
+        table = f'"{self.table}"'
+        return CatalogDiff(
+            inserted=self.codes(
+                conn,
+                f"SELECT Bestell_Nr FROM new_catalog EXCEPT SELECT Bestell_Nr FROM {table};",
+            ),
+            deleted=self.codes(
+                conn,
+                f"SELECT Bestell_Nr FROM {table} EXCEPT SELECT Bestell_Nr FROM new_catalog;",
+            ),
+            # Rows that differ in any column, EXCEPT treats NULLs as equal.
+            updated=self.codes(
+                conn,
+                f"SELECT Bestell_Nr FROM (SELECT * FROM new_catalog EXCEPT SELECT * FROM {table}) "
+                f"INTERSECT SELECT Bestell_Nr FROM {table};",
+            ),
+        )
+
+    def apply(self, conn: sqlite3.Connection, diff: CatalogDiff) -> None:
+        """Writes the changes of the diff from the temporary table new_catalog to the product table."""
+        table = f'"{self.table}"'
+        columns = [
+            column for column in self.table_columns(conn) if column != "Bestell_Nr"
+        ]
+        conn.executemany(
+            f"DELETE FROM {table} WHERE Bestell_Nr = ?;",
+            [(code,) for code in diff.deleted],
+        )
+        names = ", ".join(f'"{column}"' for column in columns)
+        conn.executemany(
+            f"UPDATE {table} SET ({names}) = (SELECT {names} FROM new_catalog "
+            f"WHERE new_catalog.Bestell_Nr = {table}.Bestell_Nr) WHERE Bestell_Nr = ?;",
+            [(code,) for code in diff.updated],
+        )
+        conn.executemany(
+            f"INSERT INTO {table} SELECT * FROM new_catalog WHERE Bestell_Nr = ?;",
+            [(code,) for code in diff.inserted],
+        )
+
+    def replace(self, conn: sqlite3.Connection, catalog: pd.DataFrame) -> CatalogDiff:
+        """Recreates the product table with the columns of the catalog."""
+        old_codes = (
+            set(self.codes(conn, f'SELECT Bestell_Nr FROM "{self.table}";'))
+            if self.table_columns(conn)
+            else set()
+        )
+        new_codes = set(catalog["Bestell_Nr"].tolist())
+        conn.execute(f'DROP TABLE IF EXISTS "{self.table}";')
+        conn.execute(pd.io.sql.get_schema(catalog, self.table))
+        conn.executemany(
+            self.insert_sql(self.table, list(catalog.columns)), self.records(catalog)
+        )
+        return CatalogDiff(
+            inserted=sorted(new_codes - old_codes),
+            updated=sorted(new_codes & old_codes),
+            deleted=sorted(old_codes - new_codes),
+            schema_changed=True,
+        )
+
+    def sync_code_aliases(
+        self, conn: sqlite3.Connection, aliases: pd.DataFrame
+    ) -> Set[int]:
+        """Replaces the EAN/EOC aliases of the product codes and returns the product codes whose aliases changed."""
+        conn.execute("""CREATE TABLE IF NOT EXISTS product_code_aliases (
+                code TEXT PRIMARY KEY,
+                Bestell_Nr INTEGER NOT NULL
+            );""")
+        old = set(conn.execute("SELECT code, Bestell_Nr FROM product_code_aliases;"))
+        new = {
+            (str(code), int(bestell_nr)) for code, bestell_nr in self.records(aliases)
+        }
+        if old == new:
+            return set()
+        conn.execute("DELETE FROM product_code_aliases;")
+        conn.executemany("INSERT INTO product_code_aliases VALUES (?, ?);", sorted(new))
+        return {bestell_nr for _, bestell_nr in old ^ new}
+
+    def log_changes(
+        self, conn: sqlite3.Connection, diff: CatalogDiff, alias_codes: Set[int] = ()
+    ) -> int:
+        """
+        Adds the changes of the diff and the alias changes to the change log under a new version.
+
+        Args:
+            conn (sqlite3.Connection): The connection with the open sync transaction.
+            diff (CatalogDiff): The changes of the lamps table.
+            alias_codes (Set[int]): The product codes whose aliases changed. Defaults to none.
+
+        Returns:
+            int: The version.
+        """
+        CatalogChangeLog.setup_table(conn)
+        version = conn.execute(
+            "SELECT COALESCE(MAX(version), 0) + 1 FROM catalog_changes;"
+        ).fetchone()[0]
+        changed_at = datetime.now().isoformat()
+        # A product changed in the lamps table keeps its change, e.g. a deletion.
+        changes = {
+            **{code: "alias" for code in alias_codes},
+            **diff.changes(),
+        }
+        conn.executemany(
+            "INSERT INTO catalog_changes VALUES (?, ?, ?, ?);",
+            [(version, changed_at, code, change) for code, change in changes.items()],
+        )
+        return version
+
+    def sync(
+        self,
+        catalog: pd.DataFrame,
+        dry_run: bool = False,
+        code_aliases: Optional[pd.DataFrame] = None,
+    ) -> CatalogDiff:
+        """
+        Synchronizes the product table with the cleaned catalog.
+
+        Args:
+            catalog (pd.DataFrame): The cleaned catalog, see clean_catalog.
+            dry_run (bool): Only computes the diff, the transaction is rolled back. Defaults to False.
+            code_aliases (pd.DataFrame, optional): The EAN/EOC aliases of the product codes, see
+                product_code_aliases. Defaults to None, the aliases are left as they are.
+
+        Returns:
+            CatalogDiff: The inserted, updated and deleted product codes.
+        """
+        start = time.perf_counter()
+        # Autocommit mode, so the transaction is controlled explicitly and includes the DDL statements.
+        conn = sqlite3.connect(self.path_sql_db, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE;")
+            columns = self.table_columns(conn)
+            if columns and sorted(columns) == sorted(catalog.columns):
+                catalog = catalog[columns]
+                conn.execute(
+                    f'CREATE TEMP TABLE new_catalog AS SELECT * FROM "{self.table}" WHERE 0;'
+                )
+                conn.executemany(
+                    self.insert_sql("new_catalog", columns), self.records(catalog)
+                )
+                diff = self.diff(conn)
+                if not dry_run:
+                    self.apply(conn, diff)
+                conn.execute("DROP TABLE new_catalog;")
+            else:
+                logger.warning(
+                    f"COLUMNS OF THE CATALOG DIFFER FROM THE {self.table.upper()} TABLE, THE TABLE IS RECREATED"
+                )
+                diff = self.replace(conn, catalog)
+            alias_codes = (
+                self.sync_code_aliases(conn, code_aliases)
+                if code_aliases is not None
+                else set()
+            )
+            version = None
+            if dry_run or not (diff or alias_codes):
+                conn.execute("ROLLBACK;")
+            else:
+                version = self.log_changes(conn, diff, alias_codes)
+                conn.execute("COMMIT;")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK;")
+            raise
+        finally:
+            conn.close()
+
+        logger.info(
+            f"CATALOG SYNC{' (DRY RUN)' if dry_run else ''}: {len(diff.inserted)} INSERTED, "
+            f"{len(diff.updated)} UPDATED, {len(diff.deleted)} DELETED IN {time.perf_counter() - start:.2f}s"
+        )
+        if version is not None:
+            self.publish(diff, version)
+        return diff
+
+    def publish(self, diff: CatalogDiff, version: int) -> None:
+        """Publishes the changed product codes and recreates their precomputed answers."""
+        runtime_stats.increment("catalog", "syncs")
+        for name in ("inserted", "updated", "deleted"):
+            runtime_stats.increment("catalog", name, len(getattr(diff, name)))
+        runtime_stats.record_event(
+            "catalog",
+            {
+                "time": time.time(),
+                "version": version,
+                "inserted": diff.inserted,
+                "updated": diff.updated,
+                "deleted": diff.deleted,
+            },
+        )
+        if not diff:
+            # Only the aliases changed, the product answers stay the same.
+            return
+        product_answers = ProductAnswerTable(self.path_sql_db)
+        product_answers.update_products(diff.changes())
+        product_answers.close()
+
+
+def main():
+    """Synchronizes the lamps table of a knowledge base with the product spreadsheet from the command line."""
+    parser = argparse.ArgumentParser(description=CatalogSync.__doc__)
+    parser.add_argument("--path-kb", required=True, help="Knowledge base directory.")
+    parser.add_argument("--path-xlsx", required=True, help="Product spreadsheet.")
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Only report, do not change the table."
+    )
+    args = parser.parse_args()
+
+    raw = pd.read_excel(args.path_xlsx)
+    CatalogSync(args.path_kb + "/sqlite_db.db").sync(
+        clean_catalog(raw),
+        dry_run=args.dry_run,
+        code_aliases=product_code_aliases(raw),
+    )
+
+
+if __name__ == "__main__":
+    main()
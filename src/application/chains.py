@@ -1,12 +1,33 @@
-import json
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pformat
 from typing import Union, List
 
 import application.templates as tl
+from application.column_selection import ColumnSelector
+from application.expert_index import ExpertAnswerIndex
+from application.memory import memory_profiler
+from application.product_answers import IntentClassifier, ProductAnswerTable
+from application.results import (
+    ChainResult,
+    item_metadata,
+    page_content,
+    result_summary,
+)
+from application.retrievers import ScoredRetriever
+from application.generation import (
+    GenerationConfig,
+    GenerationController,
+    get_generation_config,
+    parse_json_output,
+)
 from langchain.output_parsers import StructuredOutputParser
 from langchain.prompts import PromptTemplate
-from langchain_core.runnables import RunnableParallel, RunnablePassthrough
+from langchain_core.runnables import RunnablePassthrough
+from llama_cpp import LlamaGrammar
 from utils.logging_utils import logger
+from utils.runtime_stats import runtime_stats
 from langchain_community.llms import LlamaCpp
 from langchain_core.documents.base import Document
 from langchain_core.retrievers import BaseRetriever
@@ -18,12 +39,17 @@ def log_execute(func: callable) -> callable:
     def wrapper(chain, query, **kwargs):
         logger.info(f"EXECUTING {chain.__class__.__name__} WITH QUERY: {query}")
         result = func(chain, query, **kwargs)
-        logger.info(f"RESULT:\n{pformat(result, sort_dicts=False)}")
+        log_result(result)
         return result
 
     return wrapper
 
 
+def log_result(result: Union[ChainResult, dict]) -> None:
+    """Logs a compact summary of a chain result, the context is referenced by IDs instead of serialized."""
+    logger.info(f"RESULT: {result_summary(result)}")
+
+
 class Chain:
     """Base class for all chains in the application. Contains common methods and attributes."""
 
@@ -33,17 +59,9 @@ class Chain:
         self.parser = self.create_parser()
         self.prompt = self.create_prompt()
 
-    def sort_llm_output(self, dict: dict) -> dict:
-        """Sorts the LLM output dictionary according to the key order."""
-        key_order = [
-            "question_id",
-            "question_type",
-            "solved",
-            "question",
-            "answer",
-            "context",
-        ]
-        return {k: dict.get(k, None) for k in key_order}
+    def sort_llm_output(self, dict: dict) -> ChainResult:
+        """Creates the result from the LLM output dictionary, missing keys are None."""
+        return ChainResult.from_dict(dict)
 
     def to_bool(self, value):
         """Converts a string value to a boolean."""
@@ -57,6 +75,15 @@ class Chain:
         """Creates a structured output parser from the response schema."""
         return StructuredOutputParser.from_response_schemas(self.response_schema)
 
+    def create_generator(
+        self, generation_config: GenerationConfig = None
+    ) -> GenerationController:
+        """Creates the generation controller that applies the token budgets of the chain."""
+        config = generation_config or get_generation_config(self.__class__.__name__)
+        return GenerationController(
+            llm=self.llm, config=config, chain_name=self.__class__.__name__
+        )
+
     def create_prompt(self) -> PromptTemplate:
         """Creates a prompt from the prompt template and the response schema."""
         format_instructions = self.parser.get_format_instructions()
@@ -69,17 +96,32 @@ class Chain:
 class ProductChain(Chain):
     """Chain for product-related queries."""
 
-    def __init__(self, llm: LlamaCpp):
+    def __init__(
+        self,
+        llm: LlamaCpp,
+        generation_config: GenerationConfig = None,
+        prune_columns: bool = True,
+        answer_table: ProductAnswerTable = None,
+    ):
         self.llm = llm
+        # Only the product columns relevant to the question are sent to the LLM.
+        self.column_selector = ColumnSelector() if prune_columns else None
+        # Questions of a common intent are answered from the precomputed answers without the LLM.
+        self.answer_table = answer_table
+        self.intent_classifier = (
+            IntentClassifier() if answer_table is not None else None
+        )
         self.response_schema = tl.product_response_schema
         self.prompt_template = tl.product_prompt_template
         self.parser = self.create_parser()
         self.prompt = self.create_prompt()
+        self.generator = self.create_generator(generation_config)
+        self.product_chain = self.prompt | self.generator
         self.question_id = None
 
     def convert_llm_output(
         self, llm_output: Union[str, dict], product_info: dict
-    ) -> dict:
+    ) -> ChainResult:
         """
         Converts the LLM output to a standardized format.
 
@@ -88,30 +130,79 @@ class ProductChain(Chain):
             product_info (dict): The product information to be included in the converted output.
 
         Returns:
-            dict: The converted LLM output in sorted format.
+            ChainResult: The converted LLM output, referencing the product information.
+        """
+        llm_output = parse_json_output(llm_output)
+        # A truncated, unparsable or non-object output counts as not solved, so it is forwarded to an expert.
+        llm_output = llm_output if isinstance(llm_output, dict) else {}
+        return ChainResult(
+            question_id=f"P{self.question_id}",
+            question_type="PRODUCT",
+            solved=llm_output.get("solved", False),
+            question=llm_output.get("question"),
+            answer=llm_output.get("answer"),
+            context=product_info,
+        )
+
+    def select_context(self, query: str, product_info: dict) -> dict:
+        """Returns the product information relevant to the query. All columns are used without a column selector."""
+        if self.column_selector is None:
+            return product_info
+        return self.column_selector.select(query, product_info)
+
+    def lookup_answer(self, query: str, product_info: dict) -> ChainResult:
+        """
+        Returns the precomputed answer if the query has a common intent.
+
+        Args:
+            query (str): The query string.
+            product_info (dict): Context about the product.
+
+        Returns:
+            ChainResult or None: The precomputed answer, or None if there is none for the query.
         """
-        llm_output = (
-            json.loads(llm_output) if isinstance(llm_output, str) else llm_output
+        if self.answer_table is None or "Bestell_Nr" not in product_info:
+            return None
+        intent = self.intent_classifier.classify(query)
+        answer = (
+            self.answer_table.lookup(product_info["Bestell_Nr"], intent)
+            if intent is not None
+            else None
+        )
+        runtime_stats.increment(
+            "product_answers", "hits" if answer is not None else "misses"
+        )
+        if answer is None:
+            return None
+        return ChainResult(
+            question_id=f"P{self.question_id}",
+            question_type="PRODUCT",
+            solved=True,
+            question=query,
+            answer=answer,
+            context=product_info,
         )
-        llm_output["context"] = product_info
-        llm_output["question_type"] = "PRODUCT"
-        llm_output["question_id"] = f"P{self.question_id}"
-        return self.sort_llm_output(llm_output)
 
     @log_execute
-    def execute(self, query: str, product_info: dict) -> dict:
+    @memory_profiler.profile("ProductChain.execute")
+    def execute(self, query: str, product_info: dict) -> ChainResult:
         """
         Executes the chain for the given query and product information.
+        Questions of a common intent are answered from the product answer table if one is set.
 
         Args:
             query (str): The query string.
             product_info (dict): Context about the product.
 
         Returns:
-            dict: The response from the chain.
+            ChainResult: The response from the chain.
         """
-        product_chain = self.prompt | self.llm
-        response = product_chain.invoke({"question": query, "context": product_info})
+        precomputed = self.lookup_answer(query, product_info)
+        if precomputed is not None:
+            return precomputed
+        response = self.product_chain.invoke(
+            {"question": query, "context": self.select_context(query, product_info)}
+        )
         response = self.convert_llm_output(response, product_info)
         return response
 
@@ -119,84 +210,286 @@ class ProductChain(Chain):
 class DocumentChain(Chain):
     """Chain for document retrieval queries."""
 
-    def __init__(self, retriever: BaseRetriever, llm: LlamaCpp):
+    def __init__(
+        self,
+        retriever: BaseRetriever,
+        llm: LlamaCpp,
+        generation_config: GenerationConfig = None,
+        expert_index: ExpertAnswerIndex = None,
+    ):
         self.llm = llm
         self.retriever = retriever
+        self.expert_index = expert_index
         self.response_schema = tl.document_reponse_schema
         self.prompt_template = tl.document_prompt_template
         self.parser = self.create_parser()
         self.prompt = self.create_prompt()
+        self.generator = self.create_generator(generation_config)
+        self.doc_chain_from_docs = (
+            RunnablePassthrough.assign(
+                context=(lambda x: self.concat_docs(x["context"]))
+            )
+            | self.prompt
+            | self.generator
+        )
         self.question_id = None
 
     def concat_docs(self, docs: List[Document]) -> str:
         """Concatenates the page content of the documents to a single string."""
         return "\n\n".join(doc.page_content for doc in docs)
 
-    def convert_llm_output(self, llm_output: dict):
+    def convert_llm_output(self, llm_output: dict, question_id: str = None):
         """
         Converts the LLM output to a standardized format.
 
         Args:
             llm_output (dict): The LLM output to be converted.
+            question_id (str, optional): The ID of the question. Defaults to the question_id of the chain.
 
         Returns:
-            dict or None: The converted LLM output in sorted format, or None if an error occurred.
+            ChainResult or None: The converted LLM output referencing the retrieved documents, or None if an error occurred.
         """
         try:
-            llm_output["context"] = [doc.dict() for doc in llm_output["context"]]
-            llm_output["question_type"] = "DOCUMENT"
-
-            llm_output_dict = json.loads(llm_output["llm_output"])
+            llm_output_dict = parse_json_output(llm_output["llm_output"])
             llm_output_dict = {k.lower(): v for k, v in llm_output_dict.items()}
 
             # Sometimes the LLM output contains "antwort" and sometimes "answer",
             # so we need to check for both.
             answer_key = "antwort" if "antwort" in llm_output_dict else "answer"
-            llm_output["answer"] = llm_output_dict[answer_key]
-            del llm_output["llm_output"]
-            llm_output["question_id"] = f"D{self.question_id}"
-
-            return self.sort_llm_output(llm_output)
+            return ChainResult(
+                question_id=f"D{question_id or self.question_id}",
+                question_type="DOCUMENT",
+                question=llm_output["question"],
+                answer=llm_output_dict[answer_key],
+                context=llm_output["context"],
+            )
         except Exception as e:
             logger.error(
                 f"Error occurred during conversion of LLM output: {e}\n {pformat(llm_output, sort_dicts=False)} "
             )
             return None
 
+    def create_insufficient_response(
+        self, query: str, question_id: str = None
+    ) -> ChainResult:
+        """Creates the response for a query without relevant documents, without calling the LLM."""
+        return ChainResult(
+            question_id=f"D{question_id or self.question_id}",
+            question_type="DOCUMENT",
+            solved=False,
+            question=query,
+            answer=tl.insufficient_information_answer,
+            context=[],
+        )
+
+    def create_expert_response(
+        self, query: str, expert_match: dict, question_id: str = None
+    ) -> ChainResult:
+        """Creates the response from a verified expert answer. The answer is returned verbatim with its source."""
+        return ChainResult(
+            question_id=f"E{question_id or self.question_id}",
+            question_type="EXPERT",
+            solved=True,
+            question=query,
+            answer=expert_match["answer"],
+            context=[
+                Document(
+                    page_content=f"Frage: {expert_match['question']}. Antwort: {expert_match['answer']}",
+                    metadata={
+                        "question_id": expert_match["question_id"],
+                        "source": expert_match["source"],
+                        "author": "Expert",
+                        "score": expert_match["score"],
+                    },
+                )
+            ],
+        )
+
     @log_execute
-    def execute(self, query: str) -> dict:
+    def execute(self, query: str) -> ChainResult:
         """
         Executes the chain for the given query and product information.
+        A verified expert answer to a matching question is returned without generation. If the retriever finds
+        no relevant documents, the LLM is skipped and an "insufficient information" response is returned.
 
         Args:
             query (str): The query string.
 
         Returns:
-            dict: The response from the chain.
+            ChainResult: The response from the chain.
         """
-        doc_chain_from_docs = (
-            RunnablePassthrough.assign(
-                context=(lambda x: self.concat_docs(x["context"]))
+        expert_match = self.expert_index.match(query) if self.expert_index else None
+        if expert_match is not None:
+            return self.create_expert_response(query, expert_match)
+
+        with memory_profiler.stage("DocumentChain.retrieve"):
+            context = self.retriever.invoke(query)
+        if not context:
+            logger.info("NO RELEVANT DOCUMENTS FOUND. SKIPPING GENERATION.")
+            return self.create_insufficient_response(query)
+
+        return self.generate(query, context)
+
+    @memory_profiler.profile("DocumentChain.generate")
+    def generate(
+        self, query: str, context: List[Document], question_id: str = None
+    ) -> ChainResult:
+        """
+        Generates the answer to the query from the retrieved context.
+
+        Args:
+            query (str): The query string.
+            context (List[Document]): The retrieved documents.
+            question_id (str, optional): The ID of the question. Defaults to the question_id of the chain.
+
+        Returns:
+            ChainResult or None: The response, or None if the LLM output could not be converted.
+        """
+        response = {"context": context, "question": query}
+        response["llm_output"] = self.doc_chain_from_docs.invoke(response)
+        return self.convert_llm_output(response, question_id)
+
+    def retrieve_batch(self, queries: List[str]) -> List[List[Document]]:
+        """Retrieves the context of all queries with one embedding call and one multi-query vector search."""
+        if isinstance(self.retriever, ScoredRetriever):
+            scored_docs = self.retriever.knowledge_base.search_with_scores(
+                queries, k=self.retriever.max_k
             )
-            | self.prompt
-            | self.llm
+            return [self.retriever.select(result) for result in scored_docs]
+        return self.retriever.batch(queries)
+
+    def generate_group(self, items: List[tuple]) -> List[tuple]:
+        """
+        Generates the answers of queries that share the same context, one after another.
+        The prompt starts with the context, so the LLM reuses the evaluated prompt prefix.
+
+        Args:
+            items (List[tuple]): The index, query, question ID and context per query.
+
+        Returns:
+            List[tuple]: The index and the response or error per query.
+        """
+        results = []
+        for index, query, question_id, context in items:
+            try:
+                response = self.generate(query, context, question_id)
+                if response is None:
+                    raise ValueError("The LLM output could not be converted.")
+                results.append((index, response))
+            except Exception as e:
+                logger.error(f"BATCH QUESTION {question_id} FAILED: {e}")
+                results.append(
+                    (index, self.create_error_response(query, question_id, e))
+                )
+        return results
+
+    def create_error_response(
+        self, query: str, question_id: str, error: Exception
+    ) -> ChainResult:
+        """Creates the result of a batch question that failed."""
+        return ChainResult(
+            question_id=f"D{question_id}",
+            question_type="DOCUMENT",
+            question=query,
+            error=f"{error.__class__.__name__}: {error}",
         )
-        doc_chain_with_source = RunnableParallel(
-            {"context": self.retriever, "question": RunnablePassthrough()}
-        ).assign(llm_output=doc_chain_from_docs)
-        response = doc_chain_with_source.invoke(query)
-        response = self.convert_llm_output(response)
-        return response
+
+    def execute_batch(
+        self, queries: List[str], question_ids: List[str] = None, max_workers: int = 1
+    ) -> List[ChainResult]:
+        """
+        Executes the chain for several queries, e.g. from the email or ticket channels.
+
+        All queries are embedded in one batch and searched with one multi-query vector search. Queries
+        with the same retrieved context are grouped and generated one after another, and the groups go
+        through a bounded worker pool. A failing query yields an item with an "error" key instead of
+        aborting the batch.
+
+        Args:
+            queries (List[str]): The query strings.
+            question_ids (List[str], optional): The IDs of the questions. Defaults to random IDs.
+            max_workers (int): The number of groups generated in parallel. Keep 1 for a single local LlamaCpp
+                model, which handles one generation at a time. Defaults to 1.
+
+        Returns:
+            List[ChainResult]: The responses in the order of the queries.
+        """
+        logger.info(f"EXECUTING {self.__class__.__name__} WITH {len(queries)} QUERIES")
+        question_ids = question_ids or [uuid.uuid4().hex for _ in queries]
+        results = [None] * len(queries)
+
+        try:
+            contexts = self.retrieve_batch(queries)
+        except Exception as e:
+            logger.error(f"BATCH RETRIEVAL FAILED: {e}")
+            return [
+                self.create_error_response(query, question_id, e)
+                for query, question_id in zip(queries, question_ids)
+            ]
+
+        groups = defaultdict(list)
+        for index, (query, question_id, context) in enumerate(
+            zip(queries, question_ids, contexts)
+        ):
+            try:
+                expert_match = (
+                    self.expert_index.match(query) if self.expert_index else None
+                )
+            except Exception as e:
+                results[index] = self.create_error_response(query, question_id, e)
+                continue
+            if expert_match is not None:
+                results[index] = self.create_expert_response(
+                    query, expert_match, question_id
+                )
+            elif not context:
+                results[index] = self.create_insufficient_response(query, question_id)
+            else:
+                key = tuple(
+                    doc.metadata.get("chunk_id", doc.page_content) for doc in context
+                )
+                groups[key].append((index, query, question_id, context))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for group_results in executor.map(self.generate_group, groups.values()):
+                for index, response in group_results:
+                    results[index] = response
+
+        failed = sum("error" in result for result in results)
+        logger.info(
+            f"BATCH DONE: {len(queries)} QUERIES, {len(groups)} CONTEXT GROUPS, {failed} FAILED"
+        )
+        return results
+
+
+def judge_batch_grammar(n_items: int) -> str:
+    """
+    Creates a GBNF grammar for a JSON array of exactly n_items judgements with the fields of the judge schema.
+
+    Args:
+        n_items (int): The number of judged items.
+
+    Returns:
+        str: The grammar.
+    """
+    items = ' ws "," ws '.join(["item"] * n_items)
+    return f"""root ::= "[" ws {items} ws "]"
+item ::= "{{" ws "\\"reasoning_for_correctness\\"" ws ":" ws string ws "," ws "\\"correctness\\"" ws ":" ws [0-4] ws "}}"
+string ::= "\\"" ( [^"\\\\\\n] | "\\\\" ["\\\\/bfnrt] )* "\\""
+ws ::= [ \\t\\n]?
+"""
 
 
 class Judge(Chain):
-    def __init__(self, llm: LlamaCpp):
+    def __init__(self, llm: LlamaCpp, generation_config: GenerationConfig = None):
         self.llm = llm
         self.llm_response = None
         self.response_schema = tl.judge_schema
         self.prompt_template = tl.judge_prompt_template
         self.parser = None
         self.prompt = self.create_prompt()
+        self.generator = self.create_generator(generation_config)
+        self.judge_chain = self.prompt | self.generator
         self.label = None
 
     def create_prompt(self) -> PromptTemplate:
@@ -206,20 +499,29 @@ class Judge(Chain):
             partial_variables={"schema": self.response_schema},
         )
 
-    def judge_output(self) -> dict:
+    def judge_output(self) -> ChainResult:
         """Generates the correctness score and justification for the LLM output.
 
         Returns:
-            dict: The judged output with correctness score and justification.
+            ChainResult: The judged output with correctness score and justification.
         """
         logger.info(f"EXECUTING {self.__class__.__name__}")
 
-        judge_chain = self.prompt | self.llm
-        response = judge_chain.invoke(self.prepare_input())
-        response_dict = {**json.loads(response), **self.llm_response}
+        response = self.judge_chain.invoke(self.prepare_input())
+        # Malformed output yields no correctness score, so the answer is forwarded to an expert.
+        judgement = parse_json_output(response)
+        judgement = judgement if isinstance(judgement, dict) else {}
+        self.set_judgement(self.llm_response, judgement)
+
+        log_result(self.llm_response)
+        return self.llm_response
 
-        logger.info(f"RESULT:\n{pformat(response_dict, sort_dicts=False)}")
-        return response_dict
+    def set_judgement(self, llm_response: ChainResult, judgement: dict) -> None:
+        """Adds the correctness score and justification of the judge to the response."""
+        llm_response.reasoning_for_correctness = judgement.get(
+            "reasoning_for_correctness"
+        )
+        llm_response.correctness = judgement.get("correctness")
 
     def prepare_input(self) -> dict:
         """Prepares the input for the judge chain."""
@@ -229,28 +531,142 @@ class Judge(Chain):
             "context": self.llm_response["context"],
         }
 
+    def format_batch_item(self, number: int, llm_response: dict) -> str:
+        """Formats a DOCUMENT response as a numbered item of the batch prompt."""
+        return tl.judge_batch_item_template.format(
+            number=number,
+            question=llm_response["question"],
+            answer=llm_response["answer"],
+            context=[page_content(item) for item in llm_response["context"]],
+        )
+
+    def plan_batches(
+        self,
+        items: List[str],
+        max_batch_size: int = 8,
+        output_tokens_per_item: int = 160,
+    ) -> List[List[int]]:
+        """
+        Splits the items into batches that fit into the context window of the LLM, prompt and output included.
+
+        Args:
+            items (List[str]): The formatted items.
+            max_batch_size (int): The maximum number of items per batch. Defaults to 8.
+            output_tokens_per_item (int): The output tokens reserved per item. Defaults to 160.
+
+        Returns:
+            List[List[int]]: The indices of the items per batch.
+        """
+        n_ctx = getattr(self.llm, "n_ctx", 4096)
+        prompt_tokens = self.llm.get_num_tokens(
+            tl.judge_batch_prompt_template.format(
+                n_items=max_batch_size, schema=self.response_schema, items=""
+            )
+        )
+        budget = int(n_ctx * 0.95) - prompt_tokens
+        batches, batch, used = [], [], 0
+        for index, item in enumerate(items):
+            cost = self.llm.get_num_tokens(item) + output_tokens_per_item
+            if batch and (used + cost > budget or len(batch) == max_batch_size):
+                batches.append(batch)
+                batch, used = [], 0
+            batch.append(index)
+            used += cost
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def judge_batch_items(
+        self, llm_responses: List[dict], output_tokens_per_item: int
+    ) -> List[dict]:
+        """Judges several DOCUMENT responses with one grammar-constrained generation of a JSON array."""
+        items = [
+            self.format_batch_item(number, llm_response)
+            for number, llm_response in enumerate(llm_responses, start=1)
+        ]
+        prompt = tl.judge_batch_prompt_template.format(
+            n_items=len(items), schema=self.response_schema, items="\n".join(items)
+        )
+        config = get_generation_config("Judge")
+        config.max_tokens = output_tokens_per_item * len(items)
+        config.field_max_tokens = {}
+        generator = GenerationController(self.llm, config, "JudgeBatch")
+        grammar = LlamaGrammar.from_string(
+            judge_batch_grammar(len(items)), verbose=False
+        )
+        judgements = parse_json_output(generator.invoke(prompt, grammar=grammar))
+        return judgements if isinstance(judgements, list) else []
+
+    def judge_batch(
+        self,
+        llm_responses: List[dict],
+        max_batch_size: int = 8,
+        output_tokens_per_item: int = 160,
+    ) -> List[ChainResult]:
+        """
+        Judges the responses of an offline evaluation in batches, the scoring rubric is sent once per batch.
+        The batch size adapts to the context window. Items missing from a truncated batch output are judged
+        one by one. Responses that are not judged by execute (e.g. without context) are passed to execute.
+
+        Args:
+            llm_responses (List[dict]): The LLM responses to evaluate.
+            max_batch_size (int): The maximum number of responses per LLM call. Defaults to 8.
+            output_tokens_per_item (int): The output tokens reserved per response. Defaults to 160.
+
+        Returns:
+            List[ChainResult]: The evaluated responses in the order of the input, as returned by execute.
+        """
+        llm_responses = [ChainResult.from_dict(response) for response in llm_responses]
+        results = [None] * len(llm_responses)
+        judged = []
+        for index, llm_response in enumerate(llm_responses):
+            if llm_response["question_type"] == "DOCUMENT" and llm_response["context"]:
+                judged.append(index)
+            else:
+                results[index] = self.execute(llm_response)
+
+        items = [self.format_batch_item(0, llm_responses[i]) for i in judged]
+        for batch in self.plan_batches(items, max_batch_size, output_tokens_per_item):
+            batch_responses = [llm_responses[judged[i]] for i in batch]
+            logger.info(f"EXECUTING {self.__class__.__name__} WITH {len(batch)} ITEMS")
+            judgements = self.judge_batch_items(batch_responses, output_tokens_per_item)
+            for position, llm_response in enumerate(batch_responses):
+                judgement = judgements[position] if position < len(judgements) else None
+                index = judged[batch[position]]
+                if isinstance(judgement, dict) and "correctness" in judgement:
+                    self.llm_response = llm_response
+                    llm_response.context = self.extract_page_content()
+                    self.set_judgement(llm_response, judgement)
+                    results[index] = self.check_correctness(llm_response)
+                else:
+                    results[index] = self.execute(llm_response)
+        return results
+
     def check_solved(self) -> bool:
         """Checks if the LLM response is solved."""
         return self.to_bool(self.llm_response["solved"])
 
     def extract_page_content(self) -> List[str]:
         """Removes the metadata from the LLM response and returns the page content"""
-        return [item["page_content"] for item in self.llm_response["context"]]
+        return [page_content(item) for item in self.llm_response["context"]]
 
-    def execute(self, llm_response: dict) -> dict:
+    @memory_profiler.profile("Judge.execute")
+    def execute(self, llm_response: ChainResult) -> ChainResult:
         """Evaluates the given LLM response.
 
         By a PRODUCT question, the 'solved' key is checked and the response is returned if solved.
         By a DOCUMENT question, the correctness score is checked and the response is returned if the score is less then 3.
+        A DOCUMENT question without context is returned without judging.
+        An EXPERT answer is not judged and only returned outside of the chat.
 
         Args:
-            llm_response (dict): The LLM response to evaluate.
+            llm_response (ChainResult): The LLM response to evaluate. Dictionaries, e.g. loaded from a file, are converted.
 
         Returns:
-            dict: The evaluated response.
+            ChainResult: The evaluated response.
         """
 
-        self.llm_response = llm_response
+        self.llm_response = ChainResult.from_dict(llm_response)
         response = None
 
         # PRODUCT BLOCK
@@ -261,21 +677,34 @@ class Judge(Chain):
                 print(f"{self.llm_response['answer']}\n")
         # DOCUMENT BLOCK
         elif self.llm_response["question_type"] == "DOCUMENT":
+            # Without context there is nothing to judge, the question goes straight to an expert.
+            if not self.llm_response["context"]:
+                return self.llm_response
             self.llm_response["context"] = self.extract_page_content()
             response = self.judge_output()
             response = self.check_correctness(response)
+        # EXPERT BLOCK
+        elif self.llm_response["question_type"] == "EXPERT":
+            # Verified expert answers are not judged.
+            if self.label == "chat":
+                source = item_metadata(self.llm_response["context"][0])["source"]
+                print(
+                    f"{self.llm_response['answer']}\n(Expertenantwort, Quelle: {source})\n"
+                )
+            else:
+                response = self.llm_response
 
         return response
 
-    def check_correctness(self, response: dict):
+    def check_correctness(self, response: ChainResult):
         """
         Checks the correctness of the response and prompts the user for feedback if necessary.
 
         Args:
-            response (dict): The response dictionary.
+            response (ChainResult): The judged response.
 
         Returns:
-            dict: The modified response dictionary or None if the user is satisfied with the answer.
+            ChainResult: The judged response or None if the user is satisfied with the answer.
         """
         if response.get("correctness", None) is None or response["correctness"] < 3:
             return response
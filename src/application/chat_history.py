@@ -0,0 +1,297 @@
+import json
+import sqlite3
+import threading
+import uuid
+from collections import deque
+from datetime import datetime
+from typing import Deque, Dict, List, Optional
+
+from application.results import item_metadata, serialize_context
+from utils.logging_utils import logger
+
+
+def compact_context(llm_output: dict) -> list:
+    """
+    Replaces the context of an LLM output with references. Retrieved chunks are referenced by their
+    chunk ID and expert answers by the ID of their chunk, product rows by their Bestell_Nr.
+    Context entries without an ID are kept as they are.
+
+    Args:
+        llm_output (dict): The LLM output as a dictionary.
+
+    Returns:
+        list: The context references.
+    """
+    context = llm_output.get("context") or []
+    if isinstance(context, dict):
+        context = [context]
+    refs = []
+    for entry in context:
+        metadata = item_metadata(entry)
+        if "chunk_id" in metadata:
+            refs.append({"chunk_id": metadata["chunk_id"]})
+        elif metadata.get("author") == "Expert" and "question_id" in metadata:
+            refs.append({"chunk_id": f"expert_{metadata['question_id']}"})
+        elif isinstance(entry, dict) and "Bestell_Nr" in entry:
+            refs.append({"product_code": entry["Bestell_Nr"]})
+        else:
+            refs.append(serialize_context([entry])[0])
+    return refs
+
+
+class ChatHistoryStore:
+    """Stores the chat sessions in a SQLite database in WAL mode and keeps the recent turns of open sessions in memory.
+
+    Every turn is appended to the database with references to its context instead of the context
+    itself. Per open session only the last max_recent_turns compact turns are held in a ring buffer,
+    so the memory of a session does not grow with its length.
+    """
+
+    def __init__(self, path_db: str, max_recent_turns: int = 20):
+        """
+        Initializes a ChatHistoryStore object.
+
+        Args:
+            path_db (str): The path to the SQLite database file.
+            max_recent_turns (int): The number of turns per open session kept in memory. Defaults to 20.
+        """
+        self.path_db = path_db
+        self.max_recent_turns = max_recent_turns
+        self.recent_turns: Dict[str, Deque[dict]] = {}
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path_db, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.setup_database()
+
+    def setup_database(self) -> None:
+        """Enables WAL mode and creates the sessions and turns tables."""
+        with self._lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL;")
+            self.conn.execute("PRAGMA synchronous=NORMAL;")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY,
+                    started_at TEXT NOT NULL,
+                    ended_at TEXT,
+                    turns INTEGER NOT NULL DEFAULT 0
+                );""")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS turns (
+                    session_id TEXT NOT NULL,
+                    turn INTEGER NOT NULL,
+                    question_id TEXT,
+                    question_type TEXT,
+                    question TEXT,
+                    answer TEXT,
+                    solved INTEGER,
+                    context_refs TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    PRIMARY KEY (session_id, turn)
+                );""")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_sessions_started ON sessions (started_at);"
+            )
+
+    def start_session(self, session_id: str = None) -> str:
+        """
+        Starts a new session.
+
+        Args:
+            session_id (str, optional): The ID of the session. Defaults to a random ID.
+
+        Returns:
+            str: The ID of the session.
+        """
+        session_id = session_id or uuid.uuid4().hex
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO sessions (session_id, started_at) VALUES (?, ?);",
+                (session_id, datetime.now().isoformat()),
+            )
+            self.recent_turns[session_id] = deque(maxlen=self.max_recent_turns)
+        return session_id
+
+    def end_session(self, session_id: str) -> None:
+        """Marks a session as ended and releases its recent turns."""
+        with self._lock, self.conn:
+            self.conn.execute(
+                "UPDATE sessions SET ended_at = ? WHERE session_id = ?;",
+                (datetime.now().isoformat(), session_id),
+            )
+            self.recent_turns.pop(session_id, None)
+
+    def append(self, session_id: str, llm_output: dict) -> dict:
+        """
+        Appends a turn to a session.
+
+        Args:
+            session_id (str): The ID of the session.
+            llm_output (dict): The LLM output of the turn.
+
+        Returns:
+            dict: The compact turn, as kept in memory.
+        """
+        llm_output = llm_output or {}
+        context_refs = compact_context(llm_output)
+        solved = llm_output.get("solved")
+        now = datetime.now().isoformat()
+        with self._lock, self.conn:
+            self.conn.execute(
+                "UPDATE sessions SET turns = turns + 1 WHERE session_id = ?;",
+                (session_id,),
+            )
+            turn = self.conn.execute(
+                "SELECT turns FROM sessions WHERE session_id = ?;", (session_id,)
+            ).fetchone()
+            if turn is None:
+                raise KeyError(f"Unknown session ID: {session_id}")
+            record = {
+                "session_id": session_id,
+                "turn": turn[0],
+                "question_id": llm_output.get("question_id"),
+                "question_type": llm_output.get("question_type"),
+                "question": llm_output.get("question"),
+                "answer": llm_output.get("answer"),
+                "solved": None if solved is None else bool(solved),
+                "context_refs": context_refs,
+                "created_at": now,
+            }
+            self.conn.execute(
+                """INSERT INTO turns
+                (session_id, turn, question_id, question_type, question, answer, solved, context_refs, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);""",
+                (
+                    *[
+                        record[key]
+                        for key in (
+                            "session_id",
+                            "turn",
+                            "question_id",
+                            "question_type",
+                            "question",
+                            "answer",
+                            "solved",
+                        )
+                    ],
+                    json.dumps(context_refs, default=str),
+                    now,
+                ),
+            )
+            recent = self.recent_turns.setdefault(
+                session_id, deque(maxlen=self.max_recent_turns)
+            )
+            recent.append(record)
+        return record
+
+    def recent(self, session_id: str) -> List[dict]:
+        """Returns the recent turns of an open session from memory, oldest first."""
+        with self._lock:
+            return list(self.recent_turns.get(session_id, ()))
+
+    def row_to_dict(self, row: sqlite3.Row) -> dict:
+        """Converts a database row to a turn with decoded context references."""
+        record = dict(row)
+        record["context_refs"] = json.loads(record["context_refs"])
+        if record["solved"] is not None:
+            record["solved"] = bool(record["solved"])
+        return record
+
+    def get_session(self, session_id: str) -> Optional[dict]:
+        """Returns the session record, or None if the session is unknown."""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT * FROM sessions WHERE session_id = ?;", (session_id,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def list_sessions(self, limit: int = 50, offset: int = 0) -> List[dict]:
+        """Returns the sessions, newest first."""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT * FROM sessions ORDER BY started_at DESC LIMIT ? OFFSET ?;",
+                (limit, offset),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_turns(
+        self, session_id: str, limit: int = 50, offset: int = 0
+    ) -> List[dict]:
+        """Returns the turns of a session from the database, oldest first."""
+        with self._lock:
+            rows = self.conn.execute(
+                """SELECT * FROM turns WHERE session_id = ?
+                ORDER BY turn LIMIT ? OFFSET ?;""",
+                (session_id, limit, offset),
+            ).fetchall()
+        return [self.row_to_dict(row) for row in rows]
+
+    def resolve_context(self, record: dict, knowledge_base) -> list:
+        """
+        Loads the context of a turn from the knowledge base.
+
+        Args:
+            record (dict): A turn of get_turns or recent.
+            knowledge_base (KnowledgeBase): The knowledge base the chunks and products are loaded from.
+
+        Returns:
+            list: The chunks as dictionaries with page_content and metadata, and the product rows.
+                Chunks removed from the vector store and products removed from the catalog since the turn
+                are left out.
+        """
+        refs = record["context_refs"]
+        chunk_ids = [ref["chunk_id"] for ref in refs if "chunk_id" in ref]
+        chunks = {}
+        if chunk_ids:
+            data = knowledge_base.vector_store._collection.get(
+                ids=chunk_ids, include=["documents", "metadatas"]
+            )
+            for chunk_id, text, metadata in zip(
+                data["ids"], data["documents"], data["metadatas"]
+            ):
+                chunks[chunk_id] = {
+                    "page_content": text,
+                    "metadata": {**metadata, "chunk_id": chunk_id},
+                }
+        context = []
+        for ref in refs:
+            if "chunk_id" in ref:
+                if ref["chunk_id"] in chunks:
+                    context.append(chunks[ref["chunk_id"]])
+            elif "product_code" in ref:
+                try:
+                    context.append(
+                        knowledge_base.execute_sql_query(ref["product_code"])
+                    )
+                except IndexError:
+                    logger.warning(
+                        f"PRODUCT {ref['product_code']} OF SESSION {record['session_id']} IS NO LONGER IN THE CATALOG"
+                    )
+            else:
+                context.append(ref)
+        return context
+
+    def delete_sessions_before(self, timestamp: str) -> int:
+        """
+        Deletes the sessions started before the given time with their turns.
+
+        Args:
+            timestamp (str): The time in ISO format.
+
+        Returns:
+            int: The number of deleted sessions.
+        """
+        with self._lock, self.conn:
+            self.conn.execute(
+                """DELETE FROM turns WHERE session_id IN
+                (SELECT session_id FROM sessions WHERE started_at < ?);""",
+                (timestamp,),
+            )
+            deleted = self.conn.execute(
+                "DELETE FROM sessions WHERE started_at < ?;", (timestamp,)
+            ).rowcount
+        logger.info(f"DELETED {deleted} CHAT SESSIONS STARTED BEFORE {timestamp}")
+        return deleted
+
+    def close(self) -> None:
+        """Closes the database connection."""
+        with self._lock:
+            self.recent_turns.clear()
+            self.conn.close()
@@ -4,6 +4,7 @@ from application.chains import Judge, ProductChain, DocumentChain
 from application.knowledge_base import KnowledgeBase
 from utils.logging_utils import logger
 from application.communcation_handler import CommunicationHandler
+from application.memory import memory_profiler
 import uuid
 
 
@@ -34,7 +35,8 @@ class ChatBot:
         self.product_chain = product_chain
         self.judge = judge
         self.comm_handler = CommunicationHandler(knowledge_base=self.kb)
-        self.chat_history = []
+        self.history_store = self.kb.chat_history_store
+        self.session_id = None
         self.question_id = 0
 
     def say_message(self, hello_message: bool):
@@ -56,12 +58,16 @@ class ChatBot:
         )
 
     def get_chat_history(self) -> list:
-        """Returns the chat history."""
-        return self.chat_history
+        """Returns the recent turns of the current session. Older turns are loaded with the history store's get_turns."""
+        if self.session_id is None:
+            return []
+        return self.history_store.recent(self.session_id)
 
-    def append_to_chat_history(self, message: str):
-        """Appends a message to the chat history."""
-        self.chat_history.append(message)
+    def append_to_chat_history(self, message: dict):
+        """Appends the LLM output of a turn to the session history."""
+        if self.session_id is None:
+            self.session_id = self.history_store.start_session()
+        self.history_store.append(self.session_id, message)
 
     def call_judge(self, llm_output: str):
         """Calls the Judge instance to evaluate the LLM output.
@@ -73,6 +79,7 @@ class ChatBot:
         judge_response = self.judge.execute(llm_response=llm_output)
         if judge_response is not None:
             self.comm_handler.ask_and_foward(judge_response)
+        memory_profiler.end_request()
 
     def call_doc_chain(self, init_query: str):
         """
@@ -86,15 +93,34 @@ class ChatBot:
         self.append_to_chat_history(llm_output)
         self.call_judge(llm_output)
 
-    def call_product_chain(self, product_info: dict):
+    def call_product_chain(self, product_info: dict, product_query: str = None):
         """
         Calls the ProductChain instance to execute product-related queries.
 
         Args:
             product_info (dict): The product information.
+            product_query (str, optional): The first question about the product, e.g. the input that contained
+                the product code. Asked for if not given.
         """
         while True:
-            product_query = input(">>> Was möchten Sie über das Produkt wissen?\n")
+            if product_query is None:
+                product_query = input(">>> Was möchten Sie über das Produkt wissen?\n")
+            # A catalog sync may have changed the product since it was looked up.
+            change = self.kb.refresh_catalog().get(product_info["Bestell_Nr"])
+            if change == "delete":
+                logger.warning(
+                    f"PRODUCT {product_info['Bestell_Nr']} WAS REMOVED FROM THE CATALOG"
+                )
+                print(
+                    tl.product_removed_message.format(
+                        product_code=product_info["Bestell_Nr"]
+                    )
+                )
+                break
+            if change == "update":
+                product_info = self.kb.execute_sql_query(
+                    product_code=product_info["Bestell_Nr"]
+                )
             self.product_chain.question_id = uuid.uuid4().hex
             llm_output = self.product_chain.execute(
                 query=product_query,
@@ -107,15 +133,17 @@ class ChatBot:
             )
             if product_query.lower() == "nein":
                 break
+            product_query = None
 
     def start_chat(self) -> list:
         """
         Starts the chatbot and handles the conversation.
 
         Returns:
-            list: The chat history.
+            list: The recent turns of the session.
         """
-        logger.info("###### NEW CHAT ######.")
+        self.session_id = self.history_store.start_session()
+        logger.info(f"###### NEW CHAT {self.session_id} ######.")
         self.say_message(hello_message=True)
         while True:
             init_query = input("\n>>> Ihre Frage:\n")
@@ -126,10 +154,22 @@ class ChatBot:
                 break
             if init_query == "":
                 continue
+            self.kb.refresh_catalog()
             if init_query.isdigit():
-                product_info = self.kb.execute_sql_query(product_code=init_query)
+                # An EAN or EOC is resolved to its Bestell_Nr.
+                product_code = self.kb.product_matcher.match(init_query) or init_query
+                product_info = self.kb.execute_sql_query(product_code=product_code)
                 self.call_product_chain(product_info)
+                continue
+            # A product code within a question goes to the ProductChain without retrieval.
+            product_code = self.kb.product_matcher.match(init_query)
+            if product_code is not None:
+                logger.info(f"PRODUCT CODE {product_code} DETECTED IN USER INPUT")
+                product_info = self.kb.execute_sql_query(product_code=product_code)
+                self.call_product_chain(product_info, product_query=init_query)
             else:
                 self.call_doc_chain(init_query)
 
-        return self.get_chat_history()
+        chat_history = self.get_chat_history()
+        self.history_store.end_session(self.session_id)
+        return chat_history
@@ -0,0 +1,458 @@
+import argparse
+import glob
+import os
+import re
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Iterable, List, Optional, Tuple
+
+import fitz
+from langchain_core.documents.base import Document
+from transformers import AutoTokenizer
+
+from application.knowledge_base import KnowledgeBase
+from application.models import EMBEDDING_MODEL_NAME, setup_embeddings
+from utils.logging_utils import logger
+from utils.runtime_stats import runtime_stats
+
+# Bullet points and numbered items, and "key: value" lines of the technical data sheets.
+BULLET_PATTERN = re.compile(r"^\s*(?:[-•▪·–*]|\d{1,2}[.)])\s+")
+SPEC_PATTERN = re.compile(r"^[^:]{1,40}:\s*\S")
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+(?=[A-ZÄÖÜ0-9])")
+
+
+@dataclass
+class Block:
+    """A structural block of a PDF page: a heading, a table, a spec list or a text paragraph."""
+
+    kind: str
+    lines: List[str]
+    page: int
+
+
+@dataclass
+class ChunkingStats:
+    """Statistics of a chunking run."""
+
+    files: int = 0
+    pages: int = 0
+    chunks: int = 0
+    tokens: int = 0
+    truncated: int = 0
+    seconds: float = 0.0
+    failed_files: List[str] = field(default_factory=list)
+
+    @property
+    def truncation_rate(self) -> float:
+        return self.truncated / self.chunks if self.chunks else 0.0
+
+    @property
+    def mean_tokens(self) -> float:
+        return self.tokens / self.chunks if self.chunks else 0.0
+
+    def merge(self, other: "ChunkingStats") -> None:
+        self.files += other.files
+        self.pages += other.pages
+        self.chunks += other.chunks
+        self.tokens += other.tokens
+        self.truncated += other.truncated
+        self.failed_files += other.failed_files
+
+    def report(self) -> dict:
+        """Logs the statistics and publishes them as gauges of the "chunking" runtime stats."""
+        report = {
+            **asdict(self),
+            "truncation_rate": self.truncation_rate,
+            "mean_tokens": self.mean_tokens,
+        }
+        logger.info(
+            f"CHUNKED {self.files} FILES ({self.pages} PAGES) INTO {self.chunks} CHUNKS "
+            f"OF {self.mean_tokens:.0f} TOKENS ON AVERAGE IN {self.seconds:.1f}s, "
+            f"TRUNCATION RATE {self.truncation_rate:.2%}"
+        )
+        for key, value in report.items():
+            runtime_stats.set_gauge("chunking", key, value)
+        return report
+
+
+class PdfStructureParser:
+    """Splits the pages of a PDF into headings, tables, spec lists and text paragraphs with PyMuPDF.
+
+    Headings are short blocks in a larger or bold font than the body text of the page. Tables are found
+    with PyMuPDF's table finder and returned row by row, the first row being the header.
+    """
+
+    def __init__(self, heading_scale: float = 1.15, max_heading_chars: int = 120):
+        """
+        Initializes a PdfStructureParser object.
+
+        Args:
+            heading_scale (float): The font size of a heading relative to the body text. Defaults to 1.15.
+            max_heading_chars (int): The maximum length of a heading. Defaults to 120.
+        """
+        self.heading_scale = heading_scale
+        self.max_heading_chars = max_heading_chars
+
+    def parse(self, path: str) -> Tuple[List[Block], int]:
+        """
+        Parses a PDF file.
+
+        Args:
+            path (str): The path of the PDF file.
+
+        Returns:
+            Tuple[List[Block], int]: The blocks in reading order and the number of pages.
+        """
+        with fitz.open(path) as pdf:
+            blocks = [block for page in pdf for block in self.parse_page(page)]
+            return blocks, pdf.page_count
+
+    def parse_page(self, page: fitz.Page) -> List[Block]:
+        tables = page.find_tables().tables
+        table_rects = [fitz.Rect(table.bbox) for table in tables]
+        items = [
+            (rect.y0, Block("table", self.table_lines(table), page.number + 1))
+            for rect, table in zip(table_rects, tables)
+        ]
+
+        text_blocks = [
+            block for block in page.get_text("dict")["blocks"] if block["type"] == 0
+        ]
+        sizes = [
+            span["size"]
+            for block in text_blocks
+            for line in block["lines"]
+            for span in line["spans"]
+            if span["text"].strip()
+        ]
+        body_size = statistics.median(sizes) if sizes else 0.0
+        for block in text_blocks:
+            if any(fitz.Rect(block["bbox"]).intersects(rect) for rect in table_rects):
+                continue
+            lines = [
+                "".join(span["text"] for span in line["spans"]).strip()
+                for line in block["lines"]
+            ]
+            lines = [line for line in lines if line]
+            if not lines:
+                continue
+            spans = [
+                span
+                for line in block["lines"]
+                for span in line["spans"]
+                if span["text"].strip()
+            ]
+            kind = self.classify(lines, spans, body_size)
+            items.append((block["bbox"][1], Block(kind, lines, page.number + 1)))
+        return [block for _, block in sorted(items, key=lambda item: item[0])]
+
+    def table_lines(self, table) -> List[str]:
+        """Returns the rows of a table as lines with the cells separated by " | "."""
+        rows = []
+        for row in table.extract():
+            cells = [" ".join((cell or "").split()) for cell in row]
+            if any(cells):
+                rows.append(" | ".join(cells))
+        return rows
+
+    def classify(self, lines: List[str], spans: List[dict], body_size: float) -> str:
+        text = " ".join(lines)
+        is_large = max(span["size"] for span in spans) >= body_size * self.heading_scale
+        # Bit 4 of the span flags marks bold fonts.
+        is_bold = all(span["flags"] & 16 for span in spans)
+        if (
+            len(lines) <= 2
+            and len(text) <= self.max_heading_chars
+            and (is_large or is_bold)
+            and not text.endswith(".")
+        ):
+            return "heading"
+        structured = sum(
+            1
+            for line in lines
+            if BULLET_PATTERN.match(line) or SPEC_PATTERN.match(line)
+        )
+        if len(lines) >= 2 and structured >= len(lines) / 2:
+            return "list"
+        return "text"
+
+
+class StructuredChunker:
+    """Chunks technical PDFs along their structure and sizes the chunks with the tokenizer of the embedding model.
+
+    A chunk never spans two sections and starts with the heading of its section. Blocks are kept whole if
+    they fit into a chunk; larger tables and spec lists are split between rows or lines, with the header
+    row repeated, and larger paragraphs between sentences. Only a single sentence or row longer than a chunk
+    is split by tokens. The tokens of a document are counted in one batch call of the fast tokenizer.
+    """
+
+    def __init__(
+        self,
+        model_name: str = EMBEDDING_MODEL_NAME,
+        max_tokens: int = 512,
+        chunk_tokens: int = 450,
+        overlap_tokens: int = 32,
+        parser: PdfStructureParser = None,
+    ):
+        """
+        Initializes a StructuredChunker object.
+
+        Args:
+            model_name (str): The embedding model whose tokenizer sizes the chunks. Defaults to EMBEDDING_MODEL_NAME.
+            max_tokens (int): The input limit of the embedding model, longer chunks are truncated. Defaults to 512.
+            chunk_tokens (int): The target size of a chunk. It is below the limit, as the tokens of joined
+                lines can differ slightly from the sum of their tokens. Defaults to 450.
+            overlap_tokens (int): The overlap of the windows of a sentence longer than a chunk. Defaults to 32.
+            parser (PdfStructureParser, optional): The PDF parser. Defaults to a new PdfStructureParser.
+        """
+        self.model_name = model_name
+        self.max_tokens = max_tokens
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.parser = parser or PdfStructureParser()
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+        self.special_tokens = self.tokenizer.num_special_tokens_to_add()
+
+    def count_tokens(self, texts: List[str]) -> List[int]:
+        """Counts the tokens of the texts without special tokens in one batch."""
+        if not texts:
+            return []
+        encodings = self.tokenizer(texts, add_special_tokens=False)
+        return [len(ids) for ids in encodings["input_ids"]]
+
+    def split_by_tokens(self, text: str, budget: int) -> List[Tuple[str, int]]:
+        """Splits a text into overlapping windows of at most budget tokens."""
+        offsets = self.tokenizer(
+            text, add_special_tokens=False, return_offsets_mapping=True
+        )["offset_mapping"]
+        step = max(budget - self.overlap_tokens, 1)
+        windows = []
+        for start in range(0, len(offsets), step):
+            window = offsets[start : start + budget]
+            windows.append((text[window[0][0] : window[-1][1]], len(window)))
+            if start + budget >= len(offsets):
+                break
+        return windows
+
+    def block_units(self, block: Block) -> List[str]:
+        """Returns the units of a block that are only split if they are longer than a chunk."""
+        if block.kind == "text":
+            # Lines ending with a hyphen continue the word in the next line.
+            text = ""
+            for line in block.lines:
+                text += line[:-1] if line.endswith("-") else line + " "
+            return [unit for unit in SENTENCE_PATTERN.split(text.strip()) if unit]
+        return block.lines
+
+    def sections(self, blocks: List[Block]) -> List[Tuple[str, int, List[Block]]]:
+        """Groups the blocks by section. Consecutive headings form one section title."""
+        sections = []
+        heading, page, content = "", 1, []
+        for block in blocks:
+            if block.kind == "heading":
+                if content:
+                    sections.append((heading, page, content))
+                    heading, content = "", []
+                heading = f"{heading} / {' '.join(block.lines)}".strip(" /")
+                page = block.page
+            else:
+                if not content and not heading:
+                    page = block.page
+                content.append(block)
+        if content:
+            sections.append((heading, page, content))
+        return sections
+
+    def chunk_blocks(self, blocks: List[Block], source: str) -> List[Document]:
+        """
+        Chunks the blocks of a document.
+
+        Args:
+            blocks (List[Block]): The blocks in reading order.
+            source (str): The source of the document.
+
+        Returns:
+            List[Document]: The chunks with the source, page, section and token count in the metadata.
+        """
+        sections = self.sections(blocks)
+        units = [
+            [self.block_units(block) for block in content] for _, _, content in sections
+        ]
+        texts = [heading for heading, _, _ in sections] + [
+            unit for section in units for block in section for unit in block
+        ]
+        counts = iter(self.count_tokens(texts))
+        heading_counts = [next(counts) for _ in sections]
+
+        chunks = []
+        for (heading, page, content), block_units, heading_count in zip(
+            sections, units, heading_counts
+        ):
+            budget = self.chunk_tokens - heading_count
+            lines, tokens, kinds, first_page = [], 0, set(), page
+
+            def flush():
+                nonlocal lines, tokens, kinds
+                if lines:
+                    chunks.append((heading, first_page, lines, sorted(kinds)))
+                lines, tokens, kinds = [], 0, set()
+
+            for block, block_texts in zip(content, block_units):
+                sized = [(text, next(counts)) for text in block_texts]
+                header = sized[0] if block.kind == "table" and len(sized) > 1 else None
+                block_tokens = sum(count for _, count in sized)
+                # A block that fits into an empty chunk is not split.
+                if lines and tokens + block_tokens > budget >= block_tokens:
+                    flush()
+                for text, count in sized:
+                    pieces = (
+                        self.split_by_tokens(text, budget)
+                        if count > budget
+                        else [(text, count)]
+                    )
+                    for piece, piece_count in pieces:
+                        if lines and tokens + piece_count > budget:
+                            flush()
+                        if not lines:
+                            first_page = block.page
+                            if header is not None and (text, count) != header:
+                                lines.append(header[0])
+                                tokens += header[1]
+                        lines.append(piece)
+                        tokens += piece_count
+                        kinds.add(block.kind)
+            flush()
+
+        page_contents = [
+            "\n".join(([heading] if heading else []) + lines)
+            for heading, _, lines, _ in chunks
+        ]
+        token_counts = [
+            count + self.special_tokens for count in self.count_tokens(page_contents)
+        ]
+        return [
+            Document(
+                page_content=page_content,
+                metadata={
+                    "source": source,
+                    "page": page,
+                    "section": heading,
+                    "block_types": ",".join(kinds),
+                    "token_count": token_count,
+                },
+            )
+            for page_content, token_count, (heading, page, _, kinds) in zip(
+                page_contents, token_counts, chunks
+            )
+        ]
+
+    def chunk_file(self, path: str) -> Tuple[List[Document], ChunkingStats]:
+        """
+        Chunks a PDF file.
+
+        Args:
+            path (str): The path of the PDF file.
+
+        Returns:
+            Tuple[List[Document], ChunkingStats]: The chunks and the statistics of the file.
+        """
+        stats = ChunkingStats(files=1)
+        start = time.perf_counter()
+        try:
+            blocks, stats.pages = self.parser.parse(path)
+            docs = self.chunk_blocks(blocks, source=path)
+        except Exception as e:
+            logger.error(f"CHUNKING OF {path} FAILED: {e}")
+            stats.failed_files.append(path)
+            return [], stats
+        stats.chunks = len(docs)
+        stats.tokens = sum(doc.metadata["token_count"] for doc in docs)
+        stats.truncated = sum(
+            1 for doc in docs if doc.metadata["token_count"] > self.max_tokens
+        )
+        stats.seconds = time.perf_counter() - start
+        return docs, stats
+
+
+# The chunker of a worker process, created once per process by init_worker.
+_worker_chunker: Optional[StructuredChunker] = None
+
+
+def init_worker(config: dict) -> None:
+    global _worker_chunker
+    _worker_chunker = StructuredChunker(**config)
+
+
+def chunk_file_in_worker(path: str) -> Tuple[List[Document], ChunkingStats]:
+    return _worker_chunker.chunk_file(path)
+
+
+def chunk_files(
+    paths: Iterable[str], workers: int = None, **config
+) -> Tuple[List[Document], ChunkingStats]:
+    """
+    Chunks PDF files in a pool of processes, each with its own tokenizer.
+
+    Args:
+        paths (Iterable[str]): The paths of the PDF files.
+        workers (int, optional): The number of processes. Defaults to the number of CPUs.
+        **config: The arguments of the StructuredChunker.
+
+    Returns:
+        Tuple[List[Document], ChunkingStats]: The chunks in the order of the files and the statistics of the run.
+    """
+    paths = list(paths)
+    stats = ChunkingStats()
+    start = time.perf_counter()
+    docs = []
+    workers = min(workers or os.cpu_count() or 1, max(len(paths), 1))
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=init_worker, initargs=(config,)
+    ) as executor:
+        for file_docs, file_stats in executor.map(chunk_file_in_worker, paths):
+            docs += file_docs
+            stats.merge(file_stats)
+    stats.seconds = time.perf_counter() - start
+    return docs, stats
+
+
+def main():
+    """Chunks the PDFs of a directory and loads them into the vector store of a knowledge base from the command line."""
+    parser = argparse.ArgumentParser(description=StructuredChunker.__doc__)
+    parser.add_argument("--path-kb", required=True, help="Knowledge base directory.")
+    parser.add_argument("--path-docs", required=True, help="Directory of the PDFs.")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes.")
+    parser.add_argument(
+        "--chunk-tokens", type=int, default=450, help="Target tokens per chunk."
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only chunk and report, do not load the chunks.",
+    )
+    args = parser.parse_args()
+
+    paths = sorted(
+        glob.glob(os.path.join(args.path_docs, "**", "*.pdf"), recursive=True)
+    )
+    docs, stats = chunk_files(
+        paths, workers=args.workers, chunk_tokens=args.chunk_tokens
+    )
+    if not args.dry_run:
+        start = time.perf_counter()
+        kb = KnowledgeBase(
+            path_sql_db=args.path_kb + "/sqlite_db.db",
+            path_vector_store=args.path_kb + "/chroma_db",
+            path_email_storage=args.path_kb + "/email_storage",
+            embedding_model=setup_embeddings(),
+        )
+        kb.load_docs_to_vector_store(docs)
+        kb.close()
+        stats.seconds += time.perf_counter() - start
+    stats.report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import re
+from typing import Dict, List, Set, Tuple
+
+import application.templates as tl
+
+UMLAUTS = str.maketrans({"ä": "ae", "ö": "oe", "ü": "ue", "ß": "ss"})
+# Shorter parts of column names, e.g. "lang" of Bezeichnung_lang or "fuer" of Ersatz_fuer, are prefixes of
+# common words ("lange", "für"). Such columns are found by their synonyms only.
+MIN_NAME_TERM_LENGTH = 6
+
+
+def normalize_tokens(text: str) -> List[str]:
+    """Lowercases the text, replaces umlauts and splits it into alphanumeric tokens."""
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", str(text))
+    return re.findall(r"[a-z0-9]+", text.lower().translate(UMLAUTS))
+
+
+def term_matches(token: str, term: str) -> bool:
+    """
+    Checks if a question token matches an index term.
+    Short terms have to match exactly, longer terms also match inflections and compounds.
+    """
+    if len(term) < 4:
+        return token == term
+    return token.startswith(term) or (len(term) >= 6 and term in token)
+
+
+class ColumnSelector:
+    """Selects the columns of a product row that are relevant to a question."""
+
+    def __init__(
+        self,
+        column_index: Dict[str, dict] = None,
+        identifier_columns: List[str] = None,
+    ):
+        """
+        Initializes a ColumnSelector object.
+
+        Args:
+            column_index (Dict[str, dict], optional): Synonyms and descriptions per column. Defaults to tl.product_column_index.
+            identifier_columns (List[str], optional): Columns that are always selected. Defaults to tl.product_identifier_columns.
+        """
+        self.column_index = column_index or tl.product_column_index
+        self.identifier_columns = identifier_columns or tl.product_identifier_columns
+        self.index_cache: Dict[Tuple[str, ...], Dict[str, Set[str]]] = {}
+
+    def build_index(self, columns: Tuple[str, ...]) -> Dict[str, Set[str]]:
+        """
+        Builds the index terms for the given columns from their synonyms, descriptions and the longer parts of their names.
+
+        Args:
+            columns (Tuple[str, ...]): The column names of the product row.
+
+        Returns:
+            Dict[str, Set[str]]: The index terms per column.
+        """
+        index = {}
+        for column in columns:
+            entry = self.column_index.get(column, {})
+            terms = {
+                t for t in normalize_tokens(column) if len(t) >= MIN_NAME_TERM_LENGTH
+            }
+            terms.update(entry.get("synonyms", []))
+            terms.update(
+                t for t in normalize_tokens(entry.get("description", "")) if len(t) >= 6
+            )
+            index[column] = terms
+        return index
+
+    def get_index(self, columns: Tuple[str, ...]) -> Dict[str, Set[str]]:
+        """Returns the precomputed index for the given columns."""
+        if columns not in self.index_cache:
+            self.index_cache[columns] = self.build_index(columns)
+        return self.index_cache[columns]
+
+    def match_columns(self, question: str, columns: Tuple[str, ...]) -> List[str]:
+        """
+        Returns the columns whose index terms match the question.
+
+        Args:
+            question (str): The question of the user.
+            columns (Tuple[str, ...]): The column names of the product row.
+
+        Returns:
+            List[str]: The matched columns in the order of the product row.
+        """
+        tokens = set(normalize_tokens(question))
+        index = self.get_index(columns)
+        return [
+            column
+            for column in columns
+            if any(
+                term_matches(token, term) for token in tokens for term in index[column]
+            )
+        ]
+
+    def select(self, question: str, product_info: dict) -> dict:
+        """
+        Reduces the product information to the identifiers and the columns relevant to the question.
+
+        Args:
+            question (str): The question of the user.
+            product_info (dict): The product row.
+
+        Returns:
+            dict: The reduced product row, or the full row if no column matches the question.
+        """
+        columns = tuple(product_info)
+        matched = self.match_columns(question, columns)
+        if not matched:
+            return product_info
+        selected = set(matched) | set(self.identifier_columns)
+        return {k: v for k, v in product_info.items() if k in selected}
@@ -1,10 +1,33 @@
-from pprint import pformat
 import re
-import os
-import json
-import application.templates as tl
 from utils.logging_utils import logger
 from application.knowledge_base import KnowledgeBase
+from application.escalation_store import STATUS_IN_KB, render_email
+
+
+def parse_expert_reply(txt_file: str) -> tuple:
+    """
+    Parses the question ID and the expert's answer from a reply to an escalation email.
+
+    Args:
+        txt_file (str): The path to the text file.
+
+    Returns:
+        A tuple containing the question ID and the expert's response.
+    """
+    with open(txt_file, "r") as file:
+        contents = file.read()
+
+    human_answer = re.search(
+        "<\|human_expert\|>(.*?)<\/\|human_expert\|>", contents, re.DOTALL
+    )
+    question_id = re.search("'question_id': '([^']+)'", contents, re.DOTALL)
+    if human_answer is None or question_id is None:
+        raise ValueError(f"No question ID or expert answer found in {txt_file}")
+
+    human_answer = human_answer.group(1).replace("\n", "")
+    if not human_answer.strip():
+        raise ValueError(f"Empty expert answer in {txt_file}")
+    return question_id.group(1), human_answer
 
 
 class CommunicationHandler:
@@ -17,31 +40,28 @@ class CommunicationHandler:
         Args:
             knowledge_base (KnowledgeBase): The knowledge base.
         """
-        self.email_template = tl.email_template
         self.kb = knowledge_base
         self.email_storage = self.kb.path_email_storage
+        self.path_outbox = f"{self.email_storage}/outbox"
+        self.escalation_store = self.kb.escalation_store
 
-    def send_email_and_save_json(self, email: str, llm_output: dict) -> None:
+    def save_escalation(self, llm_output: dict) -> str:
         """
-        Saves the email and LLM output.
+        Saves the unanswered question in the escalation store and writes its email to the outbox.
+        The emails of the store can be exported again with escalation_store.py.
 
         Args:
-            email (str): The email content.
             llm_output (dict): The LLM output as a dictionary.
-        """
-        question_id = llm_output["question_id"]
-        folder_path = f"{self.email_storage}/{question_id}"
-        os.makedirs(folder_path, exist_ok=True)
-
-        # Save email
-        email_file_path = f"{folder_path}/mail_{question_id}.txt"
-        with open(email_file_path, "w") as file:
-            file.write(email)
 
-        # Save LLM output
-        llm_output_file_path = f"{folder_path}/output_{question_id}.json"
-        with open(llm_output_file_path, "w") as file:
-            json.dump(llm_output, file)
+        Returns:
+            str: The path of the email file.
+        """
+        self.escalation_store.add(llm_output)
+        path = self.escalation_store.write_email(
+            llm_output["question_id"], self.path_outbox
+        )
+        logger.info(f"ESCALATION EMAIL WRITTEN TO {path}")
+        return path
 
     def create_email(self, llm_output: dict) -> str:
         """
@@ -53,11 +73,7 @@ class CommunicationHandler:
         Returns:
             The formatted email content as a string.
         """
-        email_content = self.email_template.format(
-            type_question=llm_output["question_type"],
-            llm_output=pformat(llm_output, sort_dicts=False),
-        )
-        return email_content
+        return render_email(llm_output)
 
     def ask_user(self) -> bool:
         """
@@ -79,8 +95,7 @@ class CommunicationHandler:
             llm_output (dict): The LLM output as a dictionary.
         """
         if self.ask_user():
-            email = self.create_email(llm_output)
-            self.send_email_and_save_json(email, llm_output)
+            self.save_escalation(llm_output)
             print(">>> Ihre Frage wurde an einen Experten weitergeleitet.\n")
             logger.info("QUESTION NOT SOLVED! EMAIL SENT TO EXPERT.")
 
@@ -94,17 +109,7 @@ class CommunicationHandler:
         Returns:
             A tuple containing the question ID and the expert's response.
         """
-        with open(txt_file, "r") as file:
-            contents = file.read()
-
-        human_answer = re.search(
-            "<\|human_expert\|>(.*?)<\/\|human_expert\|>", contents, re.DOTALL
-        )
-        question_id = re.search("'question_id': '([^']+)'", contents, re.DOTALL)
-
-        human_answer = human_answer.group(1).replace("\n", "")
-        question_id = question_id.group(1)
-        return question_id, human_answer
+        return parse_expert_reply(txt_file)
 
     def send_expert_response_to_kb(self, txt_file: str) -> None:
         """
@@ -114,5 +119,7 @@ class CommunicationHandler:
             txt_file (str): The path to the text file containing the expert's response.
         """
         question_id, human_answer = self.get_expert_response(txt_file)
+        self.escalation_store.set_expert_answer(question_id, human_answer, txt_file)
         doc = self.kb.create_expert_doc(question_id, human_answer, txt_file)
-        self.kb.load_doc_to_vector_store(doc)
+        self.kb.add_expert_docs([doc])
+        self.escalation_store.set_status([question_id], STATUS_IN_KB)
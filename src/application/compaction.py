@@ -0,0 +1,377 @@
+import argparse
+import re
+import zlib
+from collections import defaultdict
+from typing import Dict, List, Set, Tuple
+
+import numpy as np
+from application.knowledge_base import KnowledgeBase
+from application.models import setup_embeddings
+from utils.logging_utils import logger
+
+MINHASH_PRIME = (1 << 31) - 1
+
+
+def normalize_text(text: str) -> List[str]:
+    """Lowercases the text and splits it into words, so whitespace and punctuation differences are ignored."""
+    return re.findall(r"\w+", text.lower())
+
+
+def number_tokens(text: str) -> Tuple[str, ...]:
+    """Returns the words with digits of the text, e.g. wattages, lumen values and order numbers, sorted."""
+    return tuple(
+        sorted(word for word in normalize_text(text) if any(c.isdigit() for c in word))
+    )
+
+
+def shingles(text: str, size: int = 5) -> Set[int]:
+    """
+    Hashes the word shingles of the text.
+
+    Args:
+        text (str): The chunk text.
+        size (int): The number of words per shingle. Defaults to 5.
+
+    Returns:
+        Set[int]: The 31-bit hashes of the shingles. Texts shorter than the shingle size form one shingle.
+    """
+    words = normalize_text(text)
+    if len(words) <= size:
+        return {zlib.crc32(" ".join(words).encode()) % MINHASH_PRIME}
+    return {
+        zlib.crc32(" ".join(words[i : i + size]).encode()) % MINHASH_PRIME
+        for i in range(len(words) - size + 1)
+    }
+
+
+class IndexCompactor:
+    """Finds and removes near-duplicate chunks in the vector store of a knowledge base.
+
+    Candidate pairs come from MinHash signatures with LSH banding over the chunk text and from the
+    nearest neighbours in the embedding space (e.g. the same disclaimer in another language).
+    A candidate pair is a duplicate if the embeddings are near-identical, or if the texts overlap strongly
+    and the embeddings are similar, and in both cases only if the texts contain the same numbers and codes,
+    so datasheets of product variants that differ in wattage, lumen or order number are kept. Every
+    duplicate is verified against the chunk that is kept, duplicates are not chained over other chunks.
+    Each group is reduced to the kept chunk, which lists the sources of the removed chunks in its metadata.
+    Expert answers are only merged with answers to the same question.
+    """
+
+    def __init__(
+        self,
+        knowledge_base: KnowledgeBase,
+        num_perm: int = 64,
+        bands: int = 16,
+        shingle_size: int = 5,
+        text_threshold: float = 0.8,
+        text_embedding_threshold: float = 0.9,
+        embedding_threshold: float = 0.98,
+        neighbors: int = 3,
+        seed: int = 42,
+    ):
+        """
+        Initializes an IndexCompactor object.
+
+        Args:
+            knowledge_base (KnowledgeBase): The knowledge base to compact.
+            num_perm (int): The number of MinHash permutations. Defaults to 64.
+            bands (int): The number of LSH bands, must divide num_perm. Defaults to 16.
+            shingle_size (int): The number of words per shingle. Defaults to 5.
+            text_threshold (float): The minimum estimated Jaccard similarity of a text duplicate. Defaults to 0.8.
+            text_embedding_threshold (float): The minimum cosine similarity of a text duplicate. Defaults to 0.9.
+            embedding_threshold (float): The cosine similarity above which chunks are duplicates
+                regardless of their text. Defaults to 0.98.
+            neighbors (int): The number of nearest neighbours checked per chunk. Defaults to 3.
+            seed (int): The seed of the MinHash permutations. Defaults to 42.
+        """
+        if num_perm % bands != 0:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.kb = knowledge_base
+        self.collection = knowledge_base.vector_store._collection
+        self.num_perm = num_perm
+        self.bands = bands
+        self.shingle_size = shingle_size
+        self.text_threshold = text_threshold
+        self.text_embedding_threshold = text_embedding_threshold
+        self.embedding_threshold = embedding_threshold
+        self.neighbors = neighbors
+        rng = np.random.default_rng(seed)
+        self.perm_a = rng.integers(1, MINHASH_PRIME, num_perm, dtype=np.uint64)
+        self.perm_b = rng.integers(0, MINHASH_PRIME, num_perm, dtype=np.uint64)
+
+        self.ids: List[str] = []
+        self.texts: List[str] = []
+        self.metadatas: List[dict] = []
+        self.embeddings: np.ndarray = None
+        self.signatures: np.ndarray = None
+        self.numbers: List[Tuple[str, ...]] = []
+
+    def load(self) -> None:
+        """Loads all chunks with their embeddings and computes the MinHash signatures."""
+        data = self.collection.get(include=["documents", "metadatas", "embeddings"])
+        self.ids = data["ids"]
+        self.texts = data["documents"]
+        self.metadatas = [metadata or {} for metadata in data["metadatas"]]
+        embeddings = np.asarray(data["embeddings"], dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        self.embeddings = embeddings / np.where(norms == 0, 1, norms)
+        self.signatures = np.stack([self.minhash(text) for text in self.texts])
+        self.numbers = [number_tokens(text) for text in self.texts]
+        logger.info(f"LOADED {len(self.ids)} CHUNKS FOR COMPACTION")
+
+    def minhash(self, text: str) -> np.ndarray:
+        """Computes the MinHash signature of the text."""
+        hashes = np.fromiter(shingles(text, self.shingle_size), dtype=np.uint64)
+        permuted = (np.outer(hashes, self.perm_a) + self.perm_b) % MINHASH_PRIME
+        return permuted.min(axis=0)
+
+    def is_expert(self, i: int) -> bool:
+        return self.metadatas[i].get("keywords") == "expert_answer"
+
+    def text_candidates(self) -> Set[Tuple[int, int]]:
+        """Finds the chunk pairs that share at least one LSH band of their MinHash signatures."""
+        rows = self.num_perm // self.bands
+        candidates = set()
+        for band in range(self.bands):
+            buckets = defaultdict(list)
+            for i, signature in enumerate(self.signatures):
+                buckets[signature[band * rows : (band + 1) * rows].tobytes()].append(i)
+            for members in buckets.values():
+                for j, first in enumerate(members):
+                    for second in members[j + 1 :]:
+                        candidates.add((first, second))
+        return candidates
+
+    def embedding_candidates(self, batch_size: int = 256) -> Set[Tuple[int, int]]:
+        """Finds the nearest neighbours of every chunk with batched queries of the vector index."""
+        index_of = {chunk_id: i for i, chunk_id in enumerate(self.ids)}
+        n_results = min(self.neighbors + 1, len(self.ids))
+        candidates = set()
+        for start in range(0, len(self.ids), batch_size):
+            results = self.collection.query(
+                query_embeddings=self.embeddings[start : start + batch_size].tolist(),
+                n_results=n_results,
+                include=[],
+            )
+            for offset, neighbor_ids in enumerate(results["ids"]):
+                i = start + offset
+                for neighbor_id in neighbor_ids:
+                    j = index_of[neighbor_id]
+                    if i != j:
+                        candidates.add((min(i, j), max(i, j)))
+        return candidates
+
+    def is_duplicate(self, i: int, j: int) -> bool:
+        """Checks whether two chunks are duplicates, see the class description."""
+        if self.is_expert(i) != self.is_expert(j):
+            return False
+        if self.is_expert(i) and self.metadatas[i].get("question_id") != self.metadatas[
+            j
+        ].get("question_id"):
+            return False
+        if self.numbers[i] != self.numbers[j]:
+            return False
+        cosine = float(self.embeddings[i] @ self.embeddings[j])
+        jaccard = float(np.mean(self.signatures[i] == self.signatures[j]))
+        return cosine >= self.embedding_threshold or (
+            jaccard >= self.text_threshold and cosine >= self.text_embedding_threshold
+        )
+
+    def representative_key(self, i: int) -> tuple:
+        """Orders the chunks by preference to be kept: expert answers by age, other chunks by length."""
+        if self.is_expert(i):
+            return (True, self.metadatas[i].get("creationDate", ""))
+        return (False, len(self.texts[i]), -i)
+
+    def find_duplicate_groups(self) -> List[List[int]]:
+        """
+        Verifies the candidate pairs and groups the duplicates around the chunks that are kept.
+
+        Returns:
+            List[List[int]]: The indices of the chunks per group of duplicates, the kept chunk first.
+        """
+        duplicates = defaultdict(set)
+        for i, j in self.text_candidates() | self.embedding_candidates():
+            if self.is_duplicate(i, j):
+                duplicates[i].add(j)
+                duplicates[j].add(i)
+        groups = []
+        assigned = set()
+        # The most preferred chunk keeps its direct duplicates, which are not checked against each other.
+        for keep in sorted(duplicates, key=self.representative_key, reverse=True):
+            if keep in assigned:
+                continue
+            members = sorted(duplicates[keep] - assigned)
+            if members:
+                assigned.update([keep, *members])
+                groups.append([keep, *members])
+        return groups
+
+    def merge_metadata(self, keep: int, group: List[int]) -> dict:
+        """Adds the sources of all chunks in the group to the metadata of the kept chunk."""
+        metadata = dict(self.metadatas[keep])
+        sources = []
+        for i in group:
+            source = str(self.metadatas[i].get("source", ""))
+            page = self.metadatas[i].get("page")
+            entry = f"{source} (p. {page})" if page is not None else source
+            if entry and entry not in sources:
+                sources.append(entry)
+        # Chroma metadata values must be scalars, so the sources are joined to one string.
+        metadata["merged_sources"] = "; ".join(sources)
+        metadata["merged_count"] = len(group)
+        return metadata
+
+    def plan(self) -> Dict[str, dict]:
+        """
+        Plans the compaction without changing the vector store.
+
+        Returns:
+            Dict[str, dict]: Per kept chunk ID the merged metadata and the IDs of the removed duplicates.
+        """
+        if self.signatures is None:
+            self.load()
+        plan = {}
+        for group in self.find_duplicate_groups():
+            keep = group[0]
+            plan[self.ids[keep]] = {
+                "metadata": self.merge_metadata(keep, group),
+                "removed_ids": [self.ids[i] for i in group if i != keep],
+            }
+        return plan
+
+    def measure_diversity(
+        self, queries: List[str], k: int, excluded_ids: Set[str]
+    ) -> dict:
+        """
+        Measures the diversity of the top-k search results, ignoring the excluded chunks.
+
+        Args:
+            queries (List[str]): The evaluation queries.
+            k (int): The number of results per query.
+            excluded_ids (Set[str]): The chunk IDs that are treated as removed.
+
+        Returns:
+            dict: The mean pairwise cosine similarity and the mean number of distinct sources of the top-k results.
+        """
+        index_of = {chunk_id: i for i, chunk_id in enumerate(self.ids)}
+        # Extra results replace the excluded chunks, so the ranking after the compaction is simulated.
+        n_results = k * 4 if excluded_ids else k
+        results = self.kb.search_with_scores(queries, k=n_results)
+        similarities, distinct_sources = [], []
+        for scored_docs in results:
+            top = [
+                index_of[doc.metadata["chunk_id"]]
+                for doc, _ in scored_docs
+                if doc.metadata["chunk_id"] not in excluded_ids
+            ][:k]
+            if len(top) < 2:
+                continue
+            vectors = self.embeddings[top]
+            pairwise = vectors @ vectors.T
+            similarities.append(pairwise[np.triu_indices(len(top), 1)].mean())
+            distinct_sources.append(len({self.metadatas[i].get("source") for i in top}))
+        return {
+            "mean_pairwise_similarity": (
+                float(np.mean(similarities)) if similarities else np.nan
+            ),
+            "mean_distinct_sources": (
+                float(np.mean(distinct_sources)) if distinct_sources else np.nan
+            ),
+        }
+
+    def index_size(self, excluded_ids: Set[str]) -> dict:
+        """Returns the number of chunks and the approximate size of texts and embeddings in bytes."""
+        kept = [
+            i for i, chunk_id in enumerate(self.ids) if chunk_id not in excluded_ids
+        ]
+        dimension = self.embeddings.shape[1] if len(self.ids) else 0
+        return {
+            "chunks": len(kept),
+            "bytes": sum(len(self.texts[i].encode()) + dimension * 4 for i in kept),
+        }
+
+    def run(self, queries: List[str] = None, k: int = 3, dry_run: bool = False) -> dict:
+        """
+        Compacts the vector store and reports the index size and retrieval diversity before and after.
+
+        Args:
+            queries (List[str], optional): The queries for the diversity measurement.
+                Defaults to a sample of 200 chunk texts.
+            k (int): The number of results per query of the diversity measurement. Defaults to 3.
+            dry_run (bool): Whether only the report is created without changing the vector store. Defaults to False.
+
+        Returns:
+            dict: The number of merged groups and removed chunks, and the size and diversity before and after.
+        """
+        plan = self.plan()
+        removed_ids = {
+            chunk_id for entry in plan.values() for chunk_id in entry["removed_ids"]
+        }
+
+        if queries is None:
+            rng = np.random.default_rng(0)
+            sample = rng.choice(
+                len(self.texts), min(200, len(self.texts)), replace=False
+            )
+            queries = [self.texts[i] for i in sample]
+        report = {
+            "groups": len(plan),
+            "removed_chunks": len(removed_ids),
+            "size_before": self.index_size(set()),
+            "size_after": self.index_size(removed_ids),
+            "diversity_before": self.measure_diversity(queries, k, set()),
+            "diversity_after": self.measure_diversity(queries, k, removed_ids),
+        }
+
+        if not dry_run and plan:
+            self.collection.update(
+                ids=list(plan.keys()),
+                metadatas=[entry["metadata"] for entry in plan.values()],
+            )
+            self.collection.delete(ids=list(removed_ids))
+            expert_ids = [
+                chunk_id for chunk_id in removed_ids if chunk_id.startswith("expert_")
+            ]
+            if expert_ids:
+                self.kb.expert_index.collection.delete(ids=expert_ids)
+            if self.kb.lexical_index is not None:
+                self.kb.lexical_index.delete(removed_ids)
+                self.kb.lexical_index.save()
+            if self.kb.shard_index is not None:
+                for shard in self.kb.shard_index.collections.values():
+                    shard.delete(ids=list(removed_ids))
+                    kept_ids = shard.get(ids=list(plan.keys()), include=[])["ids"]
+                    if kept_ids:
+                        shard.update(
+                            ids=kept_ids,
+                            metadatas=[
+                                plan[chunk_id]["metadata"] for chunk_id in kept_ids
+                            ],
+                        )
+            self.signatures = None
+
+        logger.info(f"INDEX COMPACTION{' (DRY RUN)' if dry_run else ''}: {report}")
+        return report
+
+
+def main():
+    """Compacts the vector store of a knowledge base from the command line."""
+    parser = argparse.ArgumentParser(description=IndexCompactor.__doc__)
+    parser.add_argument("--path-kb", required=True, help="Knowledge base directory.")
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Only report, do not change the index."
+    )
+    args = parser.parse_args()
+
+    kb = KnowledgeBase(
+        path_sql_db=args.path_kb + "/sqlite_db.db",
+        path_vector_store=args.path_kb + "/chroma_db",
+        path_email_storage=args.path_kb + "/email_storage",
+        embedding_model=setup_embeddings(),
+    )
+    IndexCompactor(kb).run(dry_run=args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
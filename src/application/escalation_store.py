@@ -0,0 +1,282 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from pprint import pformat
+from typing import List, Optional, Tuple
+
+import application.templates as tl
+from application.results import as_dict
+from utils.logging_utils import logger
+
+STATUS_OPEN = "open"
+STATUS_ANSWERED = "answered"
+STATUS_IN_KB = "in_knowledge_base"
+
+
+def render_email(llm_output: dict) -> str:
+    """
+    Creates the email for an unanswered question.
+
+    Args:
+        llm_output (dict): The LLM output as a dictionary or chain result.
+
+    Returns:
+        The formatted email content as a string.
+    """
+    llm_output = as_dict(llm_output)
+    return tl.email_template.format(
+        type_question=llm_output["question_type"],
+        llm_output=pformat(llm_output, sort_dicts=False),
+    )
+
+
+class EscalationStore:
+    """Stores the questions forwarded to human experts in a SQLite database in WAL mode, keyed by question_id."""
+
+    def __init__(self, path_db: str):
+        """
+        Initializes an EscalationStore object.
+
+        Args:
+            path_db (str): The path to the SQLite database file.
+        """
+        self.path_db = path_db
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path_db, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.setup_database()
+
+    def setup_database(self) -> None:
+        """Enables WAL mode and creates the escalations table."""
+        with self._lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL;")
+            self.conn.execute("PRAGMA synchronous=NORMAL;")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS escalations (
+                    question_id TEXT PRIMARY KEY,
+                    question_type TEXT,
+                    question TEXT,
+                    status TEXT NOT NULL,
+                    llm_output TEXT NOT NULL,
+                    expert_answer TEXT,
+                    source TEXT,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL
+                );""")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_escalations_status ON escalations (status, created_at);"
+            )
+
+    def add(self, llm_output: dict) -> None:
+        """Adds an unanswered question."""
+        self.add_many([llm_output])
+
+    def add_many(self, llm_outputs: List[dict]) -> None:
+        """
+        Adds several unanswered questions in one transaction. Known question IDs are ignored.
+
+        Args:
+            llm_outputs (List[dict]): The LLM outputs as dictionaries or chain results.
+        """
+        now = datetime.now().isoformat()
+        llm_outputs = [as_dict(output) for output in llm_outputs]
+        rows = [
+            (
+                output["question_id"],
+                output.get("question_type"),
+                output.get("question"),
+                STATUS_OPEN,
+                json.dumps(output, default=str),
+                now,
+                now,
+            )
+            for output in llm_outputs
+        ]
+        with self._lock, self.conn:
+            self.conn.executemany(
+                """INSERT OR IGNORE INTO escalations
+                (question_id, question_type, question, status, llm_output, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?);""",
+                rows,
+            )
+
+    def row_to_dict(self, row: sqlite3.Row) -> dict:
+        """Converts a database row to a dictionary with the decoded LLM output."""
+        record = dict(row)
+        record["llm_output"] = json.loads(record["llm_output"])
+        return record
+
+    def get(self, question_id: str) -> Optional[dict]:
+        """
+        Returns the escalation of the given question.
+
+        Args:
+            question_id (str): The ID of the question.
+
+        Returns:
+            dict or None: The escalation record, or None if the question is unknown.
+        """
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT * FROM escalations WHERE question_id = ?;", (question_id,)
+            ).fetchone()
+        return self.row_to_dict(row) if row else None
+
+    def list_by_status(
+        self, status: str = STATUS_OPEN, limit: int = 100, offset: int = 0
+    ) -> List[dict]:
+        """Returns the escalations with the given status, oldest first."""
+        with self._lock:
+            rows = self.conn.execute(
+                """SELECT * FROM escalations WHERE status = ?
+                ORDER BY created_at LIMIT ? OFFSET ?;""",
+                (status, limit, offset),
+            ).fetchall()
+        return [self.row_to_dict(row) for row in rows]
+
+    def count_by_status(self) -> dict:
+        """Returns the number of escalations per status."""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT status, COUNT(*) FROM escalations GROUP BY status;"
+            ).fetchall()
+        return {status: count for status, count in rows}
+
+    def set_status(self, question_ids: List[str], status: str) -> None:
+        """Sets the status of the given questions in one transaction."""
+        now = datetime.now().isoformat()
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "UPDATE escalations SET status = ?, updated_at = ? WHERE question_id = ?;",
+                [(status, now, question_id) for question_id in question_ids],
+            )
+
+    def set_expert_answer(
+        self, question_id: str, expert_answer: str, source: str
+    ) -> None:
+        """Stores the answer of the expert and marks the question as answered."""
+        self.set_expert_answers([(question_id, expert_answer, source)])
+
+    def set_expert_answers(
+        self, answers: List[Tuple[str, str, str]], status: str = STATUS_ANSWERED
+    ) -> None:
+        """
+        Stores several expert answers in one transaction.
+
+        Args:
+            answers (List[Tuple[str, str, str]]): The question ID, expert answer and source per answer.
+            status (str): The new status of the questions. Defaults to "answered".
+        """
+        now = datetime.now().isoformat()
+        with self._lock, self.conn:
+            self.conn.executemany(
+                """UPDATE escalations SET expert_answer = ?, source = ?, status = ?, updated_at = ?
+                WHERE question_id = ?;""",
+                [
+                    (expert_answer, source, status, now, question_id)
+                    for question_id, expert_answer, source in answers
+                ],
+            )
+
+    def render_email(self, question_id: str) -> str:
+        """Creates the email of the given question on demand."""
+        record = self.get(question_id)
+        if record is None:
+            raise KeyError(f"Unknown question ID: {question_id}")
+        return render_email(record["llm_output"])
+
+    def write_email(self, question_id: str, directory: str) -> str:
+        """
+        Writes the email of the given question to a directory as mail_<question_id>.txt.
+
+        Args:
+            question_id (str): The ID of the question.
+            directory (str): The directory, e.g. the outbox of the email storage.
+
+        Returns:
+            str: The path of the written email file.
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = f"{directory}/mail_{question_id}.txt"
+        with open(path, "w") as file:
+            file.write(self.render_email(question_id))
+        return path
+
+    def export_emails(self, directory: str, status: str = STATUS_OPEN) -> List[str]:
+        """
+        Writes the emails of all escalations with the given status to a directory.
+
+        Args:
+            directory (str): The export directory.
+            status (str): The status of the exported escalations. Defaults to "open".
+
+        Returns:
+            List[str]: The paths of the written email files.
+        """
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        offset = 0
+        while records := self.list_by_status(status, limit=500, offset=offset):
+            for record in records:
+                path = f"{directory}/mail_{record['question_id']}.txt"
+                with open(path, "w") as file:
+                    file.write(render_email(record["llm_output"]))
+                paths.append(path)
+            offset += len(records)
+        logger.info(f"EXPORTED {len(paths)} EMAILS TO {directory}")
+        return paths
+
+    def import_legacy_directory(self, path_email_storage: str) -> int:
+        """
+        Imports the per-question directories written by earlier versions (<question_id>/output_<question_id>.json).
+
+        Args:
+            path_email_storage (str): The path to the email storage directory.
+
+        Returns:
+            int: The number of imported questions.
+        """
+        llm_outputs = []
+        for entry in os.scandir(path_email_storage):
+            path = f"{entry.path}/output_{entry.name}.json"
+            if entry.is_dir() and os.path.exists(path):
+                with open(path, "r") as file:
+                    llm_outputs.append(json.load(file))
+        self.add_many(llm_outputs)
+        logger.info(f"IMPORTED {len(llm_outputs)} LEGACY ESCALATIONS")
+        return len(llm_outputs)
+
+    def close(self) -> None:
+        """Closes the database connection."""
+        with self._lock:
+            self.conn.close()
+
+
+def main():
+    """Exports the escalation emails of a knowledge base from the command line, e.g. to resend them."""
+    parser = argparse.ArgumentParser(description=EscalationStore.__doc__)
+    parser.add_argument("--path-kb", required=True, help="Knowledge base directory.")
+    parser.add_argument(
+        "--status",
+        default=STATUS_OPEN,
+        choices=[STATUS_OPEN, STATUS_ANSWERED, STATUS_IN_KB],
+        help="Status of the exported escalations.",
+    )
+    parser.add_argument(
+        "--out", help="Export directory. Defaults to the outbox of the email storage."
+    )
+    args = parser.parse_args()
+
+    path_email_storage = args.path_kb + "/email_storage"
+    store = EscalationStore(f"{path_email_storage}/escalations.db")
+    try:
+        logger.info(f"ESCALATIONS BY STATUS: {store.count_by_status()}")
+        store.export_emails(args.out or f"{path_email_storage}/outbox", args.status)
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import re
+from typing import Callable, List, Optional, Set
+
+from chromadb.api import ClientAPI
+from langchain_core.documents.base import Document
+from utils.logging_utils import logger
+
+
+def number_tokens(text: str) -> Set[str]:
+    """Returns the digit runs of the text, e.g. product codes, wattages and lengths."""
+    return set(re.findall(r"\d+", text))
+
+
+class ExpertAnswerIndex:
+    """Index of the questions answered by human experts, used to return verified answers without generation.
+
+    Only the expert questions are embedded, so an incoming question is compared with questions, not with answers.
+    The similarity threshold depends on the embedding model and the questions, so matching is off until the
+    threshold is tuned for the knowledge base (see ExpertThresholdTuner). A match also requires the numbers
+    of both questions to be equal, so a question about another product code never gets the stored answer.
+    Queries the lexical check answers from the documents, e.g. strong BM25 hits, are not embedded at all.
+    """
+
+    def __init__(
+        self,
+        client: ClientAPI,
+        embed_queries: Callable[[List[str]], List[List[float]]],
+        collection_name: str = "expert_answers",
+        score_threshold: Optional[float] = None,
+        lexical_check: Optional[Callable[[str], bool]] = None,
+    ):
+        """
+        Initializes an ExpertAnswerIndex object.
+
+        Args:
+            client (ClientAPI): The Chroma client of the knowledge base.
+            embed_queries (Callable): Function that embeds a list of texts.
+            collection_name (str): The name of the collection. Defaults to "expert_answers".
+            score_threshold (float, optional): The minimum cosine similarity of a match. Defaults to None,
+                nothing is matched.
+            lexical_check (Callable, optional): Returns True for queries with a strong lexical match in the
+                documents, which are not matched. Defaults to None, every query is matched.
+        """
+        self.embed_queries = embed_queries
+        self.score_threshold = score_threshold
+        self.lexical_check = lexical_check
+        self.collection = client.get_or_create_collection(
+            name=collection_name, metadata={"hnsw:space": "cosine"}
+        )
+
+    def parse_expert_doc(self, page_content: str, metadata: dict) -> Optional[dict]:
+        """Extracts the question and answer of an expert document created with KnowledgeBase.create_expert_doc."""
+        question = metadata.get("question")
+        answer = metadata.get("expert_answer")
+        if question is None or answer is None:
+            # Documents created before the question and answer were stored in the metadata.
+            match = re.match(r"Frage: (.*?)\. Antwort: (.*)", page_content, re.DOTALL)
+            if match is None:
+                return None
+            question, answer = match.groups()
+        return {
+            "question_id": str(metadata["question_id"]),
+            "question": question,
+            "answer": answer,
+            "source": metadata.get("source", ""),
+        }
+
+    def add_docs(self, docs: List[Document]) -> None:
+        """
+        Upserts expert documents into the index with one embedding call.
+
+        Args:
+            docs (List[Document]): The expert answer documents.
+        """
+        entries = [
+            self.parse_expert_doc(doc.page_content, doc.metadata) for doc in docs
+        ]
+        entries = [entry for entry in entries if entry is not None]
+        if not entries:
+            return
+        self.collection.upsert(
+            ids=[f"expert_{entry['question_id']}" for entry in entries],
+            embeddings=self.embed_queries([entry["question"] for entry in entries]),
+            documents=[entry["question"] for entry in entries],
+            metadatas=entries,
+        )
+
+    def rebuild(self, expert_docs: dict) -> int:
+        """
+        Rebuilds the index from the expert documents of the vector store.
+
+        Args:
+            expert_docs (dict): The result of KnowledgeBase.get_docs(keywords="expert_answer").
+
+        Returns:
+            int: The number of indexed expert answers.
+        """
+        existing = self.collection.get(include=[])["ids"]
+        if existing:
+            self.collection.delete(ids=existing)
+        docs = [
+            Document(page_content=text, metadata=metadata)
+            for text, metadata in zip(
+                expert_docs["documents"], expert_docs["metadatas"]
+            )
+        ]
+        self.add_docs(docs)
+        logger.info(f"EXPERT INDEX REBUILT WITH {self.collection.count()} ANSWERS")
+        return self.collection.count()
+
+    def match(self, query: str) -> Optional[dict]:
+        """
+        Finds a verified expert answer for the query.
+
+        Args:
+            query (str): The question of the user.
+
+        Returns:
+            dict or None: The expert question, answer, source and similarity score, or None if no expert
+            question is similar enough or the query has a strong lexical match.
+        """
+        if self.score_threshold is None or self.collection.count() == 0:
+            return None
+        if self.lexical_check is not None and self.lexical_check(query):
+            return None
+        result = self.collection.query(
+            query_embeddings=self.embed_queries([query]),
+            n_results=1,
+            include=["metadatas", "distances"],
+        )
+        if not result["ids"][0]:
+            return None
+        score = 1 - result["distances"][0][0]
+        metadata = result["metadatas"][0][0]
+        if score < self.score_threshold:
+            return None
+        if number_tokens(query) != number_tokens(metadata["question"]):
+            logger.info(
+                f"EXPERT QUESTION WITH SCORE {score:.3f} REJECTED, THE NUMBERS DIFFER"
+            )
+            return None
+        logger.info(f"EXPERT ANSWER MATCHED WITH SCORE {score:.3f}")
+        return {**metadata, "score": score}
@@ -0,0 +1,421 @@
+import json
+import time
+from contextlib import nullcontext
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional
+
+from langchain_community.llms import LlamaCpp
+from langchain_core.runnables import Runnable, RunnableConfig
+from application.models import LazyModel, set_speculative_decoding
+from utils.logging_utils import logger
+from utils.runtime_stats import runtime_stats
+
+
+@dataclass
+class GenerationConfig:
+    """
+    Generation limits of a chain.
+
+    Attributes:
+        max_tokens (int): The token budget of a single call.
+        field_max_tokens (Dict[str, int]): Token budgets for the values of top-level JSON fields.
+        stop_on_json_close (bool): Whether decoding ends as soon as the top-level JSON value is closed.
+        repetition_min_period (int): The shortest token sequence checked for repetitions. Single tokens
+            repeat legitimately, e.g. the digits of 50000 or of an EAN.
+        repetition_max_period (int): The longest token sequence checked for repetitions.
+        repetition_min_repeats (int): The number of consecutive repeats that aborts the generation.
+        speculative (bool): Whether prompt-lookup speculative decoding is used, if the LLM supports it.
+    """
+
+    max_tokens: int = 512
+    field_max_tokens: Dict[str, int] = field(default_factory=dict)
+    stop_on_json_close: bool = True
+    repetition_min_period: int = 2
+    repetition_max_period: int = 12
+    repetition_min_repeats: int = 4
+    speculative: bool = False
+
+
+@dataclass
+class GenerationReport:
+    """Report of a single controlled generation."""
+
+    chain: str
+    tokens_generated: int
+    max_tokens: int
+    tokens_saved: int
+    stop_reason: str
+    seconds: float
+    first_token_seconds: Optional[float]
+    speculative: bool = False
+
+    @property
+    def decode_tokens_per_second(self) -> Optional[float]:
+        """Returns the decoding speed without the prefill time of the first token."""
+        if self.first_token_seconds is None or self.tokens_generated < 2:
+            return None
+        decode_seconds = self.seconds - self.first_token_seconds
+        return (self.tokens_generated - 1) / decode_seconds if decode_seconds else None
+
+
+# Per-chain defaults. The field budgets follow the response schemas in templates.py.
+# Speculative decoding is enabled for the chains whose answers copy spans of the context.
+DEFAULT_GENERATION_CONFIGS = {
+    "DocumentChain": GenerationConfig(
+        max_tokens=384,
+        field_max_tokens={"answer": 256, "antwort": 256},
+        speculative=True,
+    ),
+    "ProductChain": GenerationConfig(
+        max_tokens=384,
+        field_max_tokens={"question": 96, "answer": 256, "solved": 8},
+        speculative=True,
+    ),
+    "Judge": GenerationConfig(
+        max_tokens=320,
+        field_max_tokens={"reasoning_for_correctness": 256, "correctness": 8},
+    ),
+    "QAPairDatasetGenerator": GenerationConfig(
+        max_tokens=384, field_max_tokens={"question": 96, "answer": 256}
+    ),
+}
+
+
+def get_generation_config(name: str) -> GenerationConfig:
+    """Returns a copy of the default generation config for the given chain name."""
+    config = DEFAULT_GENERATION_CONFIGS.get(name, GenerationConfig())
+    return GenerationConfig(**asdict(config))
+
+
+class JsonStreamMonitor:
+    """Tracks the structure of a streamed JSON text to detect its end and the field being written."""
+
+    def __init__(self):
+        self.stack: List[str] = []
+        self.in_string = False
+        self.escape = False
+        self.started = False
+        self.closed = False
+        self.expect_key = False
+        self.reading_key = False
+        self.awaiting_colon = False
+        self.awaiting_value = False
+        self.key_buffer = ""
+        self.current_key: Optional[str] = None
+        self.consumed = 0
+
+    def feed(self, text: str) -> int:
+        """
+        Feeds the next piece of generated text.
+
+        Args:
+            text (str): The generated text.
+
+        Returns:
+            int: The number of characters consumed. Less than len(text) if the top-level value closed within the text.
+        """
+        for index, char in enumerate(text):
+            if self.closed:
+                return index
+            self._feed_char(char)
+            self.consumed += 1
+        return len(text)
+
+    def _feed_char(self, char: str) -> None:
+        top_level_object = len(self.stack) == 1 and self.stack[0] == "{"
+
+        if self.in_string:
+            if self.escape:
+                self.escape = False
+            elif char == "\\":
+                self.escape = True
+            elif char == '"':
+                self.in_string = False
+                if self.reading_key:
+                    self.reading_key = False
+                    self.current_key = self.key_buffer.lower()
+                    self.awaiting_colon = True
+                return
+            if self.reading_key:
+                self.key_buffer += char
+            return
+
+        if char.isspace():
+            return
+        if char == '"':
+            self.in_string = True
+            self.awaiting_value = False
+            if top_level_object and self.expect_key:
+                self.expect_key = False
+                self.reading_key = True
+                self.key_buffer = ""
+            return
+        if char in "{[":
+            self.started = True
+            self.awaiting_value = False
+            self.stack.append(char)
+            if len(self.stack) == 1 and char == "{":
+                self.expect_key = True
+            return
+        if char in "}]":
+            if self.stack:
+                self.stack.pop()
+            if self.started and not self.stack:
+                self.closed = True
+            return
+        if char == ":":
+            self.awaiting_colon = False
+            self.awaiting_value = True
+            return
+        if char == "," and top_level_object:
+            self.expect_key = True
+            self.current_key = None
+            return
+        self.awaiting_value = False
+
+    def in_field_value(self) -> Optional[str]:
+        """Returns the top-level key whose value is currently generated, if any."""
+        if self.reading_key or self.awaiting_colon or not self.stack:
+            return None
+        return self.current_key
+
+    def closing_suffix(self) -> str:
+        """Returns the text that closes all open strings and containers."""
+        suffix = ""
+        if self.in_string:
+            suffix += '"'
+            if self.reading_key:
+                suffix += ": null"
+        elif self.awaiting_colon:
+            suffix += ": null"
+        elif self.awaiting_value:
+            suffix += "null"
+        for opener in reversed(self.stack):
+            suffix += "}" if opener == "{" else "]"
+        return suffix
+
+
+def strip_trailing_comma(text: str) -> str:
+    """Removes a dangling comma before the closing part of a truncated JSON text."""
+    stripped = text.rstrip()
+    return stripped[:-1] if stripped.endswith(",") else stripped
+
+
+def parse_json_output(llm_output: Any) -> Any:
+    """
+    Parses the JSON output of a LLM. Truncated output is repaired by closing the open strings and containers.
+
+    Args:
+        llm_output (Any): The LLM output. Dictionaries and lists are returned unchanged.
+
+    Returns:
+        Any: The parsed JSON value, or an empty dictionary if the output could not be parsed.
+    """
+    if not isinstance(llm_output, str):
+        return llm_output
+    try:
+        return json.loads(llm_output)
+    except json.JSONDecodeError:
+        pass
+
+    monitor = JsonStreamMonitor()
+    start = min(
+        (i for i in (llm_output.find("{"), llm_output.find("[")) if i >= 0),
+        default=-1,
+    )
+    if start >= 0:
+        text = llm_output[start:]
+        consumed = monitor.feed(text)
+        text = text[:consumed]
+        repaired = (
+            text
+            if monitor.closed
+            else strip_trailing_comma(text) + monitor.closing_suffix()
+        )
+        try:
+            return json.loads(repaired)
+        except json.JSONDecodeError:
+            pass
+
+    logger.error(f"Could not parse LLM output as JSON: {llm_output}")
+    return {}
+
+
+def find_repetition(
+    tokens: List[str], max_period: int, min_repeats: int, min_period: int = 2
+) -> int:
+    """
+    Detects a token sequence that is repeated at the end of the generated tokens. Sequences without letters,
+    e.g. digits and punctuation, are not checked, as numbers and codes repeat their digits legitimately.
+
+    Args:
+        tokens (List[str]): The generated tokens.
+        max_period (int): The longest repeated sequence that is checked.
+        min_repeats (int): The number of consecutive repeats that count as degenerate output.
+        min_period (int): The shortest repeated sequence that is checked. Defaults to 2.
+
+    Returns:
+        int: The number of tokens to drop to keep only the first occurrence, or 0 if no repetition was found.
+    """
+    for period in range(min_period, max_period + 1):
+        span = period * min_repeats
+        if span > len(tokens):
+            break
+        tail = tokens[-period:]
+        if not any(char.isalpha() for char in "".join(tail)):
+            continue
+        if all(
+            tokens[len(tokens) - period * (i + 1) : len(tokens) - period * i] == tail
+            for i in range(1, min_repeats)
+        ):
+            return period * (min_repeats - 1)
+    return 0
+
+
+class GenerationController(Runnable):
+    """Streams a LlamaCpp generation and ends decoding early according to a GenerationConfig.
+
+    Decoding ends when the top-level JSON value closes, when a field exceeds its token budget or when the
+    output degenerates into repetitions. Truncated JSON is closed so that it can still be parsed.
+    Generations of chains sharing a model instance are serialized by the generation lock of its client,
+    which also covers switching speculative decoding for the generation.
+    """
+
+    def __init__(self, llm: LlamaCpp, config: GenerationConfig, chain_name: str):
+        """
+        Initializes a GenerationController object.
+
+        Args:
+            llm (LlamaCpp): The LlamaCpp model used for generation.
+            config (GenerationConfig): The generation limits.
+            chain_name (str): The name of the chain, used in the reports.
+        """
+        self.llm = llm
+        self.config = config
+        self.chain_name = chain_name
+        self.last_report: Optional[GenerationReport] = None
+
+    def invoke(
+        self, input: Any, config: Optional[RunnableConfig] = None, **kwargs
+    ) -> str:
+        """
+        Generates the LLM output for the given prompt.
+
+        Args:
+            input (Any): The prompt or prompt value.
+            config (RunnableConfig, optional): The runnable config passed to the LLM.
+            **kwargs: Additional generation parameters passed to llama.cpp.
+
+        Returns:
+            str: The generated text.
+        """
+        # The model is resolved once, so the lock, the speculative decoding switch and the stream use the
+        # same instance even if the registry reloads the model meanwhile.
+        llm = self.llm.resolve() if isinstance(self.llm, LazyModel) else self.llm
+        lock = getattr(getattr(llm, "client", None), "generation_lock", None)
+        with lock or nullcontext():
+            return self.generate(llm, input, config, **kwargs)
+
+    def generate(
+        self, llm: LlamaCpp, input: Any, config: Optional[RunnableConfig], **kwargs
+    ) -> str:
+        """Streams the generation of the given model, see invoke."""
+        params = {"max_tokens": self.config.max_tokens, **kwargs}
+        max_tokens = params["max_tokens"]
+        monitor = JsonStreamMonitor()
+        tokens: List[str] = []
+        field_tokens: Dict[str, int] = {}
+        stop_reason = "eos"
+        first_token_seconds = None
+        speculative = set_speculative_decoding(llm, self.config.speculative)
+
+        start = time.perf_counter()
+        stream = llm.stream(input, config, **params)
+        try:
+            for chunk in stream:
+                if first_token_seconds is None:
+                    first_token_seconds = time.perf_counter() - start
+                consumed = monitor.feed(chunk)
+                tokens.append(chunk[:consumed])
+
+                if monitor.closed and self.config.stop_on_json_close:
+                    stop_reason = "json_closed"
+                    break
+
+                key = monitor.in_field_value()
+                if key is not None:
+                    field_tokens[key] = field_tokens.get(key, 0) + 1
+                    budget = self.config.field_max_tokens.get(key)
+                    if budget is not None and field_tokens[key] > budget:
+                        stop_reason = f"field_budget:{key}"
+                        break
+
+                drop = find_repetition(
+                    tokens,
+                    self.config.repetition_max_period,
+                    self.config.repetition_min_repeats,
+                    self.config.repetition_min_period,
+                )
+                if drop:
+                    tokens = tokens[:-drop]
+                    stop_reason = "repetition"
+                    break
+            else:
+                if len(tokens) >= max_tokens:
+                    stop_reason = "length"
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                close()
+
+        text = "".join(tokens)
+        if monitor.started and not monitor.closed:
+            if stop_reason == "repetition":
+                monitor = JsonStreamMonitor()
+                monitor.feed(text)
+            text = strip_trailing_comma(text) + monitor.closing_suffix()
+
+        self.last_report = self.create_report(
+            len(tokens),
+            max_tokens,
+            stop_reason,
+            start,
+            first_token_seconds,
+            speculative,
+        )
+        return text
+
+    def create_report(
+        self,
+        tokens_generated: int,
+        max_tokens: int,
+        stop_reason: str,
+        start: float,
+        first_token_seconds: Optional[float],
+        speculative: bool = False,
+    ) -> GenerationReport:
+        """Creates, logs and records the report of a generation."""
+        early_stop = stop_reason not in ("eos", "length")
+        report = GenerationReport(
+            chain=self.chain_name,
+            tokens_generated=tokens_generated,
+            max_tokens=max_tokens,
+            tokens_saved=max_tokens - tokens_generated if early_stop else 0,
+            stop_reason=stop_reason,
+            seconds=time.perf_counter() - start,
+            first_token_seconds=first_token_seconds,
+            speculative=speculative,
+        )
+        logger.info(
+            f"GENERATION {report.chain}: {report.tokens_generated} tokens, "
+            f"{report.tokens_saved} saved, stop reason '{report.stop_reason}'"
+        )
+        runtime_stats.increment("generation", f"{self.chain_name}.calls")
+        runtime_stats.increment(
+            "generation", f"{self.chain_name}.tokens_generated", tokens_generated
+        )
+        runtime_stats.increment(
+            "generation", f"{self.chain_name}.tokens_saved", report.tokens_saved
+        )
+        runtime_stats.record_event("generation", asdict(report))
+        return report
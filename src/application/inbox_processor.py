@@ -0,0 +1,171 @@
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+from application.communcation_handler import parse_expert_reply
+from application.escalation_store import STATUS_IN_KB
+from application.knowledge_base import KnowledgeBase
+from application.models import setup_embeddings
+from utils.logging_utils import logger
+
+
+class ExpertInboxProcessor:
+    """Loads the expert replies of an inbox directory into the knowledge base in batches.
+
+    A checkpoint file records the processed and failed reply files, so repeated runs only
+    handle replies that are new or changed since the last run.
+    """
+
+    def __init__(
+        self,
+        knowledge_base: KnowledgeBase,
+        path_inbox: str,
+        path_checkpoint: str = None,
+        max_workers: int = 8,
+    ):
+        """
+        Initializes an ExpertInboxProcessor object.
+
+        Args:
+            knowledge_base (KnowledgeBase): The knowledge base the expert answers are loaded into.
+            path_inbox (str): The directory with the expert replies as text files.
+            path_checkpoint (str, optional): The checkpoint file. Defaults to "checkpoint.json" in the inbox.
+            max_workers (int): The number of threads parsing the replies. Defaults to 8.
+        """
+        self.kb = knowledge_base
+        self.path_inbox = path_inbox
+        self.path_checkpoint = path_checkpoint or f"{path_inbox}/checkpoint.json"
+        self.max_workers = max_workers
+        self.checkpoint = self.load_checkpoint()
+
+    def load_checkpoint(self) -> dict:
+        """Loads the checkpoint or creates an empty one."""
+        if os.path.exists(self.path_checkpoint):
+            with open(self.path_checkpoint, "r") as file:
+                return json.load(file)
+        return {"processed": {}, "failed": {}}
+
+    def save_checkpoint(self) -> None:
+        """Writes the checkpoint atomically."""
+        tmp_path = f"{self.path_checkpoint}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self.checkpoint, file)
+        os.replace(tmp_path, self.path_checkpoint)
+
+    def scan_new_replies(self) -> List[Tuple[str, float]]:
+        """
+        Finds the reply files that were not processed in their current version.
+
+        Returns:
+            List[Tuple[str, float]]: The paths and modification times of the new replies.
+        """
+        known = {**self.checkpoint["processed"], **self.checkpoint["failed"]}
+        new_replies = []
+        with os.scandir(self.path_inbox) as entries:
+            for entry in entries:
+                if not entry.is_file() or not entry.name.endswith(".txt"):
+                    continue
+                mtime = entry.stat().st_mtime
+                if known.get(entry.name) == mtime:
+                    continue
+                new_replies.append((entry.path, mtime))
+        return new_replies
+
+    def parse_replies(self, replies: List[Tuple[str, float]]) -> Tuple[dict, dict]:
+        """
+        Parses the replies in parallel and keeps the newest reply per question.
+
+        Args:
+            replies (List[Tuple[str, float]]): The paths and modification times of the replies.
+
+        Returns:
+            Tuple[dict, dict]: The newest (path, mtime, answer) per question ID and the errors per file name.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [
+                (path, mtime, executor.submit(parse_expert_reply, path))
+                for path, mtime in replies
+            ]
+
+        answers: Dict[str, tuple] = {}
+        errors: Dict[str, str] = {}
+        for path, mtime, future in futures:
+            try:
+                question_id, answer = future.result()
+            except Exception as e:
+                errors[os.path.basename(path)] = str(e)
+                continue
+            if question_id not in answers or answers[question_id][1] < mtime:
+                answers[question_id] = (path, mtime, answer)
+        return answers, errors
+
+    def run(self) -> dict:
+        """
+        Processes all new replies: parse, deduplicate, embed in one batch and upsert in bulk.
+
+        Returns:
+            dict: The number of new, loaded and failed replies.
+        """
+        replies = self.scan_new_replies()
+        if not replies:
+            logger.info("NO NEW EXPERT REPLIES.")
+            return {"new": 0, "loaded": 0, "failed": 0}
+
+        answers, errors = self.parse_replies(replies)
+
+        docs = []
+        for question_id, (path, _, answer) in answers.items():
+            try:
+                docs.append(self.kb.create_expert_doc(question_id, answer, path))
+            except Exception as e:
+                errors[os.path.basename(path)] = str(e)
+
+        self.kb.add_expert_docs(docs)
+        self.kb.escalation_store.set_expert_answers(
+            [
+                (
+                    doc.metadata["question_id"],
+                    answers[doc.metadata["question_id"]][2],
+                    doc.metadata["source"],
+                )
+                for doc in docs
+            ],
+            status=STATUS_IN_KB,
+        )
+
+        for path, mtime in replies:
+            name = os.path.basename(path)
+            if name in errors:
+                self.checkpoint["failed"][name] = mtime
+                logger.error(f"EXPERT REPLY {name} FAILED: {errors[name]}")
+            else:
+                self.checkpoint["processed"][name] = mtime
+                self.checkpoint["failed"].pop(name, None)
+        self.save_checkpoint()
+
+        result = {"new": len(replies), "loaded": len(docs), "failed": len(errors)}
+        logger.info(f"EXPERT INBOX PROCESSED: {result}")
+        return result
+
+
+def main():
+    """Processes the expert inbox of a knowledge base from the command line."""
+    parser = argparse.ArgumentParser(description=ExpertInboxProcessor.__doc__)
+    parser.add_argument("--path-kb", required=True, help="Knowledge base directory.")
+    parser.add_argument("--inbox", required=True, help="Directory of expert replies.")
+    parser.add_argument("--checkpoint", default=None, help="Checkpoint file.")
+    args = parser.parse_args()
+
+    kb = KnowledgeBase(
+        path_sql_db=args.path_kb + "/sqlite_db.db",
+        path_vector_store=args.path_kb + "/chroma_db",
+        path_email_storage=args.path_kb + "/email_storage",
+        embedding_model=setup_embeddings(),
+    )
+    ExpertInboxProcessor(kb, args.inbox, args.checkpoint).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,27 @@
+import os
 import sqlite3
-from typing import Any, Dict, List
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
 
 from chromadb import PersistentClient
+from chromadb.api.client import SharedSystemClient
 from langchain_community.vectorstores import Chroma
 from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_community.utilities import SQLDatabase
 from langchain_core.documents.base import Document
+from langchain_core.retrievers import BaseRetriever
+from application.catalog import CatalogChangeLog
+from application.chat_history import ChatHistoryStore
+from application.escalation_store import EscalationStore
+from application.expert_index import ExpertAnswerIndex
+from application.lexical import BM25Index, ProductCodeMatcher
+from application.memory import memory_profiler
+from application.product_answers import ProductAnswerTable
+from application.retrievers import ScoredRetriever
+from application.sharding import ShardedIndex, ShardRouter
+from utils.logging_utils import logger
+from utils.runtime_stats import runtime_stats
 import json
 from datetime import datetime
 
@@ -19,6 +35,8 @@ class KnowledgeBase:
         path_vector_store: str,
         path_email_storage: str,
         embedding_model: HuggingFaceEmbeddings,
+        use_shards: bool = False,
+        use_lexical: bool = True,
     ):
         """
         Initializes a KnowledgeBase object.
@@ -28,13 +46,34 @@ class KnowledgeBase:
             path_vector_store (str): The path to the vector store file.
             path_email_storage (str): The path to the email storage directory.
             embedding_model (HuggingFaceEmbeddings): The embedding model used for vectorization.
+            use_shards (bool): Whether the search is routed to shards per source type and product category.
+                Defaults to False.
+            use_lexical (bool): Whether the dense search is fused with a BM25 index, which answers queries with
+                strong lexical matches without embedding them. Defaults to True.
         """
         self.path_sql_db = path_sql_db
         self.path_vector_store = path_vector_store
         self.path_email_storage = path_email_storage
         self.embedding_model = embedding_model
+        self.query_embedding_cache = OrderedDict()
+        self.query_embedding_cache_size = 256
+        # Whether the cached embeddings are of the quantized model, see ManagedEmbeddings.
+        self.query_embedding_cache_quantized = False
+        self._cache_lock = threading.Lock()
+        self.escalation_store = self.setup_escalation_store()
+        self.chat_history_store = self.setup_chat_history_store()
         self.sql_db = self.setup_sql_database()
         self.vector_store = self.setup_vector_store()
+        self.expert_index = self.setup_expert_index()
+        self.shard_index = self.setup_shard_index() if use_shards else None
+        # BM25 hits with at least this confidence and a clear lead are returned without the dense search.
+        self.lexical_confidence = 0.85
+        self.lexical_margin = 1.2
+        self.lexical_index = self.setup_lexical_index() if use_lexical else None
+        self.product_matcher = self.setup_product_matcher()
+        self.product_answers = self.setup_product_answers()
+        self.catalog_changes = CatalogChangeLog(self.path_sql_db)
+        self.catalog_version = self.catalog_changes.latest_version()
         self.retriever = self.create_retriever()
 
     def display_vector_store_info(self) -> None:
@@ -64,6 +103,25 @@ class KnowledgeBase:
         """
         return SQLDatabase.from_uri("sqlite:///" + self.path_sql_db)
 
+    def setup_escalation_store(self) -> EscalationStore:
+        """
+        Sets up the store of the questions forwarded to experts in the email storage directory.
+
+        Returns:
+            EscalationStore: The escalation store object.
+        """
+        os.makedirs(self.path_email_storage, exist_ok=True)
+        return EscalationStore(f"{self.path_email_storage}/escalations.db")
+
+    def setup_chat_history_store(self) -> ChatHistoryStore:
+        """
+        Sets up the store of the chat sessions next to the escalation store.
+
+        Returns:
+            ChatHistoryStore: The chat history store object.
+        """
+        return ChatHistoryStore(f"{self.path_email_storage}/chat_history.db")
+
     def setup_vector_store(self) -> Chroma:
         """
         Sets up the vector store.
@@ -77,6 +135,214 @@ class KnowledgeBase:
             collection_name="technical_documents",
         )
 
+    def setup_expert_index(self) -> ExpertAnswerIndex:
+        """
+        Sets up the index of verified expert answers in the vector store client.
+        An empty index is built from the expert answers already stored in the vector store.
+
+        Returns:
+            ExpertAnswerIndex: The expert answer index.
+        """
+        expert_index = ExpertAnswerIndex(
+            client=self.vector_store._client,
+            embed_queries=self.embed_queries,
+            score_threshold=self.load_retriever_settings().get(
+                "expert_score_threshold"
+            ),
+            lexical_check=self.has_strong_lexical_match,
+        )
+        if expert_index.collection.count() == 0:
+            expert_docs = self.get_docs(keywords="expert_answer")
+            if expert_docs["ids"]:
+                expert_index.rebuild(expert_docs)
+        return expert_index
+
+    def setup_shard_index(self) -> ShardedIndex:
+        """
+        Sets up the sharded index in the vector store client. The shards are built from the
+        technical documents collection if none exist yet.
+
+        Returns:
+            ShardedIndex: The sharded index.
+        """
+        collection = self.vector_store._collection
+        shard_index = ShardedIndex(
+            client=self.vector_store._client,
+            embed_queries=self.embed_queries,
+            relevance_score_fn=self.vector_store._select_relevance_score_fn(),
+            router=ShardRouter.from_sql_database(self.path_sql_db),
+            collection_metadata=collection.metadata,
+        )
+        if not shard_index.shards and collection.count() > 0:
+            shard_index.build(collection)
+        return shard_index
+
+    def setup_lexical_index(self) -> BM25Index:
+        """
+        Sets up the BM25 index of the technical documents collection next to the Chroma files.
+        The index is rebuilt if it is missing or does not match the collection.
+
+        Returns:
+            BM25Index: The BM25 index.
+        """
+        collection = self.vector_store._collection
+        lexical_index = BM25Index(
+            f"{self.path_vector_store}/bm25_{collection.name}.json"
+        )
+        if not lexical_index.load() or len(lexical_index) != collection.count():
+            lexical_index.build(collection)
+        return lexical_index
+
+    def setup_product_matcher(self) -> ProductCodeMatcher:
+        """
+        Sets up the matcher of the product codes in the lamps table and their EAN/EOC aliases.
+
+        Returns:
+            ProductCodeMatcher: The product code matcher, without codes if there is no lamps table and
+                without aliases if the catalog was not synchronized with them, see catalog.py.
+        """
+        conn = sqlite3.connect(self.path_sql_db)
+        try:
+            rows = conn.execute(
+                "SELECT Bestell_Nr FROM lamps WHERE Bestell_Nr IS NOT NULL;"
+            ).fetchall()
+        except sqlite3.OperationalError:
+            rows = []
+        try:
+            aliases = dict(
+                conn.execute("SELECT code, Bestell_Nr FROM product_code_aliases;")
+            )
+        except sqlite3.OperationalError:
+            aliases = {}
+        finally:
+            conn.close()
+        return ProductCodeMatcher((row[0] for row in rows), aliases)
+
+    def setup_product_answers(self) -> ProductAnswerTable:
+        """
+        Sets up the precomputed answers of the common product questions in the product database.
+        The table is only opened, it is built with product_answers.py and updated by the catalog syncs.
+
+        Returns:
+            ProductAnswerTable: The product answer table.
+        """
+        product_answers = ProductAnswerTable(self.path_sql_db)
+        if product_answers.is_stale():
+            logger.warning(
+                "PRODUCT ANSWER TABLE IS STALE, REBUILD IT WITH application/product_answers.py"
+            )
+        return product_answers
+
+    def refresh_catalog(self) -> Dict[int, str]:
+        """
+        Picks up the changes of the catalog syncs since the last refresh, also of syncs in other processes.
+        The product code matcher is rebuilt. The answers of the changed products are recreated if the sync
+        did not update them, the answers of the other products are kept.
+
+        Returns:
+            Dict[int, str]: The change ("insert", "update" or "delete") per changed product code.
+        """
+        version, changes = self.catalog_changes.changes_since(self.catalog_version)
+        if not changes:
+            return {}
+        self.catalog_version = version
+        self.product_matcher = self.setup_product_matcher()
+        if self.product_answers.is_stale():
+            self.product_answers.update_products(changes)
+        runtime_stats.increment("catalog", "refreshes")
+        logger.info(
+            f"CATALOG REFRESHED TO VERSION {version}: {len(changes)} PRODUCTS CHANGED"
+        )
+        return changes
+
+    def embed_queries(self, queries: List[str]) -> List[List[float]]:
+        """
+        Embeds the queries with one call of the embedding model. Recently embedded queries are taken from a cache,
+        so the expert index and the retriever embed a question only once. When the embedding model is
+        quantized or loaded again without quantization, the cache is cleared, so the embeddings of both
+        model variants are not mixed.
+
+        Args:
+            queries (List[str]): The queries.
+
+        Returns:
+            List[List[float]]: The embeddings of the queries.
+        """
+        quantized = getattr(self.embedding_model, "quantized", False)
+        with self._cache_lock:
+            if quantized != self.query_embedding_cache_quantized:
+                self.query_embedding_cache.clear()
+                self.query_embedding_cache_quantized = quantized
+            embeddings = {
+                q: self.query_embedding_cache[q]
+                for q in queries
+                if q in self.query_embedding_cache
+            }
+        missing = [q for q in dict.fromkeys(queries) if q not in embeddings]
+        if missing:
+            embeddings.update(
+                zip(missing, self.embedding_model.embed_documents(missing))
+            )
+
+        with self._cache_lock:
+            if quantized != self.query_embedding_cache_quantized:
+                return [embeddings[query] for query in queries]
+            for query in queries:
+                self.query_embedding_cache[query] = embeddings[query]
+                self.query_embedding_cache.move_to_end(query)
+            while len(self.query_embedding_cache) > self.query_embedding_cache_size:
+                self.query_embedding_cache.popitem(last=False)
+        return [embeddings[query] for query in queries]
+
+    def memory_usage(self) -> dict:
+        """
+        Estimates the memory held by the knowledge base. The HNSW indexes of Chroma are loaded
+        into memory completely, so their size on disk is used.
+
+        Returns:
+            dict: The estimated bytes of the vector indexes, the SQLite databases and the query embedding cache.
+        """
+        index_bytes = 0
+        for root, _, files in os.walk(self.path_vector_store):
+            index_bytes += sum(
+                os.path.getsize(os.path.join(root, name))
+                for name in files
+                if name.endswith(".bin")
+            )
+        sqlite_bytes = sum(
+            os.path.getsize(path)
+            for path in (
+                self.path_sql_db,
+                self.escalation_store.path_db,
+                self.chat_history_store.path_db,
+            )
+            if os.path.exists(path)
+        )
+        with self._cache_lock:
+            cache_bytes = sum(
+                len(embedding) * 8 for embedding in self.query_embedding_cache.values()
+            )
+        return {
+            "index_bytes": index_bytes,
+            "sqlite_bytes": sqlite_bytes,
+            "cache_bytes": cache_bytes,
+            "total_bytes": index_bytes + sqlite_bytes + cache_bytes,
+        }
+
+    def close(self) -> None:
+        """Closes the SQLite connections and stops the Chroma client, so the memory of the indexes is released."""
+        self.escalation_store.close()
+        self.chat_history_store.close()
+        self.product_answers.close()
+        self.sql_db._engine.dispose()
+        client = self.vector_store._client
+        client._system.stop()
+        # Chroma shares one system per persist directory, it has to be removed so a new client reloads the indexes.
+        SharedSystemClient._identifer_to_system.pop(client._identifier, None)
+        with self._cache_lock:
+            self.query_embedding_cache.clear()
+
+    @memory_profiler.profile("KnowledgeBase.execute_sql_query")
     def execute_sql_query(self, product_code: int) -> List[Dict[str, Any]]:
         """
         Executes an SQL query and returns the results.
@@ -99,12 +365,182 @@ class KnowledgeBase:
         # Return a list of dictionaries, each representing a row
         return [dict(zip(column_names, row)) for row in rows][0]
 
-    def create_retriever(self) -> None:
-        """Creates a retriever for the vector store."""
+    @property
+    def path_retriever_settings(self) -> str:
+        return f"{self.path_vector_store}/retriever_settings.json"
+
+    def load_retriever_settings(self) -> Dict[str, Any]:
+        """
+        Loads the search settings tuned for this knowledge base, empty if it was not tuned: the settings of
+        the ScoredRetriever and the expert_score_threshold of the expert answer index.
+        """
+        if not os.path.exists(self.path_retriever_settings):
+            return {}
+        with open(self.path_retriever_settings, "r") as file:
+            return json.load(file)
+
+    def save_retriever_settings(self, **settings) -> None:
+        """Saves search settings, e.g. the score_threshold of the ThresholdTuner, for the next retrievers."""
+        settings = {**self.load_retriever_settings(), **settings}
+        with open(self.path_retriever_settings, "w") as file:
+            json.dump(settings, file, indent=2)
+        logger.info(f"RETRIEVER SETTINGS SAVED: {settings}")
+
+    def create_retriever(self, with_scores: bool = True, **kwargs) -> BaseRetriever:
+        """
+        Creates a retriever for the vector store.
+
+        Args:
+            with_scores (bool): Whether a ScoredRetriever with relevance threshold and adaptive k is created.
+                Otherwise a plain similarity retriever with k=3 is created. Defaults to True.
+            **kwargs: Settings of the ScoredRetriever, e.g. score_threshold. They override the tuned settings
+                of the knowledge base, see save_retriever_settings.
+
+        Returns:
+            BaseRetriever: The retriever.
+        """
+        if with_scores:
+            settings = {
+                key: value
+                for key, value in self.load_retriever_settings().items()
+                if key in ScoredRetriever.__fields__
+            }
+            return ScoredRetriever(knowledge_base=self, **{**settings, **kwargs})
         return self.vector_store.as_retriever(
             search_type="similarity", search_kwargs={"k": 3}
         )
 
+    @memory_profiler.profile("KnowledgeBase.search_with_scores")
+    def search_with_scores(
+        self, queries: List[str], k: int = 3
+    ) -> List[List[Tuple[Document, float]]]:
+        """
+        Searches the knowledge base for several queries. Without a BM25 index, this is the dense search.
+        Queries with a strong lexical match (see is_strong_lexical_match) are answered from the BM25 index
+        without being embedded. For the other queries, the dense and the BM25 results
+        are fused: every candidate gets the higher of its dense relevance score and its BM25 confidence.
+
+        Args:
+            queries (List[str]): The queries.
+            k (int): The number of results per query. Defaults to 3.
+
+        Returns:
+            List[List[Tuple[Document, float]]]: Per query the documents and their relevance scores, sorted by descending score.
+        """
+        if self.lexical_index is None:
+            return self.dense_search_with_scores(queries, k=k)
+
+        lexical_hits = [self.lexical_index.search(query, k=k) for query in queries]
+        dense_queries = [
+            query
+            for query, hits in zip(queries, lexical_hits)
+            if not self.is_strong_lexical_match(hits)
+        ]
+        dense_results = dict(
+            zip(dense_queries, self.dense_search_with_scores(dense_queries, k=k))
+        )
+        runtime_stats.increment(
+            "retrieval", "lexical_shortcuts", len(queries) - len(dense_queries)
+        )
+
+        hit_ids = {chunk_id for hits in lexical_hits for chunk_id, _, _ in hits}
+        lexical_docs = self.get_chunks(list(hit_ids))
+        scored_docs = []
+        for query, hits in zip(queries, lexical_hits):
+            candidates = {
+                doc.metadata["chunk_id"]: (doc, score)
+                for doc, score in dense_results.get(query, [])
+            }
+            for chunk_id, _, confidence in hits:
+                if chunk_id not in lexical_docs:
+                    continue
+                doc, score = candidates.get(chunk_id, (lexical_docs[chunk_id], 0.0))
+                if confidence > score:
+                    doc = Document(
+                        page_content=doc.page_content,
+                        metadata={**doc.metadata, "relevance_score": confidence},
+                    )
+                    score = confidence
+                candidates[chunk_id] = (doc, score)
+            fused = sorted(candidates.values(), key=lambda item: item[1], reverse=True)
+            scored_docs.append(fused[:k])
+        return scored_docs
+
+    def has_strong_lexical_match(self, query: str) -> bool:
+        """Checks if the query is answered from the BM25 index without the dense search, see search_with_scores."""
+        if self.lexical_index is None:
+            return False
+        return self.is_strong_lexical_match(self.lexical_index.search(query, k=2))
+
+    def is_strong_lexical_match(self, hits: List[Tuple[str, float, float]]) -> bool:
+        """Checks if the top BM25 hit has a high confidence and a clear lead over the second hit."""
+        if not hits or hits[0][2] < self.lexical_confidence:
+            return False
+        return len(hits) == 1 or hits[0][1] >= self.lexical_margin * hits[1][1]
+
+    def get_chunks(self, ids: List[str]) -> Dict[str, Document]:
+        """Returns the chunks with the given IDs from the vector store, with the chunk ID in the metadata."""
+        if not ids:
+            return {}
+        data = self.vector_store._collection.get(
+            ids=ids, include=["documents", "metadatas"]
+        )
+        return {
+            chunk_id: Document(
+                page_content=text, metadata={**(metadata or {}), "chunk_id": chunk_id}
+            )
+            for chunk_id, text, metadata in zip(
+                data["ids"], data["documents"], data["metadatas"]
+            )
+        }
+
+    def dense_search_with_scores(
+        self, queries: List[str], k: int = 3
+    ) -> List[List[Tuple[Document, float]]]:
+        """
+        Searches the vector store for several queries with one embedding call and one vector search.
+        With shards, each query is routed to the relevant shards instead.
+
+        Args:
+            queries (List[str]): The queries.
+            k (int): The number of results per query. Defaults to 3.
+
+        Returns:
+            List[List[Tuple[Document, float]]]: Per query the documents and their relevance scores, sorted by descending score.
+        """
+        if not queries:
+            return []
+        if self.shard_index is not None:
+            return self.shard_index.search_with_scores(queries, k=k)
+        query_embeddings = self.embed_queries(queries)
+        results = self.vector_store._collection.query(
+            query_embeddings=query_embeddings,
+            n_results=k,
+            include=["documents", "metadatas", "distances"],
+        )
+        relevance_score_fn = self.vector_store._select_relevance_score_fn()
+
+        scored_docs = []
+        for ids, texts, metadatas, distances in zip(
+            results["ids"],
+            results["documents"],
+            results["metadatas"],
+            results["distances"],
+        ):
+            docs = []
+            for chunk_id, text, metadata, distance in zip(
+                ids, texts, metadatas, distances
+            ):
+                score = relevance_score_fn(distance)
+                metadata = {
+                    **(metadata or {}),
+                    "chunk_id": chunk_id,
+                    "relevance_score": score,
+                }
+                docs.append((Document(page_content=text, metadata=metadata), score))
+            scored_docs.append(docs)
+        return scored_docs
+
     def load_doc_to_vector_store(self, doc: Document) -> None:
         """
         Loads a document into the vector store.
@@ -112,7 +548,47 @@ class KnowledgeBase:
         Args:
             doc (Document): The document to load.
         """
-        self.vector_store.add_documents([doc])
+        self.load_docs_to_vector_store([doc])
+
+    def load_docs_to_vector_store(
+        self, docs: List[Document], batch_size: int = 256
+    ) -> None:
+        """
+        Loads documents, e.g. the chunks of chunking.py, into the vector store in batches.
+        The lexical index is saved once at the end.
+
+        Args:
+            docs (List[Document]): The documents to load.
+            batch_size (int): The documents per embedding call. Defaults to 256.
+        """
+        for start in range(0, len(docs), batch_size):
+            batch = docs[start : start + batch_size]
+            ids = self.vector_store.add_documents(batch)
+            if self.shard_index is not None:
+                self.shard_index.add_from_collection(self.vector_store._collection, ids)
+            if self.lexical_index is not None:
+                self.lexical_index.add(ids, [doc.page_content for doc in batch])
+        if self.lexical_index is not None and docs:
+            self.lexical_index.save()
+
+    def add_expert_docs(self, docs: List[Document]) -> None:
+        """
+        Upserts expert answer documents into the vector store with one embedding call.
+        The document IDs are derived from the question IDs, so an answer replaces earlier answers to the same question.
+
+        Args:
+            docs (List[Document]): The expert answer documents created with create_expert_doc.
+        """
+        if not docs:
+            return
+        ids = [f"expert_{doc.metadata['question_id']}" for doc in docs]
+        self.vector_store.add_documents(docs, ids=ids)
+        self.expert_index.add_docs(docs)
+        if self.shard_index is not None:
+            self.shard_index.add_from_collection(self.vector_store._collection, ids)
+        if self.lexical_index is not None:
+            self.lexical_index.add(ids, [doc.page_content for doc in docs])
+            self.lexical_index.save()
 
     def get_docs(self, keywords: str = None) -> List[Document]:
         """
@@ -143,11 +619,15 @@ class KnowledgeBase:
         Returns:
             Document: The created document.
         """
-        path = f"{self.path_email_storage}/output_{question_id}.json"
-        with open(path, "r") as file:
-            json_file = json.load(file)
+        escalation = self.escalation_store.get(question_id)
+        if escalation is not None:
+            question = escalation["question"]
+        else:
+            # Questions escalated before the escalation store existed.
+            path = f"{self.path_email_storage}/{question_id}/output_{question_id}.json"
+            with open(path, "r") as file:
+                question = json.load(file)["question"]
 
-        question = json_file["question"]
         page_content = f"Frage: {question}. Antwort: {expert_answer}"
         doc = Document(
             page_content=page_content,
@@ -157,6 +637,8 @@ class KnowledgeBase:
                 "author": "Expert",
                 "creationDate": datetime.now().isoformat(),
                 "keywords": "expert_answer",
+                "question": question,
+                "expert_answer": expert_answer,
             },
         )
         return doc
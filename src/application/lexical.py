@@ -0,0 +1,197 @@
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from chromadb.api.models.Collection import Collection
+
+from application.column_selection import normalize_tokens
+from utils.logging_utils import logger
+
+
+class BM25Index:
+    """Inverted BM25 index over the chunk texts of a Chroma collection, persisted as JSON next to it.
+
+    Besides the raw BM25 scores, the index reports a confidence per hit: the score divided by the score
+    of a chunk of average length that contains every query term once. Query terms unknown to the index
+    count with the highest IDF, so a query only gets a high confidence if its terms, e.g. sockets,
+    wattages or article numbers, occur in the chunk.
+    """
+
+    def __init__(self, path: str, k1: float = 1.5, b: float = 0.75):
+        """
+        Initializes a BM25Index object.
+
+        Args:
+            path (str): The path of the JSON file of the index.
+            k1 (float): The term frequency saturation. Defaults to 1.5.
+            b (float): The length normalization. Defaults to 0.75.
+        """
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[str, int]] = defaultdict(dict)
+        self.doc_lengths: Dict[str, int] = {}
+        self.total_length = 0
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    def tokenize(self, text: str) -> List[str]:
+        return normalize_tokens(text)
+
+    def load(self) -> bool:
+        """Loads the index from its file. Returns False if there is no file."""
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, "r") as file:
+            data = json.load(file)
+        with self._lock:
+            self.postings = defaultdict(dict, data["postings"])
+            self.doc_lengths = data["doc_lengths"]
+            self.total_length = sum(self.doc_lengths.values())
+        return True
+
+    def save(self) -> None:
+        """Writes the index to its file, replacing the previous file atomically."""
+        with self._lock:
+            data = {"postings": self.postings, "doc_lengths": self.doc_lengths}
+            with open(f"{self.path}.tmp", "w") as file:
+                json.dump(data, file)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def add(self, ids: List[str], texts: List[str]) -> None:
+        """Adds or replaces the chunks with the given IDs."""
+        with self._lock:
+            self.delete([chunk_id for chunk_id in ids if chunk_id in self.doc_lengths])
+            for chunk_id, text in zip(ids, texts):
+                tokens = self.tokenize(text or "")
+                for term, count in Counter(tokens).items():
+                    self.postings[term][chunk_id] = count
+                self.doc_lengths[chunk_id] = len(tokens)
+                self.total_length += len(tokens)
+
+    def delete(self, ids: Iterable[str]) -> None:
+        """Removes the chunks with the given IDs."""
+        ids = set(ids)
+        if not ids:
+            return
+        with self._lock:
+            for term in list(self.postings):
+                postings = self.postings[term]
+                for chunk_id in ids & postings.keys():
+                    del postings[chunk_id]
+                if not postings:
+                    del self.postings[term]
+            for chunk_id in ids:
+                self.total_length -= self.doc_lengths.pop(chunk_id, 0)
+
+    def build(self, collection: Collection, batch_size: int = 1000) -> None:
+        """Builds the index from all chunks of the collection and saves it."""
+        with self._lock:
+            self.postings = defaultdict(dict)
+            self.doc_lengths = {}
+            self.total_length = 0
+            for offset in range(0, collection.count(), batch_size):
+                data = collection.get(
+                    include=["documents"], limit=batch_size, offset=offset
+                )
+                self.add(data["ids"], data["documents"])
+        self.save()
+        logger.info(f"BM25 INDEX BUILT WITH {len(self)} CHUNKS")
+
+    def idf(self, term: str) -> float:
+        n_docs = len(self.doc_lengths)
+        df = len(self.postings.get(term, ()))
+        return math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+
+    def search(self, query: str, k: int = 5) -> List[Tuple[str, float, float]]:
+        """
+        Searches the chunks for a query.
+
+        Args:
+            query (str): The query.
+            k (int): The number of results. Defaults to 5.
+
+        Returns:
+            List[Tuple[str, float, float]]: The chunk ID, BM25 score and confidence per hit, sorted by descending score.
+        """
+        terms = set(self.tokenize(query))
+        with self._lock:
+            if not terms or not self.doc_lengths:
+                return []
+            avg_length = self.total_length / len(self.doc_lengths)
+            scores = defaultdict(float)
+            normalizer = 0.0
+            for term in terms:
+                idf = self.idf(term)
+                normalizer += idf
+                for chunk_id, count in self.postings.get(term, {}).items():
+                    length_norm = (
+                        1 - self.b + self.b * self.doc_lengths[chunk_id] / avg_length
+                    )
+                    scores[chunk_id] += (
+                        idf * count * (self.k1 + 1) / (count + self.k1 * length_norm)
+                    )
+        top = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [
+            (chunk_id, score, min(score / normalizer, 1.0) if normalizer else 0.0)
+            for chunk_id, score in top
+        ]
+
+
+class ProductCodeMatcher:
+    """Finds known product codes (Bestell_Nr) in free text without any model.
+
+    Digit runs of 6 to 15 digits are checked against the codes of the lamps table and against the EAN and
+    EOC aliases of the codes, which are resolved to their Bestell_Nr. EOC codes without an alias are checked
+    by the order number they end with (the last 8 digits).
+    """
+
+    pattern = re.compile(r"(?<!\d)\d(?:[ .-]?\d){5,14}(?!\d)")
+
+    def __init__(
+        self, product_codes: Iterable[int], aliases: Optional[Dict[str, int]] = None
+    ):
+        """
+        Initializes a ProductCodeMatcher object.
+
+        Args:
+            product_codes (Iterable[int]): The known product codes.
+            aliases (Dict[str, int], optional): The Bestell_Nr per EAN or EOC. Defaults to None.
+        """
+        self.product_codes: Set[str] = {str(int(code)) for code in product_codes}
+        self.aliases: Dict[str, str] = {
+            str(int(code)): str(int(bestell_nr))
+            for code, bestell_nr in (aliases or {}).items()
+        }
+
+    def candidates(self, digits: str) -> List[str]:
+        digits = str(int(digits))
+        candidates = [digits]
+        if digits in self.aliases:
+            candidates.append(self.aliases[digits])
+        if len(digits) == 15:
+            candidates.append(str(int(digits[-8:])))
+        return candidates
+
+    def match(self, text: str) -> Optional[int]:
+        """
+        Returns the first known product code in the text.
+
+        Args:
+            text (str): The user input.
+
+        Returns:
+            int or None: The product code, or None if the text contains no known code.
+        """
+        for match in self.pattern.finditer(text):
+            digits = re.sub(r"\D", "", match.group())
+            for candidate in self.candidates(digits):
+                if candidate in self.product_codes:
+                    return int(candidate)
+        return None
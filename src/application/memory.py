@@ -0,0 +1,327 @@
+import functools
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterable, Iterator, Optional
+
+from utils.logging_utils import logger
+from utils.runtime_stats import runtime_stats
+
+
+def read_memory(pid: int) -> dict:
+    """
+    Reads the resident (RSS) and proportional (PSS) memory of a process from /proc.
+    Pages of the memory-mapped GGUF file count fully to the RSS of every worker, but are split between
+    the workers in the PSS, so the PSS shows the memory the workers really add.
+
+    Args:
+        pid (int): The process ID.
+
+    Returns:
+        dict: RSS and PSS in bytes. Empty if /proc is not available.
+    """
+    memory = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r") as file:
+            for line in file:
+                name, value = line.split(":", 1)
+                if name in ("Rss", "Pss"):
+                    memory[f"{name.lower()}_bytes"] = int(value.split()[0]) * 1024
+    except (FileNotFoundError, PermissionError, ValueError):
+        pass
+    return memory
+
+
+def read_mapped_memory(pid: int, paths: Iterable[str]) -> Dict[str, int]:
+    """
+    Reads the resident memory of memory-mapped files of a process from /proc, e.g. of the GGUF weights.
+
+    Args:
+        pid (int): The process ID.
+        paths (Iterable[str]): The paths of the files.
+
+    Returns:
+        Dict[str, int]: The resident bytes per mapped file. Empty if /proc is not available.
+    """
+    paths = {os.path.realpath(path) for path in paths}
+    mapped = {}
+    current = None
+    try:
+        with open(f"/proc/{pid}/smaps", "r") as file:
+            for line in file:
+                fields = line.split()
+                # Mapping headers start with an address range, e.g. "7f0c2a000000-7f0c3a000000 r--s ...".
+                if "-" in fields[0] and not fields[0].endswith(":"):
+                    current = fields[-1] if fields[-1] in paths else None
+                elif current is not None and fields[0] == "Rss:":
+                    mapped[current] = mapped.get(current, 0) + int(fields[1]) * 1024
+    except (FileNotFoundError, PermissionError, ValueError, IndexError):
+        pass
+    return mapped
+
+
+def estimate_kv_cache_bytes(llm) -> Optional[int]:
+    """
+    Estimates the KV cache of a LlamaCpp model from its context size and the model metadata:
+    keys and values of every layer for n_ctx tokens, in f16 if f16_kv is set and in f32 otherwise.
+
+    Args:
+        llm (LlamaCpp): The loaded model.
+
+    Returns:
+        int or None: The KV cache in bytes, or None if the metadata lacks the layer sizes.
+    """
+    metadata = getattr(llm.client, "metadata", None) or {}
+    architecture = metadata.get("general.architecture", "llama")
+    try:
+        n_layer = int(metadata[f"{architecture}.block_count"])
+        n_embd = int(metadata[f"{architecture}.embedding_length"])
+        n_head = int(metadata[f"{architecture}.attention.head_count"])
+        n_head_kv = int(metadata.get(f"{architecture}.attention.head_count_kv", n_head))
+    except (KeyError, ValueError):
+        return None
+    bytes_per_value = 2 if llm.f16_kv else 4
+    return 2 * n_layer * llm.n_ctx * (n_embd * n_head_kv // n_head) * bytes_per_value
+
+
+def tensor_bytes(module) -> int:
+    """Returns the bytes of the parameters and buffers of a torch module, including quantized weights."""
+    total = 0
+    for value in module.state_dict().values():
+        values = value if isinstance(value, tuple) else (value,)
+        for tensor in values:
+            if hasattr(tensor, "element_size"):
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+
+class MemoryProfiler:
+    """Samples the Python allocations of the request stages with tracemalloc and warns about leak-like growth.
+
+    Profiling is disabled by default, as tracemalloc slows down every allocation. Per stage, the profiler
+    records the bytes still allocated after the stage (retained) and, for stages that are not nested in
+    another stage, the peak during the stage. Stages of concurrent requests overlap, so the numbers are only
+    exact for one request at a time. After every request, the traced memory is sampled; if it grew in most
+    of the last leak_window requests by more than leak_threshold_mb, a warning names the stages retaining
+    the most memory.
+    """
+
+    def __init__(self, leak_window: int = 20, leak_threshold_mb: float = 8.0):
+        """
+        Initializes a MemoryProfiler object.
+
+        Args:
+            leak_window (int): The number of requests the growth is measured over. Defaults to 20.
+            leak_threshold_mb (float): The growth over the window that is reported. Defaults to 8.0.
+        """
+        self.leak_window = leak_window
+        self.leak_threshold_bytes = leak_threshold_mb * 1024**2
+        self.enabled = False
+        self.stages: Dict[str, dict] = {}
+        self.request_memory: Deque[int] = deque(maxlen=leak_window)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def enable(self, frames: int = 1) -> None:
+        """Starts tracemalloc and the sampling of the stages."""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self.enabled = True
+        logger.info("MEMORY PROFILING ENABLED")
+
+    def disable(self) -> None:
+        """Stops the sampling and tracemalloc."""
+        self.enabled = False
+        tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Samples the allocations of the enclosed code as the given stage, e.g. "DocumentChain.retrieve"."""
+        if not self.enabled:
+            yield
+            return
+        depth = getattr(self._local, "depth", 0)
+        if depth == 0:
+            tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            if tracemalloc.is_tracing():
+                current, peak = tracemalloc.get_traced_memory()
+                self.record(
+                    name, current - before, peak - before if depth == 0 else None
+                )
+
+    def profile(self, name: str):
+        """Decorator that samples every call of a function as the given stage."""
+
+        def decorator(func: callable) -> callable:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def record(self, name: str, retained: int, peak: Optional[int]) -> None:
+        with self._lock:
+            stats = self.stages.setdefault(
+                name, {"calls": 0, "retained_bytes": 0, "max_peak_bytes": 0}
+            )
+            stats["calls"] += 1
+            stats["retained_bytes"] += retained
+            if peak is not None:
+                stats["max_peak_bytes"] = max(stats["max_peak_bytes"], peak)
+            runtime_stats.set_gauge(
+                "memory", "stages", {k: dict(v) for k, v in self.stages.items()}
+            )
+
+    def end_request(self) -> None:
+        """Samples the traced memory after a request and warns if it keeps growing across requests."""
+        if not self.enabled:
+            return
+        current, _ = tracemalloc.get_traced_memory()
+        runtime_stats.set_gauge("memory", "traced_bytes", current)
+        with self._lock:
+            self.request_memory.append(current)
+            if len(self.request_memory) < self.leak_window:
+                return
+            samples = list(self.request_memory)
+            growth = samples[-1] - samples[0]
+            increases = sum(1 for a, b in zip(samples, samples[1:]) if b > a)
+            if growth <= self.leak_threshold_bytes or increases < 0.8 * (
+                len(samples) - 1
+            ):
+                return
+            # Warned once per window.
+            self.request_memory.clear()
+            suspects = sorted(
+                self.stages.items(),
+                key=lambda item: item[1]["retained_bytes"],
+                reverse=True,
+            )[:3]
+        suspects = {name: stats["retained_bytes"] for name, stats in suspects}
+        logger.warning(
+            f"POSSIBLE MEMORY LEAK: TRACED MEMORY GREW BY {growth / 1024**2:.1f} MB OVER "
+            f"{len(samples)} REQUESTS, RETAINED BYTES BY STAGE: {suspects}"
+        )
+        runtime_stats.increment("memory", "leak_warnings")
+        runtime_stats.record_event(
+            "memory",
+            {"time": time.time(), "growth_bytes": growth, "suspects": suspects},
+        )
+
+
+class MemoryAccountant:
+    """Breaks the resident memory of the process down by component.
+
+    The LLM weights are memory-mapped, so their resident pages are read from /proc per GGUF file. The KV
+    caches are estimated from n_ctx and f16_kv, the embedding model from its tensors and the Chroma indexes
+    from the size of their HNSW files, which are loaded completely. The Python heap of the requests is only
+    known while the memory profiler traces it. The rest of the RSS is reported as "other".
+    """
+
+    def __init__(self, models=None, embeddings=None, knowledge_bases=None):
+        """
+        Initializes a MemoryAccountant object.
+
+        Args:
+            models (ModelRegistry, optional): The registry of the LLMs.
+            embeddings (ManagedEmbeddings or HuggingFaceEmbeddings, optional): The embedding model.
+            knowledge_bases (Callable[[], List[KnowledgeBase]], optional): Returns the open knowledge bases,
+                e.g. of the TenantManager.
+        """
+        self.models = models
+        self.embeddings = embeddings
+        self.knowledge_bases = knowledge_bases or (lambda: [])
+
+    def llm_memory(self) -> Dict[str, dict]:
+        """Returns the resident weights and the KV cache per loaded LLM, models sharing an instance once."""
+        if self.models is None:
+            return {}
+        instances = {}
+        for name, llm in list(self.models.models.items()):
+            instances.setdefault(id(llm), (name, llm))
+        mapped = read_mapped_memory(
+            os.getpid(), [llm.model_path for _, llm in instances.values()]
+        )
+        return {
+            name: {
+                "weights_resident_bytes": mapped.get(
+                    os.path.realpath(llm.model_path), 0
+                ),
+                "weights_file_bytes": os.path.getsize(llm.model_path),
+                "kv_cache_bytes": estimate_kv_cache_bytes(llm) or 0,
+                "n_ctx": llm.n_ctx,
+                "f16_kv": llm.f16_kv,
+            }
+            for name, llm in instances.values()
+        }
+
+    def embedding_bytes(self) -> int:
+        """Returns the bytes of the tensors of the loaded embedding model, 0 if it is not loaded."""
+        # ManagedEmbeddings holds the model, a plain HuggingFaceEmbeddings is the model.
+        model = getattr(self.embeddings, "model", self.embeddings)
+        client = getattr(model, "client", None)
+        return tensor_bytes(client) if client is not None else 0
+
+    def report(self, label: str = None) -> dict:
+        """
+        Reports the memory by component, logs it and publishes it as gauges of the "memory" runtime stats.
+
+        Args:
+            label (str, optional): Names the report in the log and the gauges, e.g. "baseline" for a report
+                before the models are loaded.
+
+        Returns:
+            dict: The RSS and PSS of the process, the memory of the LLMs, the embedding model, the knowledge
+                bases and the traced Python heap, and the rest of the RSS.
+        """
+        process = read_memory(os.getpid())
+        llms = self.llm_memory()
+        knowledge_bases = [kb.memory_usage() for kb in self.knowledge_bases()]
+        components = {
+            "llm_weights_bytes": sum(
+                llm["weights_resident_bytes"] for llm in llms.values()
+            ),
+            "llm_kv_cache_bytes": sum(llm["kv_cache_bytes"] for llm in llms.values()),
+            "embedding_bytes": self.embedding_bytes(),
+            "hnsw_index_bytes": sum(usage["index_bytes"] for usage in knowledge_bases),
+            "query_cache_bytes": sum(usage["cache_bytes"] for usage in knowledge_bases),
+            "request_heap_bytes": (
+                tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+            ),
+        }
+        rss = process.get("rss_bytes", 0)
+        report = {
+            **process,
+            "components": components,
+            "other_bytes": max(rss - sum(components.values()), 0),
+            "llms": llms,
+            "label": label,
+        }
+        logger.info(
+            f"MEMORY{f' ({label.upper()})' if label else ''}: RSS {rss / 1024**2:.0f} MB, "
+            + ", ".join(
+                f"{name[:-6].upper()} {value / 1024**2:.0f} MB"
+                for name, value in {
+                    **components,
+                    "other_bytes": report["other_bytes"],
+                }.items()
+            )
+        )
+        for key, value in report.items():
+            runtime_stats.set_gauge("memory", key, value)
+        return report
+
+
+# Shared instance used by the chains and the knowledge base
+memory_profiler = MemoryProfiler()
@@ -1,9 +1,14 @@
-from typing import Tuple
+import gc
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Tuple
 
 import torch
 from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_community.llms import LlamaCpp
 from llama_cpp import LlamaGrammar
+from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
 from utils.logging_utils import logger
 
 
@@ -20,30 +25,116 @@ def setup_models() -> Tuple[HuggingFaceEmbeddings, LlamaCpp]:
     return embedding_model, llm
 
 
-def setup_llm() -> LlamaCpp:
+def setup_model_registry(
+    profile: str = "single",
+) -> Tuple[HuggingFaceEmbeddings, "ModelRegistry"]:
+    """
+    Sets up the embedding model and a registry of lazily loaded LLMs.
+
+    Args:
+        profile (str): The routing profile of the registry. Defaults to "single", "small_judge" is opt-in.
+
+    Returns:
+        A tuple containing the initialized HuggingFaceEmbeddings model and the ModelRegistry.
+    """
+    embedding_model = setup_embeddings()
+    registry = ModelRegistry(routes=ROUTING_PROFILES[profile])
+
+    return embedding_model, registry
+
+
+@dataclass
+class ModelConfig:
+    """
+    Configuration of a GGUF model loaded with LlamaCpp.
+
+    Attributes:
+        model_path (str): The path to the GGUF file.
+        n_ctx (int): The context window size.
+        n_gpu_layers (int): The number of layers offloaded to the GPU.
+        n_threads (int): The number of CPU threads.
+        temperature (float): The sampling temperature.
+        prompt_lookup_tokens (int): The number of tokens drafted from n-gram matches in the prompt
+            (prompt-lookup speculative decoding). 0 disables the mode.
+        prompt_lookup_ngram (int): The maximum n-gram size used to find matches in the prompt.
+    """
+
+    model_path: str
+    n_ctx: int = 3900
+    n_gpu_layers: int = 31
+    n_threads: int = 12
+    temperature: float = 0.5
+    prompt_lookup_tokens: int = 10
+    prompt_lookup_ngram: int = 3
+
+
+GRAMMAR_PATH = "/path/json_grammer.gbnf"
+EMBEDDING_MODEL_NAME = "intfloat/multilingual-e5-large"
+
+MODEL_CONFIGS = {
+    "large": ModelConfig(model_path="/path/sauerkrautlm-7b-hero.Q5_K_M.gguf"),
+    "small": ModelConfig(
+        model_path="/path/sauerkrautlm-3b-v1.Q4_K_M.gguf",
+        n_ctx=4096,
+        prompt_lookup_tokens=0,
+    ),
+}
+
+# Routing profiles map the chain names to the names of the models in MODEL_CONFIGS. "single" is the default,
+# "small_judge" is opt-in until the judge agreement of the small model is confirmed with RoutingBenchmark.
+ROUTING_PROFILES = {
+    "single": {
+        "DocumentChain": "large",
+        "ProductChain": "large",
+        "Judge": "large",
+        "QAPairDatasetGenerator": "large",
+        "Evaluator": "large",
+    },
+    "small_judge": {
+        "DocumentChain": "large",
+        "ProductChain": "large",
+        "Judge": "small",
+        "QAPairDatasetGenerator": "small",
+        "Evaluator": "large",
+    },
+}
+
+
+def setup_llm(model_config: ModelConfig = None) -> LlamaCpp:
     """
     Sets up the LlamaCpp model.
 
+    Args:
+        model_config (ModelConfig, optional): The model configuration. Defaults to the "large" model.
+
     Returns:
         The initialized LlamaCpp model.
     """
     None if torch.cuda.is_available() else logger.warning("CUDA is not enabled".upper())
 
+    model_config = model_config or MODEL_CONFIGS["large"]
     gpu_cpu_config = {
-        "n_ctx": 3900,
-        "n_gpu_layers": 31,
-        # "n_gpu_layers": 15,
-        "n_threads": 12,
+        "n_ctx": model_config.n_ctx,
+        "n_gpu_layers": model_config.n_gpu_layers,
+        "n_threads": model_config.n_threads,
     }
 
-    grammer_path = "/path/json_grammer.gbnf"
-    model_path = "/path/sauerkrautlm-7b-hero.Q5_K_M.gguf"
+    llm_grammar = LlamaGrammar.from_file(GRAMMAR_PATH, verbose=False)
 
-    llm_grammar = LlamaGrammar.from_file(grammer_path, verbose=False)
+    # The drafted tokens are verified by the model in one batch, so no second model is needed.
+    draft_model = (
+        LlamaPromptLookupDecoding(
+            num_pred_tokens=model_config.prompt_lookup_tokens,
+            max_ngram_size=model_config.prompt_lookup_ngram,
+        )
+        if model_config.prompt_lookup_tokens
+        else None
+    )
 
     llm = LlamaCpp(
-        model_path=model_path,
-        temperature=0.5,
+        model_path=model_config.model_path,
+        temperature=model_config.temperature,
+        # Upper bound, the chains apply their own budgets (see generation.py).
         max_tokens=2048,
         repeat_penalty=1.1,
         top_p=1,
@@ -51,12 +142,175 @@ def setup_llm() -> LlamaCpp:
         grammar=llm_grammar,
         stop=["\n\n"],
         f16_kv=True,
+        # The weights are mapped from the GGUF file, so processes loading the same file share the pages.
+        use_mmap=True,
+        use_mlock=False,
+        model_kwargs={"draft_model": draft_model},
         **gpu_cpu_config,
     )
+    # Kept on the client, so the chains can switch speculative decoding on and off per call.
+    llm.client.prompt_lookup_draft_model = draft_model
+    # A llama.cpp context is not thread safe, the chains sharing the model generate one at a time.
+    llm.client.generation_lock = threading.Lock()
 
     return llm
 
 
+class ModelRegistry:
+    """Loads named LlamaCpp models lazily and routes each chain to its model."""
+
+    def __init__(
+        self,
+        model_configs: Dict[str, ModelConfig] = None,
+        routes: Dict[str, str] = None,
+        default_model: str = "large",
+    ):
+        """
+        Initializes a ModelRegistry object.
+
+        Args:
+            model_configs (Dict[str, ModelConfig], optional): The model configurations by name. Defaults to MODEL_CONFIGS.
+            routes (Dict[str, str], optional): The model name per chain name. Defaults to the "single" profile.
+            default_model (str): The model used for chains without a route. Defaults to "large".
+        """
+        self.model_configs = model_configs or MODEL_CONFIGS
+        self.routes = routes or ROUTING_PROFILES["single"]
+        self.default_model = default_model
+        self.models: Dict[str, LlamaCpp] = {}
+        self.last_used: Dict[str, float] = {}
+        self.load_seconds: Dict[str, List[float]] = {}
+        # Called with the model name after a model was loaded, e.g. to report the memory.
+        self.load_listeners: List[Callable[[str], None]] = []
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> LlamaCpp:
+        """
+        Returns the model with the given name and loads it on first use.
+        Models with the same configuration are loaded only once.
+
+        Args:
+            name (str): The name of the model.
+
+        Returns:
+            LlamaCpp: The loaded model.
+        """
+        if name not in self.model_configs:
+            raise ValueError(f"Unknown model: {name}")
+        loaded = False
+        with self._lock:
+            if name not in self.models:
+                config = self.model_configs[name]
+                shared = next(
+                    (
+                        model
+                        for other, model in self.models.items()
+                        if self.model_configs[other] == config
+                    ),
+                    None,
+                )
+                if shared is None:
+                    logger.info(f"LOADING MODEL {name}: {config.model_path}")
+                    start = time.perf_counter()
+                    shared = setup_llm(config)
+                    seconds = time.perf_counter() - start
+                    self.load_seconds.setdefault(name, []).append(seconds)
+                    logger.info(f"MODEL {name} LOADED IN {seconds:.1f}s")
+                    loaded = True
+                self.models[name] = shared
+            self.last_used[name] = time.time()
+            model = self.models[name]
+        if loaded:
+            for listener in self.load_listeners:
+                listener(name)
+        return model
+
+    def for_chain(self, chain_name: str) -> LlamaCpp:
+        """Returns the model routed to the given chain name."""
+        return self.get(self.routes.get(chain_name, self.default_model))
+
+    def lazy(self, chain_name: str) -> "LazyModel":
+        """Returns a proxy of the model routed to the given chain name that loads the model on first use."""
+        return LazyModel(registry=self, chain_name=chain_name)
+
+    def use_profile(self, profile: str) -> None:
+        """Switches the routes to the given routing profile."""
+        if profile not in ROUTING_PROFILES:
+            raise ValueError(f"Unknown routing profile: {profile}")
+        self.routes = ROUTING_PROFILES[profile]
+
+    def loaded_models(self) -> List[str]:
+        """Returns the names of the loaded models."""
+        return list(self.models)
+
+    def idle_seconds(self, name: str) -> float:
+        """Returns the seconds since the model was last requested, 0 if it is not loaded."""
+        if name not in self.models:
+            return 0.0
+        return time.time() - self.last_used.get(name, time.time())
+
+    def unload(self, name: str) -> List[str]:
+        """
+        Unloads a model. Models sharing its instance are unloaded as well, so its memory is released.
+        The model is loaded again by the next request, the weights are mapped from the page cache if
+        the GGUF file is still cached. Generations that already hold the model finish with it.
+
+        Args:
+            name (str): The name of the model.
+
+        Returns:
+            List[str]: The names of the unloaded models.
+        """
+        with self._lock:
+            model = self.models.get(name)
+            if model is None:
+                return []
+            names = [
+                other
+                for other, other_model in self.models.items()
+                if other_model is model
+            ]
+            for other in names:
+                del self.models[other]
+            del model
+        gc.collect()
+        logger.info(f"MODELS UNLOADED: {names}")
+        return names
+
+
+class LazyModel:
+    """Proxy of a routed model. The model is loaded by the registry when an attribute is accessed first."""
+
+    def __init__(self, registry: ModelRegistry, chain_name: str):
+        self.registry = registry
+        self.chain_name = chain_name
+
+    def __getattr__(self, name: str):
+        return getattr(self.registry.for_chain(self.chain_name), name)
+
+    def resolve(self) -> LlamaCpp:
+        """Returns the routed model, loading it if needed."""
+        return self.registry.for_chain(self.chain_name)
+
+
+def set_speculative_decoding(llm: LlamaCpp, enabled: bool) -> bool:
+    """
+    Enables or disables prompt-lookup speculative decoding for the following generations.
+
+    Args:
+        llm (LlamaCpp): The LlamaCpp model set up with setup_llm.
+        enabled (bool): Whether speculative decoding is used.
+
+    Returns:
+        bool: True if speculative decoding is active, False otherwise.
+    """
+    client = getattr(llm, "client", None)
+    draft_model = getattr(client, "prompt_lookup_draft_model", None)
+    if client is None or draft_model is None:
+        return False
+    client.draft_model = draft_model if enabled else None
+    return client.draft_model is not None
+
+
 def setup_embeddings() -> HuggingFaceEmbeddings:
     """
     Sets up the HuggingFaceEmbeddings model.
@@ -65,7 +319,7 @@ def setup_embeddings() -> HuggingFaceEmbeddings:
         The initialized HuggingFaceEmbeddings model.
     """
     embedding_model = HuggingFaceEmbeddings(
-        model_name="intfloat/multilingual-e5-large",
+        model_name=EMBEDDING_MODEL_NAME,
         model_kwargs={"device": "cpu"},
         # model_kwargs={"device": "cuda"},
     )
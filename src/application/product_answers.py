@@ -0,0 +1,398 @@
+import argparse
+import hashlib
+import json
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import application.templates as tl
+from application.column_selection import normalize_tokens, term_matches
+from utils.logging_utils import logger
+
+# Questions with these terms compare products or ask about their use, they are always answered by the LLM.
+COMPLEX_TERMS = (
+    "vergleich",
+    "unterschied",
+    "ersetzen",
+    "ersatz",
+    "statt",
+    "besser",
+    "kompatib",
+    "passt",
+    "geeignet",
+)
+
+# Question words, articles and product references a canonical product question may contain besides the synonym
+# of its intent. Any other content token, e.g. "brauche", "speziellen" or "ohne", sends the question to the LLM.
+CANONICAL_TOKENS = frozenset(
+    [
+        "wie",
+        "was",
+        "welche",
+        "welcher",
+        "welches",
+        "welchen",
+        "wo",
+        "ist",
+        "sind",
+        "hat",
+        "haben",
+        "gibt",
+        "es",
+        "viel",
+        "viele",
+        "hoch",
+        "lange",
+        "finde",
+        "ich",
+        "man",
+        "kann",
+        "mir",
+        "bitte",
+        "sagen",
+        "du",
+        "sie",
+        "die",
+        "der",
+        "das",
+        "den",
+        "dem",
+        "des",
+        "ein",
+        "eine",
+        "einen",
+        "diese",
+        "dieser",
+        "dieses",
+        "denn",
+        "von",
+        "mit",
+        "bei",
+        "fuer",
+        "zu",
+        "zum",
+        "zur",
+        "hier",
+        "nr",
+        "lampe",
+        "leuchtmittel",
+        "roehre",
+        "produkt",
+        "produkts",
+        "artikel",
+        "bestellnummer",
+        "artikelnummer",
+    ]
+)
+
+
+def is_canonical_token(token: str) -> bool:
+    """Checks if a token is a question word, an article or a product reference like an order number."""
+    return token in CANONICAL_TOKENS or any(char.isdigit() for char in token)
+
+
+def is_missing(value, placeholders: Iterable = ()) -> bool:
+    """Checks if a product value is empty or one of the placeholders the catalog cleaning uses for unknown values."""
+    if value in (None, "", "-"):
+        return True
+    if isinstance(value, str):
+        value = value.strip().lower()
+    return any(value == placeholder for placeholder in placeholders)
+
+
+def format_value(value) -> str:
+    """Formats a product value for an answer, whole floats without decimals."""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class IntentClassifier:
+    """Recognizes the common product question intents by their synonyms.
+
+    Only the explicit synonyms of the intents are matched, not the column names, as a precomputed answer
+    skips the LLM and the expert escalation. Only short canonical questions are classified, which contain
+    nothing but the synonym of one intent, question words and product references. All other questions go
+    to the LLM.
+    """
+
+    def __init__(self, intents: Dict[str, dict] = None):
+        """
+        Initializes an IntentClassifier object.
+
+        Args:
+            intents (Dict[str, dict], optional): The synonyms, columns and templates per intent. Defaults to tl.product_intents.
+        """
+        self.intents = intents or tl.product_intents
+
+    def classify(self, question: str) -> Optional[str]:
+        """
+        Returns the intent of a question.
+
+        Args:
+            question (str): The question of the user.
+
+        Returns:
+            str or None: The intent, or None if the question matches no intent, several intents, compares products
+                or contains further content words.
+        """
+        tokens = set(normalize_tokens(question))
+        if any(token.startswith(term) for token in tokens for term in COMPLEX_TERMS):
+            return None
+        matches = {
+            intent: {
+                token
+                for token in tokens
+                if any(term_matches(token, term) for term in entry["synonyms"])
+            }
+            for intent, entry in self.intents.items()
+        }
+        intents = [intent for intent, matched in matches.items() if matched]
+        if len(intents) != 1:
+            return None
+        intent = intents[0]
+        if not all(is_canonical_token(token) for token in tokens - matches[intent]):
+            return None
+        return intent
+
+
+class ProductAnswerTable:
+    """Stores precomputed answers to the common product question intents for every row of the lamps table.
+
+    The answers are created from templates, the ProductChain is only used for rows where a template
+    column is empty. The table lives in the product database and remembers a fingerprint of the lamps
+    table, so it can be rebuilt when the catalog changes.
+    """
+
+    def __init__(self, path_sql_db: str, intents: Dict[str, dict] = None):
+        """
+        Initializes a ProductAnswerTable object.
+
+        Args:
+            path_sql_db (str): The path to the SQLite database with the lamps table.
+            intents (Dict[str, dict], optional): The columns and templates per intent. Defaults to tl.product_intents.
+        """
+        self.path_sql_db = path_sql_db
+        self.intents = intents or tl.product_intents
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path_sql_db, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.setup_database()
+
+    def setup_database(self) -> None:
+        """Creates the product answers table and its metadata table."""
+        with self._lock, self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS product_answers (
+                    Bestell_Nr INTEGER NOT NULL,
+                    intent TEXT NOT NULL,
+                    answer TEXT NOT NULL,
+                    method TEXT NOT NULL,
+                    PRIMARY KEY (Bestell_Nr, intent)
+                );""")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS product_answers_meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );""")
+
+    def load_rows(self) -> List[dict]:
+        """Returns the rows of the lamps table, empty if there is none."""
+        with self._lock:
+            try:
+                rows = self.conn.execute("SELECT * FROM lamps;").fetchall()
+            except sqlite3.OperationalError:
+                return []
+        return [dict(row) for row in rows]
+
+    def catalog_fingerprint(self, rows: List[dict] = None) -> str:
+        """Returns a hash of the lamps table and the intents, it changes with every change of the catalog."""
+        rows = self.load_rows() if rows is None else rows
+        digest = hashlib.sha256(json.dumps(self.intents, sort_keys=True).encode())
+        for row in sorted(rows, key=lambda row: str(row.get("Bestell_Nr"))):
+            digest.update(json.dumps(row, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def stored_fingerprint(self) -> Optional[str]:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT value FROM product_answers_meta WHERE key = 'catalog_fingerprint';"
+            ).fetchone()
+        return row[0] if row else None
+
+    def is_stale(self) -> bool:
+        """Checks if the lamps table changed since the answers were built."""
+        return self.stored_fingerprint() != self.catalog_fingerprint()
+
+    def render(self, intent: str, row: dict) -> Optional[str]:
+        """
+        Creates the answer of an intent from its template.
+
+        Args:
+            intent (str): The intent.
+            row (dict): The product row.
+
+        Returns:
+            str or None: The answer, or None if a column of the template is empty or a placeholder.
+        """
+        entry = self.intents[intent]
+        values = {key: format_value(value) for key, value in row.items()}
+        placeholders = entry.get("placeholders", ())
+        if any(
+            is_missing(row.get(column), placeholders) for column in entry["columns"]
+        ):
+            return None
+        if "value_templates" in entry:
+            value = values[entry["columns"][0]].strip().lower()
+            template = entry["value_templates"].get(value)
+        else:
+            template = entry["template"]
+        try:
+            return template.format_map(values) if template else None
+        except KeyError:
+            return None
+
+    def create_answers(
+        self, row: dict, product_chain=None
+    ) -> List[Tuple[str, str, str]]:
+        """Creates the intent, answer and method of every intent that can be answered for a product row."""
+        answers = []
+        for intent, entry in self.intents.items():
+            answer = self.render(intent, row)
+            method = "template"
+            if answer is None and product_chain is not None:
+                result = product_chain.execute(
+                    query=entry["question"], product_info=row
+                )
+                answer = (
+                    result["answer"]
+                    if product_chain.to_bool(result["solved"])
+                    else None
+                )
+                method = "llm"
+            if answer:
+                answers.append((intent, answer, method))
+        return answers
+
+    def build(self, product_chain=None) -> int:
+        """
+        Creates the answers of all intents for every product and replaces the table in one transaction.
+
+        Args:
+            product_chain (ProductChain, optional): Answers the intents whose template cannot be filled.
+                Without it, these intents are left to the ProductChain at runtime.
+
+        Returns:
+            int: The number of stored answers.
+        """
+        rows = self.load_rows()
+        records = self.store(rows, product_chain)
+        logger.info(
+            f"PRODUCT ANSWER TABLE BUILT: {records} ANSWERS FOR {len(rows)} PRODUCTS"
+        )
+        return records
+
+    def update_products(self, product_codes: Iterable[int], product_chain=None) -> int:
+        """
+        Recreates the answers of the given products, e.g. of the products changed by a catalog sync.
+        The answers of deleted products are removed.
+
+        Args:
+            product_codes (Iterable[int]): The product codes.
+            product_chain (ProductChain, optional): Answers the intents whose template cannot be filled.
+
+        Returns:
+            int: The number of stored answers.
+        """
+        product_codes = {int(code) for code in product_codes}
+        records = self.store(self.load_rows(), product_chain, product_codes)
+        logger.info(
+            f"PRODUCT ANSWERS UPDATED: {records} ANSWERS FOR {len(product_codes)} PRODUCTS"
+        )
+        return records
+
+    def store(
+        self, rows: List[dict], product_chain=None, product_codes: Set[int] = None
+    ) -> int:
+        """Replaces the answers of the given products, or of all products, and the fingerprint in one transaction."""
+        records = [
+            (row["Bestell_Nr"], intent, answer, method)
+            for row in rows
+            if row.get("Bestell_Nr") is not None
+            and (product_codes is None or row["Bestell_Nr"] in product_codes)
+            for intent, answer, method in self.create_answers(row, product_chain)
+        ]
+        fingerprint = self.catalog_fingerprint(rows)
+        with self._lock, self.conn:
+            if product_codes is None:
+                self.conn.execute("DELETE FROM product_answers;")
+            else:
+                self.conn.executemany(
+                    "DELETE FROM product_answers WHERE Bestell_Nr = ?;",
+                    [(code,) for code in product_codes],
+                )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO product_answers VALUES (?, ?, ?, ?);", records
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO product_answers_meta VALUES (?, ?);",
+                [
+                    ("catalog_fingerprint", fingerprint),
+                    ("built_at", datetime.now().isoformat()),
+                ],
+            )
+        return len(records)
+
+    def rebuild_if_stale(self, product_chain=None) -> bool:
+        """Rebuilds the answers if the lamps table changed. Returns True if they were rebuilt."""
+        if not self.is_stale():
+            return False
+        self.build(product_chain)
+        return True
+
+    def lookup(self, product_code: int, intent: str) -> Optional[str]:
+        """Returns the precomputed answer of an intent for a product, None if there is none."""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT answer FROM product_answers WHERE Bestell_Nr = ? AND intent = ?;",
+                (int(product_code), intent),
+            ).fetchone()
+        return row[0] if row else None
+
+    def close(self) -> None:
+        """Closes the database connection."""
+        with self._lock:
+            self.conn.close()
+
+
+def main():
+    """Builds the product answer table of a knowledge base from the command line."""
+    parser = argparse.ArgumentParser(description=ProductAnswerTable.__doc__)
+    parser.add_argument("--path-kb", required=True, help="Knowledge base directory.")
+    parser.add_argument(
+        "--use-llm",
+        action="store_true",
+        help="Answer intents with empty template columns with the ProductChain.",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="Rebuild even if the catalog is unchanged."
+    )
+    args = parser.parse_args()
+
+    product_chain = None
+    if args.use_llm:
+        # Imported here, the chains use this module.
+        from application.chains import ProductChain
+        from application.models import ModelRegistry
+
+        product_chain = ProductChain(llm=ModelRegistry().lazy("ProductChain"))
+
+    table = ProductAnswerTable(args.path_kb + "/sqlite_db.db")
+    if args.force:
+        table.build(product_chain)
+    elif not table.rebuild_if_stale(product_chain):
+        logger.info("PRODUCT ANSWER TABLE IS UP TO DATE")
+    table.close()
+
+
+if __name__ == "__main__":
+    main()
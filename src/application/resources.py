@@ -0,0 +1,249 @@
+import os
+import threading
+import time
+from typing import Callable, List, Optional
+
+import torch
+from langchain_community.embeddings import HuggingFaceEmbeddings
+from langchain_core.embeddings import Embeddings
+
+from application.models import ModelRegistry, setup_embeddings
+from application.memory import read_memory
+from utils.logging_utils import logger
+from utils.runtime_stats import runtime_stats
+
+
+class ManagedEmbeddings(Embeddings):
+    """Embedding model that is loaded on first use and can be unloaded or quantized while the bot is idle.
+
+    The quantized variant replaces the linear layers of the same model by int8 layers (dynamic quantization),
+    so the embeddings stay in the vector space of the index while the weights take about a quarter of the memory.
+    """
+
+    def __init__(
+        self, load_model: Callable[[], HuggingFaceEmbeddings] = setup_embeddings
+    ):
+        """
+        Initializes a ManagedEmbeddings object.
+
+        Args:
+            load_model (Callable[[], HuggingFaceEmbeddings]): Loads the embedding model. Defaults to setup_embeddings.
+        """
+        self.load_model = load_model
+        self.model: Optional[HuggingFaceEmbeddings] = None
+        self.quantized = False
+        # Once quantized under memory pressure, the model is also quantized when it is loaded again.
+        self.quantize_on_load = False
+        self.last_used: Optional[float] = None
+        self.load_seconds: List[float] = []
+        self._lock = threading.RLock()
+
+    def get_model(self) -> HuggingFaceEmbeddings:
+        """Returns the embedding model and loads it if needed."""
+        with self._lock:
+            if self.model is None:
+                logger.info("LOADING EMBEDDING MODEL")
+                start = time.perf_counter()
+                self.model = self.load_model()
+                if self.quantize_on_load:
+                    self.quantize()
+                self.load_seconds.append(time.perf_counter() - start)
+                logger.info(f"EMBEDDING MODEL LOADED IN {self.load_seconds[-1]:.1f}s")
+            self.last_used = time.time()
+            return self.model
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.get_model().embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.get_model().embed_query(text)
+
+    @property
+    def state(self) -> str:
+        """Returns "unloaded", "quantized" or "resident"."""
+        if self.model is None:
+            return "unloaded"
+        return "quantized" if self.quantized else "resident"
+
+    def idle_seconds(self) -> float:
+        """Returns the seconds since the model was last used, 0 if it is not loaded."""
+        if self.model is None or self.last_used is None:
+            return 0.0
+        return time.time() - self.last_used
+
+    def quantize(self) -> None:
+        """
+        Replaces the linear layers of the loaded model by dynamically quantized int8 layers. The layers are
+        replaced in place, so the fp32 weights are released. The knowledge bases drop their cached query
+        embeddings of the fp32 model once they see the quantized flag, see KnowledgeBase.embed_queries.
+        """
+        with self._lock:
+            if self.model is None or self.quantized:
+                return
+            torch.quantization.quantize_dynamic(
+                self.model.client, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+            )
+            self.quantized = True
+            self.quantize_on_load = True
+        logger.info("EMBEDDING MODEL QUANTIZED TO INT8")
+
+    def unload(self) -> None:
+        """Unloads the model, it is loaded again by the next embedding request."""
+        with self._lock:
+            if self.model is None:
+                return
+            self.model = None
+            self.quantized = False
+        logger.info("EMBEDDING MODEL UNLOADED")
+
+
+class ResourceManager:
+    """Unloads idle models and keeps the process within a RAM budget.
+
+    Models that were not used for their idle timeout are unloaded and loaded again on demand; the LLM
+    weights are memory-mapped, so a reload from the page cache is fast. When the resident memory exceeds
+    the budget, the least recently used LLMs are unloaded first, then the embedding model is quantized.
+    Only chains that use the registry's lazy models (ModelRegistry.lazy) release their model.
+    """
+
+    def __init__(
+        self,
+        models: ModelRegistry,
+        embeddings: ManagedEmbeddings,
+        memory_budget_mb: float = 8192,
+        llm_idle_seconds: float = 600,
+        embedding_idle_seconds: float = 1800,
+        min_idle_seconds: float = 60,
+        check_interval: float = 30,
+    ):
+        """
+        Initializes a ResourceManager object.
+
+        Args:
+            models (ModelRegistry): The registry of the LLMs.
+            embeddings (ManagedEmbeddings): The embedding model.
+            memory_budget_mb (float): The resident memory of the process. Defaults to 8192.
+            llm_idle_seconds (float): The idle time after which an LLM is unloaded. Defaults to 600.
+            embedding_idle_seconds (float): The idle time after which the embedding model is unloaded. Defaults to 1800.
+            min_idle_seconds (float): The minimum idle time of a model unloaded because of the budget, so models
+                in use are not unloaded and reloaded in turn. Defaults to 60.
+            check_interval (float): The seconds between two checks of the background thread. Defaults to 30.
+        """
+        self.models = models
+        self.embeddings = embeddings
+        self.memory_budget_bytes = memory_budget_mb * 1024**2
+        self.llm_idle_seconds = llm_idle_seconds
+        self.embedding_idle_seconds = embedding_idle_seconds
+        self.min_idle_seconds = min_idle_seconds
+        self.check_interval = check_interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def rss_bytes(self) -> int:
+        """Returns the resident memory of the process, 0 if it cannot be read."""
+        return read_memory(os.getpid()).get("rss_bytes", 0)
+
+    def over_budget(self) -> bool:
+        return self.rss_bytes() > self.memory_budget_bytes
+
+    def check(self) -> List[str]:
+        """
+        Unloads the idle models and, if the budget is exceeded, the least recently used ones.
+
+        Returns:
+            List[str]: The actions taken, e.g. "unload:large" or "quantize:embeddings".
+        """
+        actions = []
+        for name in self.models.loaded_models():
+            if name in self.models.models and (
+                self.models.idle_seconds(name) > self.llm_idle_seconds
+            ):
+                actions += [f"unload:{n}" for n in self.models.unload(name)]
+        if self.embeddings.idle_seconds() > self.embedding_idle_seconds:
+            self.embeddings.unload()
+            actions.append("unload:embeddings")
+
+        if self.over_budget():
+            by_last_use = sorted(
+                self.models.loaded_models(), key=self.models.idle_seconds, reverse=True
+            )
+            for name in by_last_use:
+                if not self.over_budget():
+                    break
+                if name in self.models.models and (
+                    self.models.idle_seconds(name) > self.min_idle_seconds
+                ):
+                    actions += [f"unload:{n}" for n in self.models.unload(name)]
+            if self.over_budget() and self.embeddings.state == "resident":
+                self.embeddings.quantize()
+                actions.append("quantize:embeddings")
+            if self.over_budget():
+                logger.warning(
+                    f"MEMORY BUDGET EXCEEDED: {self.rss_bytes() / 1024**2:.0f} MB RESIDENT"
+                )
+
+        if actions:
+            logger.info(f"RESOURCE MANAGER ACTIONS: {actions}")
+            runtime_stats.record_event(
+                "resources", {"time": time.time(), "actions": actions}
+            )
+        self.report()
+        return actions
+
+    def run(self) -> None:
+        while not self._stop.wait(self.check_interval):
+            try:
+                self.check()
+            except Exception as e:
+                logger.error(f"RESOURCE CHECK FAILED: {e}")
+
+    def start(self) -> "ResourceManager":
+        """Starts the background thread that checks the models periodically."""
+        self._thread = threading.Thread(
+            target=self.run, name="resource-manager", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stops the background thread."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.check_interval)
+
+    def report(self) -> dict:
+        """
+        Reports the residency and reload latencies of the models and publishes them as gauges of the
+        "resources" runtime stats.
+
+        Returns:
+            dict: The resident memory and budget, and per model whether it is resident, its idle time,
+                its number of loads and its last and mean load seconds.
+        """
+        models = {}
+        for name in self.models.model_configs:
+            load_seconds = self.models.load_seconds.get(name, [])
+            models[name] = {
+                "resident": name in self.models.models,
+                "idle_seconds": self.models.idle_seconds(name),
+                "loads": len(load_seconds),
+                "last_load_seconds": load_seconds[-1] if load_seconds else None,
+                "mean_load_seconds": (
+                    sum(load_seconds) / len(load_seconds) if load_seconds else None
+                ),
+            }
+        load_seconds = self.embeddings.load_seconds
+        report = {
+            "rss_bytes": self.rss_bytes(),
+            "budget_bytes": self.memory_budget_bytes,
+            "models": models,
+            "embeddings": {
+                "state": self.embeddings.state,
+                "idle_seconds": self.embeddings.idle_seconds(),
+                "loads": len(load_seconds),
+                "last_load_seconds": load_seconds[-1] if load_seconds else None,
+            },
+        }
+        for key, value in report.items():
+            runtime_stats.set_gauge("resources", key, value)
+        return report
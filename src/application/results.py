@@ -0,0 +1,129 @@
+from dataclasses import dataclass, fields
+from typing import Any, List, Optional, Union
+
+from langchain_core.documents.base import Document
+
+# The key order of the serialized results: the judgement first, then the answer, as before the typed results.
+JUDGE_KEYS = ("reasoning_for_correctness", "correctness")
+RESULT_KEYS = (
+    "question_id",
+    "question_type",
+    "solved",
+    "question",
+    "answer",
+    "context",
+)
+OPTIONAL_KEYS = JUDGE_KEYS + ("error",)
+
+
+def page_content(item: Union[Document, dict, str]) -> str:
+    """Returns the text of a context item, a retrieved document or its serialized form."""
+    if isinstance(item, Document):
+        return item.page_content
+    if isinstance(item, dict):
+        return item["page_content"]
+    return item
+
+
+def item_metadata(item: Union[Document, dict, str]) -> dict:
+    """Returns the metadata of a context item, empty for plain texts and product rows."""
+    if isinstance(item, Document):
+        return item.metadata
+    if isinstance(item, dict):
+        return item.get("metadata", {})
+    return {}
+
+
+def serialize_context(context: Any) -> Any:
+    """Converts the retrieved documents of a context to dictionaries. Other items are returned as they are."""
+    if isinstance(context, list):
+        return [item.dict() if isinstance(item, Document) else item for item in context]
+    return context
+
+
+@dataclass(slots=True)
+class ChainResult:
+    """The result of a chain, optionally with the judgement.
+
+    The context references the retrieved documents or the product rows instead of copying them, they are
+    only serialized by to_dict, e.g. when the result is stored or logged. The result can be read like the
+    dictionaries returned before: result["answer"], result.get("correctness"), "error" in result and
+    {**result} work, the judgement and error keys only exist once they are set.
+    """
+
+    question_id: Optional[str] = None
+    question_type: Optional[str] = None
+    solved: Any = None
+    question: Optional[str] = None
+    answer: Any = None
+    context: Any = None
+    reasoning_for_correctness: Optional[str] = None
+    correctness: Any = None
+    error: Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ChainResult":
+        """Creates a result from a dictionary, unknown keys are ignored."""
+        if isinstance(data, ChainResult):
+            return data
+        names = {field.name for field in fields(cls)}
+        return cls(**{key: value for key, value in data.items() if key in names})
+
+    def keys(self) -> List[str]:
+        """Returns the keys of the result in the order of to_dict."""
+        judged = [key for key in JUDGE_KEYS if getattr(self, key) is not None]
+        error = ["error"] if self.error is not None else []
+        return judged + list(RESULT_KEYS) + error
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.keys():
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key not in RESULT_KEYS + OPTIONAL_KEYS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.keys()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self[key] if key in self else default
+
+    def items(self) -> List[tuple]:
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+    def to_dict(self) -> dict:
+        """Serializes the result with the documents of the context as dictionaries."""
+        data = dict(self.items())
+        data["context"] = serialize_context(self.context)
+        return data
+
+
+def as_dict(result: Union[ChainResult, dict, None]) -> Optional[dict]:
+    """Serializes a chain result at the edges, e.g. for storage, logging or emails. Dictionaries are returned as they are."""
+    return result.to_dict() if isinstance(result, ChainResult) else result
+
+
+def result_summary(result: Union[ChainResult, dict, None]) -> str:
+    """Summarizes a chain result for the log: the IDs, the judgement, the answer and the context references.
+    Chunks are referenced by their chunk ID and product rows by their Bestell_Nr, nothing is serialized.
+    """
+    if result is None:
+        return "None"
+    context = result.get("context")
+    if not isinstance(context, list):
+        context = [] if context is None else [context]
+    refs = []
+    for item in context:
+        metadata = item_metadata(item)
+        if "chunk_id" in metadata:
+            refs.append(metadata["chunk_id"])
+        elif isinstance(item, dict) and "Bestell_Nr" in item:
+            refs.append(f"Bestell_Nr {item['Bestell_Nr']}")
+        else:
+            refs.append(metadata.get("source", type(item).__name__))
+    keys = ("question_id", "question_type", "solved", "correctness", "error")
+    parts = [f"{key}={result.get(key)}" for key in keys if key in result]
+    return f"{' '.join(parts)} answer={result.get('answer')!r} context={refs}"
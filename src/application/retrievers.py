@@ -0,0 +1,58 @@
+from typing import Any, List, Optional, Tuple
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents.base import Document
+from langchain_core.retrievers import BaseRetriever
+
+
+class ScoredRetriever(BaseRetriever):
+    """Retriever that returns only documents above a relevance threshold, with an adaptive number of documents.
+
+    The relevance score of each document is stored in its metadata under "relevance_score"
+    and the id of its chunk under "chunk_id". The threshold depends on the embedding model and the
+    documents, so it is off until it is tuned for the knowledge base with the ThresholdTuner.
+    """
+
+    knowledge_base: Any
+    """The KnowledgeBase that is searched."""
+    k: int = 3
+    """The number of documents returned when the scores are close to each other."""
+    max_k: int = 5
+    """The maximum number of documents returned."""
+    score_threshold: Optional[float] = None
+    """The minimum relevance score of a returned document, None returns the documents without a threshold."""
+    score_margin: float = 0.03
+    """Documents beyond the first k are returned while their score is within this margin of the top score."""
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def select(self, scored_docs: List[Tuple[Document, float]]) -> List[Document]:
+        """
+        Selects the documents to return from the scored search results.
+
+        Args:
+            scored_docs (List[Tuple[Document, float]]): The search results sorted by descending score.
+
+        Returns:
+            List[Document]: The selected documents. Empty if no document clears the threshold.
+        """
+        relevant = [
+            (d, s)
+            for d, s in scored_docs
+            if self.score_threshold is None or s >= self.score_threshold
+        ]
+        if not relevant:
+            return []
+        top_score = relevant[0][1]
+        return [
+            doc
+            for i, (doc, score) in enumerate(relevant[: self.max_k])
+            if i < self.k or score >= top_score - self.score_margin
+        ]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        scored_docs = self.knowledge_base.search_with_scores([query], k=self.max_k)[0]
+        return self.select(scored_docs)
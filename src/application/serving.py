@@ -0,0 +1,305 @@
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from langchain_community.embeddings import HuggingFaceEmbeddings
+
+from application.chains import DocumentChain, Judge, ProductChain
+from application.knowledge_base import KnowledgeBase
+from application.memory import read_memory
+from application.models import ROUTING_PROFILES, ModelRegistry, setup_embeddings
+from utils.logging_utils import logger
+from utils.runtime_stats import runtime_stats
+
+CHAIN_NAMES = ("DocumentChain", "ProductChain", "Judge")
+
+
+def worker_main(slot: int, profile: str, requests, results) -> None:
+    """
+    Serves the generation requests of the dispatcher in a worker process.
+    The LlamaCpp models are loaded with use_mmap, so the workers share the pages of the GGUF files.
+
+    Args:
+        slot (int): The number of the worker.
+        profile (str): The routing profile of the model registry.
+        requests (Queue): The requests of this worker.
+        results (Queue): The results of all workers.
+    """
+    models = ModelRegistry(routes=ROUTING_PROFILES[profile])
+    # Retrieval happens in the dispatcher, the document chain only generates.
+    chains = {
+        "DocumentChain": DocumentChain(
+            retriever=None, llm=models.lazy("DocumentChain")
+        ),
+        "ProductChain": ProductChain(llm=models.lazy("ProductChain")),
+        "Judge": Judge(llm=models.lazy("Judge")),
+    }
+    chains["Judge"].label = "evaluation"
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        request_id, chain_name, payload = request
+        try:
+            chain = chains[chain_name]
+            if chain_name == "DocumentChain":
+                result = chain.generate(
+                    payload["query"], payload["context"], payload["question_id"]
+                )
+            elif chain_name == "ProductChain":
+                chain.question_id = payload["question_id"]
+                result = chain.execute(
+                    query=payload["query"], product_info=payload["product_info"]
+                )
+            else:
+                result = chain.execute(payload["llm_response"])
+            results.put((request_id, slot, result, None))
+        except Exception:
+            results.put((request_id, slot, None, traceback.format_exc()))
+
+
+@dataclass
+class WorkerState:
+    """A worker process and the requests it has not answered yet."""
+
+    process: multiprocessing.Process
+    requests: multiprocessing.Queue
+    pending: Dict[int, tuple] = field(default_factory=dict)
+    handled: int = 0
+    restarts: int = 0
+
+
+class ServingPool:
+    """Serves the chains with several worker processes that share one memory-mapped model.
+
+    The worker processes are forked from a fork server, a fresh process that has only imported the
+    libraries, so they do not inherit the embedding model and knowledge base of the dispatcher. Every worker holds its own LlamaCpp instances over the same
+    GGUF files. The dispatcher holds the only vector index: it retrieves the context of document questions
+    and sends the requests to the worker with the fewest pending requests. Crashed workers are restarted
+    and their pending requests are sent again once.
+    """
+
+    def __init__(
+        self,
+        path_kb: str,
+        n_workers: int = 2,
+        profile: str = "single",
+        embedding_model: Optional[HuggingFaceEmbeddings] = None,
+        monitor_interval: float = 1.0,
+    ):
+        """
+        Initializes a ServingPool object.
+
+        Args:
+            path_kb (str): The knowledge base directory.
+            n_workers (int): The number of worker processes. Defaults to 2.
+            profile (str): The routing profile of the workers' model registry. Defaults to "single".
+            embedding_model (HuggingFaceEmbeddings, optional): The embedding model of the dispatcher.
+                Defaults to the model of setup_embeddings.
+            monitor_interval (float): The seconds between two checks of the workers. Defaults to 1.0.
+        """
+        self.path_kb = path_kb
+        self.n_workers = n_workers
+        self.profile = profile
+        self.embedding_model = embedding_model
+        self.monitor_interval = monitor_interval
+        self.context = multiprocessing.get_context("forkserver")
+        # Imported once in the fork server, the workers share the pages of the libraries.
+        self.context.set_forkserver_preload(
+            ["application.chains", "application.models"]
+        )
+        self.results = self.context.Queue()
+        self.workers: List[WorkerState] = []
+        self.futures: Dict[int, Future] = {}
+        self.request_ids = itertools.count()
+        self.kb: KnowledgeBase = None
+        self.document_chain: DocumentChain = None
+        self._lock = threading.RLock()
+        self._running = False
+
+    def start_worker(self, slot: int) -> WorkerState:
+        """Starts the worker process of the given slot."""
+        requests = self.context.Queue()
+        process = self.context.Process(
+            target=worker_main,
+            args=(slot, self.profile, requests, self.results),
+            name=f"serving-worker-{slot}",
+            daemon=True,
+        )
+        process.start()
+        logger.info(f"SERVING WORKER {slot} STARTED WITH PID {process.pid}")
+        return WorkerState(process=process, requests=requests)
+
+    def start(self) -> "ServingPool":
+        """Starts the workers, loads the knowledge base and starts the result and monitor threads."""
+        self.workers = [self.start_worker(slot) for slot in range(self.n_workers)]
+        if self.embedding_model is None:
+            self.embedding_model = setup_embeddings()
+        self.kb = KnowledgeBase(
+            path_sql_db=self.path_kb + "/sqlite_db.db",
+            path_vector_store=self.path_kb + "/chroma_db",
+            path_email_storage=self.path_kb + "/email_storage",
+            embedding_model=self.embedding_model,
+        )
+        # Only used for the expert fast path, the retrieval and the short-circuits, it never generates.
+        self.document_chain = DocumentChain(
+            retriever=self.kb.retriever, llm=None, expert_index=self.kb.expert_index
+        )
+        self._running = True
+        threading.Thread(target=self.collect_results, daemon=True).start()
+        threading.Thread(target=self.monitor_workers, daemon=True).start()
+        return self
+
+    def dispatch(
+        self, request_id: int, chain_name: str, payload: dict, attempts: int = 0
+    ) -> None:
+        """Sends a request to the worker with the fewest pending requests."""
+        with self._lock:
+            worker = min(self.workers, key=lambda state: len(state.pending))
+            worker.pending[request_id] = (chain_name, payload, attempts)
+            worker.requests.put((request_id, chain_name, payload))
+
+    def submit(self, chain_name: str, **payload) -> Future:
+        """
+        Submits a request to the workers.
+
+        Args:
+            chain_name (str): One of "DocumentChain", "ProductChain" or "Judge".
+            **payload: The arguments of the chain: query (and product_info for the ProductChain),
+                or llm_response for the Judge. An optional question_id.
+
+        Returns:
+            Future: The future of the chain response.
+        """
+        if chain_name not in CHAIN_NAMES:
+            raise ValueError(f"Unknown chain: {chain_name}")
+        future = Future()
+        payload.setdefault("question_id", uuid.uuid4().hex)
+
+        if chain_name == "DocumentChain":
+            # Same fast paths as DocumentChain.execute, answered without a worker.
+            query, question_id = payload["query"], payload["question_id"]
+            expert_match = (
+                self.kb.expert_index.match(query) if self.kb.expert_index else None
+            )
+            if expert_match is not None:
+                future.set_result(
+                    self.document_chain.create_expert_response(
+                        query, expert_match, question_id
+                    )
+                )
+                return future
+            context = self.kb.retriever.invoke(query)
+            if not context:
+                future.set_result(
+                    self.document_chain.create_insufficient_response(query, question_id)
+                )
+                return future
+            payload["context"] = context
+
+        request_id = next(self.request_ids)
+        self.futures[request_id] = future
+        self.dispatch(request_id, chain_name, payload)
+        return future
+
+    def collect_results(self) -> None:
+        """Resolves the futures with the results of the workers."""
+        while self._running:
+            try:
+                request_id, slot, result, error = self.results.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            with self._lock:
+                self.workers[slot].pending.pop(request_id, None)
+                self.workers[slot].handled += 1
+            future = self.futures.pop(request_id, None)
+            if future is None:
+                continue
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(error))
+            runtime_stats.increment("serving", "requests")
+
+    def monitor_workers(self) -> None:
+        """Restarts crashed workers and sends their pending requests again once."""
+        while self._running:
+            time.sleep(self.monitor_interval)
+            for slot, worker in enumerate(self.workers):
+                if not self._running or worker.process.is_alive():
+                    continue
+                logger.error(
+                    f"SERVING WORKER {slot} DIED WITH EXIT CODE {worker.process.exitcode}, RESTARTING"
+                )
+                with self._lock:
+                    pending = worker.pending
+                    restarted = self.start_worker(slot)
+                    restarted.handled = worker.handled
+                    restarted.restarts = worker.restarts + 1
+                    self.workers[slot] = restarted
+                runtime_stats.increment("serving", "worker_restarts")
+                for request_id, (chain_name, payload, attempts) in pending.items():
+                    future = self.futures.get(request_id)
+                    if future is None:
+                        continue
+                    if attempts >= 1:
+                        self.futures.pop(request_id, None)
+                        future.set_exception(
+                            RuntimeError(
+                                f"Worker crashed twice on request {request_id}"
+                            )
+                        )
+                        continue
+                    self.dispatch(request_id, chain_name, payload, attempts + 1)
+
+    def stats(self) -> dict:
+        """
+        Reports the workers and their memory.
+
+        Returns:
+            dict: Per worker the PID, handled and pending requests, restarts and memory, and the memory totals.
+        """
+        workers = {}
+        with self._lock:
+            for slot, worker in enumerate(self.workers):
+                workers[slot] = {
+                    "pid": worker.process.pid,
+                    "alive": worker.process.is_alive(),
+                    "handled": worker.handled,
+                    "pending": len(worker.pending),
+                    "restarts": worker.restarts,
+                    **read_memory(worker.process.pid),
+                }
+        dispatcher = read_memory(os.getpid())
+        stats = {
+            "workers": workers,
+            "dispatcher": dispatcher,
+            "total_rss_bytes": dispatcher.get("rss_bytes", 0)
+            + sum(w.get("rss_bytes", 0) for w in workers.values()),
+            "total_pss_bytes": dispatcher.get("pss_bytes", 0)
+            + sum(w.get("pss_bytes", 0) for w in workers.values()),
+        }
+        runtime_stats.set_gauge("serving", "workers", len(workers))
+        runtime_stats.set_gauge("serving", "total_pss_bytes", stats["total_pss_bytes"])
+        return stats
+
+    def close(self) -> None:
+        """Stops the workers and closes the knowledge base."""
+        self._running = False
+        for worker in self.workers:
+            worker.requests.put(None)
+        for worker in self.workers:
+            worker.process.join(timeout=10)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        if self.kb is not None:
+            self.kb.close()
@@ -0,0 +1,350 @@
+import sqlite3
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+from chromadb.api import ClientAPI
+from chromadb.api.models.Collection import Collection
+from langchain_core.documents.base import Document
+
+from application.column_selection import normalize_tokens, term_matches
+from utils.logging_utils import logger
+from utils.runtime_stats import runtime_stats
+
+SOURCE_DATASHEET = "datasheet"
+SOURCE_EXPERT = "expert_answer"
+GENERAL_CATEGORY = "general"
+CATEGORY_COLUMNS = [
+    "Produktkategorie_PK_I",
+    "Produktkategorie_PK_II",
+    "Produktkategorie_PK_III",
+]
+
+
+def get_source_type(metadata: dict) -> str:
+    """Returns the source type of a chunk: an expert answer or a datasheet."""
+    if (metadata or {}).get("keywords") == SOURCE_EXPERT:
+        return SOURCE_EXPERT
+    return SOURCE_DATASHEET
+
+
+class ShardRouter:
+    """Assigns chunks and queries to product categories by the category terms of the lamps table."""
+
+    def __init__(self, category_terms: Dict[str, set]):
+        """
+        Initializes a ShardRouter object.
+
+        Args:
+            category_terms (Dict[str, set]): The normalized terms per product category.
+        """
+        self.category_terms = category_terms
+
+    @classmethod
+    def from_sql_database(cls, path_sql_db: str) -> "ShardRouter":
+        """
+        Creates the router from the product category columns (PK I-III) of the lamps table.
+        The terms of the subcategories are assigned to their main category (PK I).
+
+        Args:
+            path_sql_db (str): The path to the SQLite database file.
+
+        Returns:
+            ShardRouter: The router.
+        """
+        conn = sqlite3.connect(path_sql_db)
+        try:
+            rows = conn.execute(
+                f"SELECT DISTINCT {', '.join(CATEGORY_COLUMNS)} FROM lamps;"
+            ).fetchall()
+        finally:
+            conn.close()
+
+        category_terms = defaultdict(set)
+        for row in rows:
+            if row[0] is None:
+                continue
+            category = "_".join(normalize_tokens(row[0]))[:24].rstrip("_")
+            for value in row:
+                category_terms[category].update(
+                    t for t in normalize_tokens(value or "") if len(t) >= 4
+                )
+        return cls(dict(category_terms))
+
+    def match_categories(self, text: str) -> List[str]:
+        """
+        Returns the categories whose terms occur in the text, the category with most matched terms first.
+
+        Args:
+            text (str): A chunk or a question.
+
+        Returns:
+            List[str]: The matched categories. Empty if the text matches no category.
+        """
+        tokens = set(normalize_tokens(text))
+        counts = {
+            category: sum(
+                any(term_matches(token, term) for token in tokens) for term in terms
+            )
+            for category, terms in self.category_terms.items()
+        }
+        return sorted(
+            [category for category, count in counts.items() if count > 0],
+            key=lambda category: -counts[category],
+        )
+
+    def categorize(self, text: str) -> str:
+        """Returns the category of a chunk, or the general category if it matches none."""
+        categories = self.match_categories(text)
+        return categories[0] if categories else GENERAL_CATEGORY
+
+    def route(self, query: str, shards: Dict[Tuple[str, str], str]) -> List[str]:
+        """
+        Selects the shards to search for a query.
+        A query that names product categories is sent to the shards of these categories and the general shards.
+        Otherwise the router is unsure and all shards are searched.
+
+        Args:
+            query (str): The question of the user.
+            shards (Dict[Tuple[str, str], str]): The collection name per (source type, category).
+
+        Returns:
+            List[str]: The collection names to search.
+        """
+        categories = set(self.match_categories(query))
+        if not categories:
+            return list(shards.values())
+        categories.add(GENERAL_CATEGORY)
+        return [
+            name for (_, category), name in shards.items() if category in categories
+        ]
+
+
+class ShardedIndex:
+    """Splits the chunks of the vector store into collections per source type and product category.
+
+    Each query is routed to the relevant shards, which are searched in parallel with one batched
+    query per shard. Searching small shards keeps the latency flat as the corpus grows.
+    """
+
+    def __init__(
+        self,
+        client: ClientAPI,
+        embed_queries: Callable[[List[str]], List[List[float]]],
+        relevance_score_fn: Callable[[float], float],
+        router: ShardRouter,
+        base_collection_name: str = "technical_documents",
+        collection_metadata: dict = None,
+        max_workers: int = 4,
+    ):
+        """
+        Initializes a ShardedIndex object.
+
+        Args:
+            client (ClientAPI): The Chroma client of the knowledge base.
+            embed_queries (Callable): Function that embeds a list of texts.
+            relevance_score_fn (Callable): Converts a distance to a relevance score.
+            router (ShardRouter): The router of chunks and queries.
+            base_collection_name (str): The prefix of the shard collections. Defaults to "technical_documents".
+            collection_metadata (dict, optional): The metadata of new shards, e.g. the distance function of the
+                unsharded collection, so the relevance scores stay comparable.
+            max_workers (int): The number of shards searched in parallel. Defaults to 4.
+        """
+        self.client = client
+        self.embed_queries = embed_queries
+        self.relevance_score_fn = relevance_score_fn
+        self.router = router
+        self.base_collection_name = base_collection_name
+        self.collection_metadata = {
+            k: v
+            for k, v in (collection_metadata or {}).items()
+            if k.startswith("hnsw:")
+        }
+        self.max_workers = max_workers
+        self.collections: Dict[str, Collection] = {}
+        self.shards: Dict[Tuple[str, str], str] = {}
+        self.load_shards()
+
+    def load_shards(self) -> None:
+        """Finds the existing shard collections of the client."""
+        for collection in self.client.list_collections():
+            metadata = collection.metadata or {}
+            if metadata.get("shard_of") == self.base_collection_name:
+                key = (metadata["shard_source"], metadata["shard_category"])
+                self.shards[key] = collection.name
+                self.collections[collection.name] = collection
+
+    def get_shard(self, source_type: str, category: str) -> Collection:
+        """Returns the collection of the shard and creates it if needed."""
+        key = (source_type, category)
+        if key not in self.shards:
+            name = f"{self.base_collection_name}__{source_type}__{category}"
+            self.collections[name] = self.client.get_or_create_collection(
+                name=name,
+                metadata={
+                    **self.collection_metadata,
+                    "shard_of": self.base_collection_name,
+                    "shard_source": source_type,
+                    "shard_category": category,
+                },
+            )
+            self.shards[key] = name
+        return self.collections[self.shards[key]]
+
+    def add(
+        self,
+        ids: List[str],
+        texts: List[str],
+        metadatas: List[dict],
+        embeddings: List[List[float]],
+    ) -> None:
+        """Upserts embedded chunks into their shards with one call per shard."""
+        batches = defaultdict(lambda: ([], [], [], []))
+        for entry in zip(ids, texts, metadatas, embeddings):
+            source_type = get_source_type(entry[2])
+            category = self.router.categorize(entry[1])
+            for values, value in zip(batches[(source_type, category)], entry):
+                values.append(value)
+        for (source_type, category), (
+            ids,
+            texts,
+            metadatas,
+            embeddings,
+        ) in batches.items():
+            self.get_shard(source_type, category).upsert(
+                ids=ids,
+                documents=texts,
+                metadatas=[metadata or None for metadata in metadatas],
+                embeddings=embeddings,
+            )
+
+    def add_from_collection(
+        self, source_collection: Collection, ids: List[str]
+    ) -> None:
+        """
+        Copies the given chunks of the unsharded collection with their embeddings into the shards, so chunks
+        just added to the vector store are not embedded again.
+
+        Args:
+            source_collection (Collection): The unsharded collection.
+            ids (List[str]): The IDs of the chunks.
+        """
+        if not ids:
+            return
+        data = source_collection.get(
+            ids=ids, include=["documents", "metadatas", "embeddings"]
+        )
+        self.add(data["ids"], data["documents"], data["metadatas"], data["embeddings"])
+
+    def build(self, source_collection: Collection, batch_size: int = 1000) -> dict:
+        """
+        Copies all chunks of the unsharded collection with their embeddings into the shards.
+
+        Args:
+            source_collection (Collection): The unsharded collection.
+            batch_size (int): The number of chunks copied per batch. Defaults to 1000.
+
+        Returns:
+            dict: The number of chunks per shard.
+        """
+        for offset in range(0, source_collection.count(), batch_size):
+            data = source_collection.get(
+                include=["documents", "metadatas", "embeddings"],
+                limit=batch_size,
+                offset=offset,
+            )
+            self.add(
+                data["ids"], data["documents"], data["metadatas"], data["embeddings"]
+            )
+        sizes = {name: self.collections[name].count() for name in self.shards.values()}
+        logger.info(f"SHARDS BUILT: {sizes}")
+        return sizes
+
+    def query_shard(
+        self, name: str, embeddings: List[List[float]], k: int
+    ) -> List[List[Tuple[Document, float]]]:
+        """Searches one shard for several query embeddings."""
+        collection = self.collections[name]
+        results = collection.query(
+            query_embeddings=embeddings,
+            n_results=min(k, collection.count()),
+            include=["documents", "metadatas", "distances"],
+        )
+        scored_docs = []
+        for ids, texts, metadatas, distances in zip(
+            results["ids"],
+            results["documents"],
+            results["metadatas"],
+            results["distances"],
+        ):
+            docs = []
+            for chunk_id, text, metadata, distance in zip(
+                ids, texts, metadatas, distances
+            ):
+                score = self.relevance_score_fn(distance)
+                metadata = {
+                    **(metadata or {}),
+                    "chunk_id": chunk_id,
+                    "relevance_score": score,
+                    "shard": name,
+                }
+                docs.append((Document(page_content=text, metadata=metadata), score))
+            scored_docs.append(docs)
+        return scored_docs
+
+    def search_with_scores(
+        self, queries: List[str], k: int = 3
+    ) -> List[List[Tuple[Document, float]]]:
+        """
+        Searches the routed shards of each query in parallel and merges the results by score.
+
+        Args:
+            queries (List[str]): The queries.
+            k (int): The number of results per query. Defaults to 3.
+
+        Returns:
+            List[List[Tuple[Document, float]]]: Per query the documents and their relevance scores, sorted by descending score.
+        """
+        if not queries:
+            return []
+        start = time.perf_counter()
+        embeddings = self.embed_queries(queries)
+
+        # Queries routed to the same shard are searched with one call.
+        shard_queries = defaultdict(list)
+        for i, query in enumerate(queries):
+            for name in self.router.route(query, self.shards):
+                if self.collections[name].count() > 0:
+                    shard_queries[name].append(i)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                name: executor.submit(
+                    self.query_shard, name, [embeddings[i] for i in indices], k
+                )
+                for name, indices in shard_queries.items()
+            }
+
+        merged = [[] for _ in queries]
+        for name, future in futures.items():
+            for i, scored_docs in zip(shard_queries[name], future.result()):
+                merged[i].extend(scored_docs)
+
+        runtime_stats.increment("retrieval", "sharded_queries", len(queries))
+        runtime_stats.increment(
+            "retrieval",
+            "shard_searches",
+            sum(len(indices) for indices in shard_queries.values()),
+        )
+        runtime_stats.record_event(
+            "retrieval",
+            {
+                "queries": len(queries),
+                "shards": len(shard_queries),
+                "seconds": time.perf_counter() - start,
+            },
+        )
+        return [
+            sorted(scored_docs, key=lambda item: -item[1])[:k] for scored_docs in merged
+        ]
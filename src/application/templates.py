@@ -46,8 +46,7 @@ Question: {question}<|im_end|>
 <|im_start|>assistant"""
 
 
-judge_prompt_template = """ <|im_start|>system
-Please act as an impartial judge and evaluate the quality of the provided answer which attempts to answer the provided question based on a provided context.
+judge_rubric = """Please act as an impartial judge and evaluate the quality of the provided answer which attempts to answer the provided question based on a provided context.
 You'll be given a function grading_function which you'll call for each provided context, question and answer to submit your reasoning and score for the correctness of the answer.
 Please make sure you always call the function to submit result.
 
@@ -71,7 +70,13 @@ Please make sure you always call the function to submit result.
           Die große Auswahl an Formen und smarten Funktionen machen sie ideal für jeden Bedarf. 
           Sparen Sie Kosten, schützen Sie die Umwelt und genießen Sie angenehmes Licht mit SME LED.”
 
-Use the following function for the response:
+"""
+
+judge_prompt_template = (
+    """ <|im_start|>system
+"""
+    + judge_rubric
+    + """Use the following function for the response:
 {schema}
 
 <|im_start|>user
@@ -84,6 +89,32 @@ Provided answer:
 Provided context:
 {context}<|im_end|>
 <|im_start|>assistant"""
+)
+
+judge_batch_prompt_template = (
+    """ <|im_start|>system
+"""
+    + judge_rubric
+    + """You will be given {n_items} numbered items, each with a question, an answer and a context.
+Grade every item independently. Respond with a JSON array that contains one object per item, in the order of the items.
+Each object has the parameters of the following function:
+{schema}
+
+<|im_start|>user
+{items}<|im_end|>
+<|im_start|>assistant"""
+)
+
+judge_batch_item_template = """Item {number}:
+Provided question:
+{question}
+
+Provided answer:
+{answer}
+
+Provided context:
+{context}
+"""
 
 
 ###  Response schemas
@@ -139,7 +170,262 @@ Please provide the correct answer for the question and reply to this mail.
 
 </|human_expert|>"""
 
+insufficient_information_answer = (
+    "Zu Ihrer Frage liegen mir leider keine ausreichenden Informationen vor."
+)
+
 greeting_template = """Willkommen zum ChatBot 🦜. Wie kann ich heute helfen?
 Für Informationen zu einem spezifischen Produkt, geben Sie bitte die Produktnummer an.
 Für allgemeine Informationen, geben Sie bitte Ihre Frage ein.
 Schreibe 'exit' oder 'quit' um das Programm zu beenden."""
+
+product_removed_message = """>>> Das Produkt {product_code} ist nicht mehr in unserem Katalog enthalten.
+Für Informationen zu einem anderen Produkt, geben Sie bitte dessen Produktnummer an.
+"""
+
+### Product columns
+
+# Columns of the lamps table that identify a product. They are always part of the product prompt.
+product_identifier_columns = ["Bestell_Nr", "Bezeichnung_lang", "Bezeichnung_kurz"]
+
+# Synonyms and descriptions of the lamps columns used to select the columns relevant to a question.
+product_column_index = {
+    "Bezeichnung_lang": {
+        "synonyms": ["bezeichnung", "name", "heisst", "produktname"],
+        "description": "Lange Produktbezeichnung",
+    },
+    "eCat_Produktdatenblatt": {
+        "synonyms": ["datenblatt", "datasheet", "ecat", "dokument", "pdf"],
+        "description": "Link zum eCat Produktdatenblatt",
+    },
+    "EU_Verordnung_Produktdatenblatt": {
+        "synonyms": ["datenblatt", "datasheet", "verordnung", "dokument", "pdf"],
+        "description": "Link zum Produktdatenblatt gemäß EU-Verordnung",
+    },
+    "EEL": {
+        "synonyms": [
+            "energieeffizienzklasse",
+            "effizienzklasse",
+            "energieklasse",
+            "eel",
+        ],
+        "description": "Energieeffizienzklasse",
+    },
+    "EEL_Label": {
+        "synonyms": ["energielabel", "label", "etikett"],
+        "description": "Link zum Energieeffizienzlabel",
+    },
+    "Sockel": {
+        "synonyms": ["sockel", "fassung", "gewinde", "e27", "e14", "gu10", "g13"],
+        "description": "Lampensockel",
+    },
+    "Ersatz_fuer": {
+        "synonyms": ["ersatz", "ersetzt", "ersetzen", "austausch", "alternative"],
+        "description": "Ersetzte konventionelle Lampe",
+    },
+    "Leistung": {
+        "synonyms": ["leistung", "watt", "wattzahl", "w"],
+        "description": "Leistung in Watt",
+    },
+    "kWh/1000h": {
+        "synonyms": ["verbrauch", "energieverbrauch", "stromverbrauch", "kwh"],
+        "description": "Energieverbrauch in kWh pro 1000 Stunden",
+    },
+    "Dimmbar": {
+        "synonyms": ["dimmbar", "dimmen", "dimmung", "dimmer"],
+        "description": "Dimmbarkeit",
+    },
+    "Lichtstrom": {
+        "synonyms": ["lichtstrom", "lumen", "lm", "helligkeit", "hell"],
+        "description": "Lichtstrom in Lumen",
+    },
+    "Lichtstaerke": {
+        "synonyms": ["lichtstaerke", "candela", "cd"],
+        "description": "Lichtstärke in Candela",
+    },
+    "Farbtemperatur": {
+        "synonyms": [
+            "farbtemperatur",
+            "kelvin",
+            "lichtfarbe",
+            "warmweiss",
+            "kaltweiss",
+        ],
+        "description": "Farbtemperatur in Kelvin",
+    },
+    "Ra_Wert_Farbwiedergabe": {
+        "synonyms": ["farbwiedergabe", "ra", "cri"],
+        "description": "Farbwiedergabeindex",
+    },
+    "Nutzlebensdauer": {
+        "synonyms": [
+            "lebensdauer",
+            "haltbarkeit",
+            "betriebsstunden",
+            "stunden",
+            "haelt",
+        ],
+        "description": "Nutzlebensdauer in Stunden",
+    },
+    "Abstrahlwinkel": {
+        "synonyms": ["abstrahlwinkel", "winkel", "grad"],
+        "description": "Abstrahlwinkel in Grad",
+    },
+    "Garantie": {
+        "synonyms": ["garantie", "gewaehrleistung"],
+        "description": "Garantie in Jahren",
+    },
+    "Spannung": {
+        "synonyms": ["spannung", "volt", "v"],
+        "description": "Spannung in Volt",
+    },
+    "Betrieb_an": {
+        "synonyms": ["betrieb", "vorschaltgeraet", "evg", "kvg", "vvg"],
+        "description": "Betrieb an Vorschaltgerät oder Netzspannung",
+    },
+    "LEDtube_Laenge_in_mm": {
+        "synonyms": ["laenge", "groesse", "abmessung", "mm"],
+        "description": "Länge der LED-Röhre in Millimeter",
+    },
+    "Menge_Palette": {
+        "synonyms": ["palette", "menge"],
+        "description": "Menge pro Palette",
+    },
+    "Verpackungseinheit_VE": {
+        "synonyms": ["verpackung", "verpackungseinheit", "ve", "stueck"],
+        "description": "Verpackungseinheit",
+    },
+    "Rotierende_Endkappen": {
+        "synonyms": ["endkappen", "rotierend", "drehbar"],
+        "description": "Rotierende Endkappen",
+    },
+    "Ausfuehrung": {
+        "synonyms": ["ausfuehrung", "variante", "oberflaeche"],
+        "description": "Ausführung",
+    },
+    "Topseller": {
+        "synonyms": ["topseller", "bestseller", "beliebt"],
+        "description": "Topseller",
+    },
+    "Neu": {
+        "synonyms": ["neu", "neuheit"],
+        "description": "Neuheit im Sortiment",
+    },
+    "Produktkategorie_PK_I": {
+        "synonyms": ["kategorie", "produktkategorie", "produktart"],
+        "description": "Produktkategorie",
+    },
+    "Produktkategorie_PK_II": {
+        "synonyms": ["kategorie", "produktkategorie", "produktart"],
+        "description": "Produktkategorie",
+    },
+    "Produktkategorie_PK_III": {
+        "synonyms": ["kategorie", "produktkategorie", "produktart"],
+        "description": "Produktkategorie",
+    },
+}
+
+# Common product question intents answered from the precomputed product answer table.
+# An intent is recognized by its synonyms only and answered by its template, or by the ProductChain with
+# its question if a column of the template is empty. The catalog cleaning replaces unknown values ("-") by
+# placeholders, 0 in numeric columns and "nein" in Dimmbar, so these values count as empty as well.
+product_intents = {
+    "name": {
+        "synonyms": ["bezeichnung", "produktname", "heisst", "name"],
+        "columns": ["Bezeichnung_lang"],
+        "question": "Wie lautet die Bezeichnung des Produkts?",
+        "template": "Die Bezeichnung des Produkts lautet {Bezeichnung_lang}.",
+    },
+    "datasheet": {
+        "synonyms": ["datenblatt", "datasheet", "ecat"],
+        "columns": ["eCat_Produktdatenblatt", "EU_Verordnung_Produktdatenblatt"],
+        "question": "Wo finde ich das Datenblatt des Produkts?",
+        "template": "Das Datenblatt von {Bezeichnung_lang} finden Sie hier: {eCat_Produktdatenblatt}. Das Produktdatenblatt gemäß EU-Verordnung: {EU_Verordnung_Produktdatenblatt}",
+    },
+    "energy_label": {
+        "synonyms": [
+            "energielabel",
+            "energieeffizienzlabel",
+            "label",
+            "etikett",
+        ],
+        "columns": ["EEL_Label"],
+        "question": "Wo finde ich das Energielabel des Produkts?",
+        "template": "Das Energieeffizienzlabel von {Bezeichnung_lang} finden Sie hier: {EEL_Label}",
+    },
+    "energy_class": {
+        "synonyms": [
+            "energieeffizienzklasse",
+            "effizienzklasse",
+            "energieklasse",
+            "eel",
+        ],
+        "columns": ["EEL"],
+        "question": "Welche Energieeffizienzklasse hat das Produkt?",
+        "template": "{Bezeichnung_lang} hat die Energieeffizienzklasse {EEL}.",
+    },
+    "wattage": {
+        "synonyms": ["leistung", "watt"],
+        "columns": ["Leistung"],
+        "placeholders": [0],
+        "question": "Welche Leistung hat das Produkt?",
+        "template": "{Bezeichnung_lang} hat eine Leistung von {Leistung} W.",
+    },
+    "consumption": {
+        "synonyms": ["verbrauch", "kwh"],
+        "columns": ["kWh/1000h"],
+        "placeholders": [0],
+        "question": "Wie hoch ist der Energieverbrauch des Produkts?",
+        "template": "{Bezeichnung_lang} verbraucht {kWh/1000h} kWh pro 1000 Stunden.",
+    },
+    "dimmable": {
+        "synonyms": ["dimmbar", "dimmen", "dimmung", "dimmer"],
+        "columns": ["Dimmbar"],
+        "placeholders": ["nein"],
+        "question": "Ist das Produkt dimmbar?",
+        "value_templates": {
+            "ja": "Ja, {Bezeichnung_lang} ist dimmbar.",
+        },
+    },
+    "luminous_flux": {
+        "synonyms": ["lichtstrom", "lumen", "helligkeit"],
+        "columns": ["Lichtstrom"],
+        "placeholders": [0],
+        "question": "Welchen Lichtstrom hat das Produkt?",
+        "template": "{Bezeichnung_lang} hat einen Lichtstrom von {Lichtstrom} lm.",
+    },
+    "color_temperature": {
+        "synonyms": ["farbtemperatur", "kelvin", "lichtfarbe"],
+        "columns": ["Farbtemperatur"],
+        "placeholders": [0],
+        "question": "Welche Farbtemperatur hat das Produkt?",
+        "template": "{Bezeichnung_lang} hat eine Farbtemperatur von {Farbtemperatur} K.",
+    },
+    "lifetime": {
+        "synonyms": ["lebensdauer", "haltbarkeit", "betriebsstunden", "haelt"],
+        "columns": ["Nutzlebensdauer"],
+        "placeholders": [0],
+        "question": "Wie lange ist die Lebensdauer des Produkts?",
+        "template": "{Bezeichnung_lang} hat eine Nutzlebensdauer von {Nutzlebensdauer} Stunden.",
+    },
+    "warranty": {
+        "synonyms": ["garantie", "gewaehrleistung"],
+        "columns": ["Garantie"],
+        "placeholders": [0],
+        "question": "Wie lange ist die Garantie des Produkts?",
+        "template": "Auf {Bezeichnung_lang} gibt es {Garantie} Jahre Garantie.",
+    },
+    "beam_angle": {
+        "synonyms": ["abstrahlwinkel", "ausstrahlwinkel"],
+        "columns": ["Abstrahlwinkel"],
+        "placeholders": [0],
+        "question": "Welchen Abstrahlwinkel hat das Produkt?",
+        "template": "{Bezeichnung_lang} hat einen Abstrahlwinkel von {Abstrahlwinkel} Grad.",
+    },
+    "voltage": {
+        "synonyms": ["spannung", "volt"],
+        "columns": ["Spannung"],
+        "question": "Mit welcher Spannung wird das Produkt betrieben?",
+        "template": "{Bezeichnung_lang} wird mit {Spannung} V betrieben.",
+    },
+}
@@ -0,0 +1,268 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator, List
+
+from langchain_community.embeddings import HuggingFaceEmbeddings
+
+from application.chains import DocumentChain, Judge, ProductChain
+from application.chatbot import ChatBot
+from application.knowledge_base import KnowledgeBase
+from application.models import ModelRegistry
+from utils.logging_utils import logger
+from utils.runtime_stats import runtime_stats
+
+
+@dataclass
+class TenantConfig:
+    """The data locations of one customer."""
+
+    path_kb: str
+    use_shards: bool = False
+
+    @property
+    def path_sql_db(self) -> str:
+        return self.path_kb + "/sqlite_db.db"
+
+    @property
+    def path_vector_store(self) -> str:
+        return self.path_kb + "/chroma_db"
+
+    @property
+    def path_email_storage(self) -> str:
+        return self.path_kb + "/email_storage"
+
+
+@dataclass
+class TenantState:
+    """The opened knowledge base and chat bot of a tenant and the number of its active leases."""
+
+    knowledge_base: KnowledgeBase
+    bot: ChatBot
+    opened_at: float
+    last_used: float
+    memory_bytes: int = 0
+    leases: int = 0
+
+
+class TenantManager:
+    """Opens the knowledge bases of several customers lazily and shares the models between them.
+
+    The embedding model and the LLMs of the model registry are loaded once. The knowledge bases of
+    idle tenants are closed least recently used first when the open tenants exceed the memory budget.
+    A tenant is idle while no lease is held on it: requests and chat sessions use its chat bot or knowledge
+    base within lease (or between acquire and release), so they are never closed while in use.
+    """
+
+    def __init__(
+        self,
+        embedding_model: HuggingFaceEmbeddings,
+        models: ModelRegistry,
+        tenants: Dict[str, TenantConfig],
+        memory_budget_mb: float = 2048,
+        max_open: int = None,
+    ):
+        """
+        Initializes a TenantManager object.
+
+        Args:
+            embedding_model (HuggingFaceEmbeddings): The embedding model shared by all tenants.
+            models (ModelRegistry): The LLMs shared by all tenants.
+            tenants (Dict[str, TenantConfig]): The configuration per tenant ID.
+            memory_budget_mb (float): The estimated memory all open knowledge bases may use. Defaults to 2048.
+            max_open (int, optional): The maximum number of open tenants. Defaults to no limit.
+        """
+        self.embedding_model = embedding_model
+        self.models = models
+        self.tenants = tenants
+        self.memory_budget_bytes = memory_budget_mb * 1024**2
+        self.max_open = max_open
+        self.open_tenants: "OrderedDict[str, TenantState]" = OrderedDict()
+        self.usage: Dict[str, Dict[str, float]] = {
+            tenant_id: {"requests": 0, "opens": 0, "evictions": 0}
+            for tenant_id in tenants
+        }
+        self._lock = threading.RLock()
+
+    def open_tenant(self, tenant_id: str) -> TenantState:
+        """Opens the knowledge base of a tenant and creates its chat bot with the shared models."""
+        config = self.tenants[tenant_id]
+        kb = KnowledgeBase(
+            path_sql_db=config.path_sql_db,
+            path_vector_store=config.path_vector_store,
+            path_email_storage=config.path_email_storage,
+            embedding_model=self.embedding_model,
+            use_shards=config.use_shards,
+        )
+        bot = ChatBot(
+            llm=self.models.lazy("DocumentChain"),
+            knowledge_base=kb,
+            document_chain=DocumentChain(
+                retriever=kb.retriever,
+                llm=self.models.lazy("DocumentChain"),
+                expert_index=kb.expert_index,
+            ),
+            product_chain=ProductChain(
+                llm=self.models.lazy("ProductChain"),
+                answer_table=kb.product_answers,
+            ),
+            judge=Judge(llm=self.models.lazy("Judge")),
+        )
+        now = time.time()
+        state = TenantState(
+            knowledge_base=kb,
+            bot=bot,
+            opened_at=now,
+            last_used=now,
+            memory_bytes=kb.memory_usage()["total_bytes"],
+        )
+        self.usage[tenant_id]["opens"] += 1
+        logger.info(f"TENANT {tenant_id} OPENED")
+        return state
+
+    def get(self, tenant_id: str) -> TenantState:
+        """
+        Returns the opened state of a tenant and opens it if needed. Without a lease, the tenant may be
+        closed once another tenant is opened.
+
+        Args:
+            tenant_id (str): The ID of the tenant.
+
+        Returns:
+            TenantState: The knowledge base and chat bot of the tenant.
+        """
+        if tenant_id not in self.tenants:
+            raise KeyError(f"Unknown tenant: {tenant_id}")
+        with self._lock:
+            opened = tenant_id not in self.open_tenants
+            if opened:
+                self.open_tenants[tenant_id] = self.open_tenant(tenant_id)
+            state = self.open_tenants[tenant_id]
+            self.open_tenants.move_to_end(tenant_id)
+            state.last_used = time.time()
+            self.usage[tenant_id]["requests"] += 1
+            # The memory only grows when a tenant is opened, so the budget is checked then.
+            if opened:
+                self.evict(keep=tenant_id)
+        return state
+
+    def acquire(self, tenant_id: str) -> TenantState:
+        """
+        Returns the opened state of a tenant and holds a lease on it, so it is not evicted until released.
+
+        Args:
+            tenant_id (str): The ID of the tenant.
+
+        Returns:
+            TenantState: The knowledge base and chat bot of the tenant.
+        """
+        with self._lock:
+            state = self.get(tenant_id)
+            state.leases += 1
+        return state
+
+    def release(self, tenant_id: str) -> None:
+        """Releases a lease of acquire. Once a tenant is idle, the budget is checked again."""
+        with self._lock:
+            state = self.open_tenants.get(tenant_id)
+            if state is None or state.leases == 0:
+                raise ValueError(f"No lease held on tenant: {tenant_id}")
+            state.leases -= 1
+            state.last_used = time.time()
+            if state.leases == 0:
+                self.evict()
+
+    @contextmanager
+    def lease(self, tenant_id: str) -> Iterator[TenantState]:
+        """Holds a lease on a tenant for the enclosed request or chat session, see acquire."""
+        state = self.acquire(tenant_id)
+        try:
+            yield state
+        finally:
+            self.release(tenant_id)
+
+    def get_knowledge_base(self, tenant_id: str) -> KnowledgeBase:
+        """Returns the knowledge base of a tenant without a lease, see lease for longer use."""
+        return self.get(tenant_id).knowledge_base
+
+    def get_bot(self, tenant_id: str) -> ChatBot:
+        """Returns the chat bot of a tenant without a lease, see lease for longer use."""
+        return self.get(tenant_id).bot
+
+    def open_memory_bytes(self) -> int:
+        """Returns the estimated memory of all open tenants."""
+        return sum(state.memory_bytes for state in self.open_tenants.values())
+
+    def evict(self, keep: str = None) -> List[str]:
+        """
+        Closes the least recently used idle tenants while the memory budget or the maximum number of open
+        tenants is exceeded. Tenants with active leases are kept, even if the budget stays exceeded.
+
+        Args:
+            keep (str, optional): A tenant that is never evicted, e.g. the one being requested.
+
+        Returns:
+            List[str]: The IDs of the evicted tenants.
+        """
+        evicted = []
+        with self._lock:
+            for state in self.open_tenants.values():
+                state.memory_bytes = state.knowledge_base.memory_usage()["total_bytes"]
+            for tenant_id in list(self.open_tenants):
+                over_budget = self.open_memory_bytes() > self.memory_budget_bytes
+                over_count = (
+                    self.max_open is not None and len(self.open_tenants) > self.max_open
+                )
+                if not (over_budget or over_count):
+                    break
+                if tenant_id == keep or self.open_tenants[tenant_id].leases:
+                    continue
+                self.close_tenant(tenant_id)
+                self.usage[tenant_id]["evictions"] += 1
+                evicted.append(tenant_id)
+        if evicted:
+            logger.info(f"TENANTS EVICTED: {evicted}")
+        self.report()
+        return evicted
+
+    def close_tenant(self, tenant_id: str) -> None:
+        """Closes the knowledge base of a tenant."""
+        with self._lock:
+            state = self.open_tenants.pop(tenant_id, None)
+            if state is not None:
+                state.knowledge_base.close()
+                logger.info(f"TENANT {tenant_id} CLOSED")
+
+    def close(self) -> None:
+        """Closes all open tenants."""
+        with self._lock:
+            for tenant_id in list(self.open_tenants):
+                self.close_tenant(tenant_id)
+
+    def report(self) -> Dict[str, dict]:
+        """
+        Reports the resource usage per tenant and publishes it as gauges of the "tenants" runtime stats.
+
+        Returns:
+            Dict[str, dict]: Per tenant ID whether it is open, its estimated memory, active leases, requests,
+                opens and evictions.
+        """
+        with self._lock:
+            report = {}
+            for tenant_id in self.tenants:
+                state = self.open_tenants.get(tenant_id)
+                report[tenant_id] = {
+                    "open": state is not None,
+                    "memory_bytes": state.memory_bytes if state else 0,
+                    "last_used": state.last_used if state else None,
+                    "leases": state.leases if state else 0,
+                    **self.usage[tenant_id],
+                }
+                runtime_stats.set_gauge("tenants", tenant_id, report[tenant_id])
+            runtime_stats.set_gauge("tenants", "open_tenants", len(self.open_tenants))
+            runtime_stats.set_gauge(
+                "tenants", "open_memory_bytes", self.open_memory_bytes()
+            )
+        return report
@@ -0,0 +1 @@
+# Puts src on the import path of the tests, so they import the packages like the application does.
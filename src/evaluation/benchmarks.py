@@ -0,0 +1,571 @@
+import copy
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import wait
+from pprint import pformat
+
+import pandas as pd
+from application.chains import DocumentChain, Judge, log_result
+from application.column_selection import ColumnSelector, normalize_tokens
+from application.generation import parse_json_output
+from application.models import ROUTING_PROFILES, setup_embeddings
+from application.serving import ServingPool
+from langchain_core.runnables import RunnablePassthrough
+from tqdm import tqdm
+from utils.logging_utils import logger
+
+
+def get_questions(qa_pair_dataset: pd.DataFrame) -> list:
+    """Returns the questions of a generated ("question") or curated ("questions") QA pair dataset."""
+    column = "questions" if "questions" in qa_pair_dataset.columns else "question"
+    return qa_pair_dataset[column].tolist()
+
+
+class DecodingBenchmark:
+    """Compares the decoding speed of plain and prompt-lookup speculative decoding on the QA dataset."""
+
+    def __init__(self, chain, qa_pair_dataset: pd.DataFrame):
+        """
+        Initializes a DecodingBenchmark object.
+
+        Args:
+            chain (Chain): The chain to benchmark, e.g. a DocumentChain.
+            qa_pair_dataset (pd.DataFrame): The QA pair dataset with the questions.
+        """
+        self.chain = chain
+        self.qa_pair_dataset = qa_pair_dataset
+        self.results: pd.DataFrame = None
+
+    def run(self, sets: int = None) -> pd.DataFrame:
+        """
+        Answers every question with and without speculative decoding.
+
+        The modes are interleaved per question, so both see the same prompt cache state.
+
+        Args:
+            sets (int, optional): The number of questions to use. Defaults to all questions.
+
+        Returns:
+            pd.DataFrame: One row per question and mode with the generation report.
+        """
+        questions = get_questions(self.qa_pair_dataset)[:sets]
+        initial_mode = self.chain.generator.config.speculative
+        rows = []
+        try:
+            for question in tqdm(questions, desc="Benchmarking decoding"):
+                for speculative in (False, True):
+                    self.chain.generator.config.speculative = speculative
+                    self.chain.question_id = uuid.uuid4().hex
+                    self.chain.execute(question)
+                    report = self.chain.generator.last_report
+                    rows.append(
+                        {
+                            "question": question,
+                            "mode": "speculative" if speculative else "plain",
+                            "speculative_active": report.speculative,
+                            "tokens": report.tokens_generated,
+                            "seconds": report.seconds,
+                            "first_token_seconds": report.first_token_seconds,
+                            "decode_tokens_per_second": report.decode_tokens_per_second,
+                        }
+                    )
+        finally:
+            self.chain.generator.config.speculative = initial_mode
+
+        self.results = pd.DataFrame(rows)
+        return self.results
+
+    def summary(self) -> pd.DataFrame:
+        """
+        Summarizes the benchmark results per decoding mode.
+
+        Returns:
+            pd.DataFrame: Mean and median decode tokens/sec per mode and the speedup over plain decoding.
+        """
+        summary = self.results.groupby("mode").agg(
+            mean_tokens_per_second=("decode_tokens_per_second", "mean"),
+            median_tokens_per_second=("decode_tokens_per_second", "median"),
+            mean_seconds=("seconds", "mean"),
+            mean_tokens=("tokens", "mean"),
+        )
+        summary["speedup"] = (
+            summary["mean_tokens_per_second"]
+            / summary.loc["plain", "mean_tokens_per_second"]
+        )
+        logger.info(f"DECODING BENCHMARK:\n{summary}")
+        return summary
+
+
+class RoutingBenchmark:
+    """Compares routing profiles of a ModelRegistry on end-to-end latency and judge agreement."""
+
+    def __init__(self, registry, retriever, qa_pair_dataset: pd.DataFrame):
+        """
+        Initializes a RoutingBenchmark object.
+
+        Args:
+            registry (ModelRegistry): The registry with the models of all profiles.
+            retriever (BaseRetriever): The retriever of the knowledge base.
+            qa_pair_dataset (pd.DataFrame): The QA pair dataset with the questions.
+        """
+        self.registry = registry
+        self.retriever = retriever
+        self.qa_pair_dataset = qa_pair_dataset
+        self.results: pd.DataFrame = None
+
+    def run_profile(self, profile: str, questions: list) -> list:
+        """Answers and judges the questions with the given routing profile."""
+        self.registry.use_profile(profile)
+        document_chain = DocumentChain(
+            retriever=self.retriever, llm=self.registry.lazy("DocumentChain")
+        )
+        judge = Judge(llm=self.registry.lazy("Judge"))
+        judge.label = "evaluation"
+
+        rows = []
+        for question in tqdm(questions, desc=f"Benchmarking profile {profile}"):
+            start = time.perf_counter()
+            document_chain.question_id = uuid.uuid4().hex
+            output = document_chain.execute(question)
+            answered = time.perf_counter()
+            judged = judge.execute(output) if output else None
+            end = time.perf_counter()
+            correctness = judged.get("correctness", None) if judged else None
+            rows.append(
+                {
+                    "profile": profile,
+                    "question": question,
+                    "chain_seconds": answered - start,
+                    "judge_seconds": end - answered,
+                    "total_seconds": end - start,
+                    "correctness": correctness,
+                    "send_to_expert": correctness is None or correctness < 3,
+                }
+            )
+        return rows
+
+    def run(
+        self, profiles: list = None, reference: str = "single", sets: int = None
+    ) -> pd.DataFrame:
+        """
+        Runs the benchmark for each routing profile.
+
+        Args:
+            profiles (list, optional): The routing profiles. Defaults to all profiles in ROUTING_PROFILES.
+            reference (str): The profile the judge agreement is measured against. Defaults to "single".
+            sets (int, optional): The number of questions to use. Defaults to all questions.
+
+        Returns:
+            pd.DataFrame: One row per question and profile.
+        """
+        profiles = profiles or list(ROUTING_PROFILES)
+        if reference not in profiles:
+            profiles = [reference, *profiles]
+        initial_routes = self.registry.routes
+        questions = get_questions(self.qa_pair_dataset)[:sets]
+
+        rows = []
+        try:
+            for profile in profiles:
+                rows.extend(self.run_profile(profile, questions))
+        finally:
+            self.registry.routes = initial_routes
+
+        results = pd.DataFrame(rows)
+        reference_results = results[results["profile"] == reference].set_index(
+            "question"
+        )
+        results["score_agreement"] = results.apply(
+            lambda row: row["correctness"]
+            == reference_results.loc[row["question"], "correctness"],
+            axis=1,
+        )
+        results["decision_agreement"] = results.apply(
+            lambda row: row["send_to_expert"]
+            == reference_results.loc[row["question"], "send_to_expert"],
+            axis=1,
+        )
+        self.results = results
+        return self.results
+
+    def summary(self) -> pd.DataFrame:
+        """
+        Summarizes the benchmark results per routing profile.
+
+        Returns:
+            pd.DataFrame: Latency percentiles and judge agreement per profile.
+        """
+        grouped = self.results.groupby("profile")
+        summary = grouped.agg(
+            mean_seconds=("total_seconds", "mean"),
+            mean_judge_seconds=("judge_seconds", "mean"),
+            score_agreement=("score_agreement", "mean"),
+            decision_agreement=("decision_agreement", "mean"),
+        )
+        summary["p50_seconds"] = grouped["total_seconds"].quantile(0.5)
+        summary["p95_seconds"] = grouped["total_seconds"].quantile(0.95)
+        logger.info(f"ROUTING BENCHMARK:\n{summary}")
+        return summary
+
+
+class ColumnPruningBenchmark:
+    """Compares ProductChain prompts with all product columns and with the selected columns only."""
+
+    def __init__(self, product_chain, knowledge_base, product_questions: pd.DataFrame):
+        """
+        Initializes a ColumnPruningBenchmark object.
+
+        Args:
+            product_chain (ProductChain): The product chain to benchmark.
+            knowledge_base (KnowledgeBase): The knowledge base with the product database.
+            product_questions (pd.DataFrame): The questions with the columns "product_code" and "question".
+        """
+        self.product_chain = product_chain
+        self.kb = knowledge_base
+        self.product_questions = product_questions
+        self.results: pd.DataFrame = None
+
+    def prompt_tokens(self, question: str, context: dict) -> int:
+        """Returns the number of prompt tokens for the given question and product context."""
+        prompt = self.product_chain.prompt.format(question=question, context=context)
+        return self.product_chain.llm.get_num_tokens(prompt)
+
+    def answer(self, question: str, product_info: dict, selector) -> dict:
+        """Answers the question with the given column selector."""
+        self.product_chain.column_selector = selector
+        self.product_chain.question_id = uuid.uuid4().hex
+        return self.product_chain.execute(query=question, product_info=product_info)
+
+    def run(self, generate_answers: bool = True) -> pd.DataFrame:
+        """
+        Measures the prompt tokens and, optionally, the answer agreement for every question.
+
+        Args:
+            generate_answers (bool): Whether the answers are generated to measure the agreement. Defaults to True.
+
+        Returns:
+            pd.DataFrame: One row per question.
+        """
+        # Restored afterwards, the answers switch the selector of the chain.
+        original_selector = self.product_chain.column_selector
+        selector = original_selector or ColumnSelector()
+        rows = []
+        try:
+            for _, row in tqdm(
+                self.product_questions.iterrows(),
+                total=len(self.product_questions),
+                desc="Benchmarking column pruning",
+            ):
+                product_info = self.kb.execute_sql_query(
+                    product_code=row["product_code"]
+                )
+                pruned_info = selector.select(row["question"], product_info)
+                result = {
+                    "product_code": row["product_code"],
+                    "question": row["question"],
+                    "columns_full": len(product_info),
+                    "columns_pruned": len(pruned_info),
+                    "tokens_full": self.prompt_tokens(row["question"], product_info),
+                    "tokens_pruned": self.prompt_tokens(row["question"], pruned_info),
+                }
+                if generate_answers:
+                    full = self.answer(row["question"], product_info, None)
+                    pruned = self.answer(row["question"], product_info, selector)
+                    result["answer_full"] = full["answer"]
+                    result["answer_pruned"] = pruned["answer"]
+                    result["answer_agreement"] = answer_overlap(
+                        full["answer"], pruned["answer"]
+                    )
+                    result["solved_agreement"] = (
+                        str(full["solved"]).lower() == str(pruned["solved"]).lower()
+                    )
+                rows.append(result)
+        finally:
+            self.product_chain.column_selector = original_selector
+
+        self.results = pd.DataFrame(rows)
+        self.results["token_reduction"] = 1 - (
+            self.results["tokens_pruned"] / self.results["tokens_full"]
+        )
+        return self.results
+
+    def summary(self) -> pd.Series:
+        """
+        Summarizes the prompt token reduction and the answer agreement.
+
+        Returns:
+            pd.Series: The mean values over all questions.
+        """
+        columns = ["tokens_full", "tokens_pruned", "token_reduction"]
+        columns += [
+            c for c in ("answer_agreement", "solved_agreement") if c in self.results
+        ]
+        summary = self.results[columns].mean()
+        logger.info(f"COLUMN PRUNING BENCHMARK:\n{summary}")
+        return summary
+
+
+class BatchJudgeBenchmark:
+    """Compares batched judging with single-item judging on the same chain outputs."""
+
+    def __init__(self, judge: Judge, llm_outputs: list):
+        """
+        Initializes a BatchJudgeBenchmark object.
+
+        Args:
+            judge (Judge): The judge to benchmark.
+            llm_outputs (list): The outputs of a DocumentChain, e.g. generated by LLMAnswerGenerator without judge.
+        """
+        self.judge = judge
+        self.llm_outputs = llm_outputs
+        self.results: pd.DataFrame = None
+        self.seconds: dict = {}
+
+    def run(self, max_batch_size: int = 8) -> pd.DataFrame:
+        """
+        Judges all outputs one by one and in batches.
+
+        Args:
+            max_batch_size (int): The maximum number of outputs per batch. Defaults to 8.
+
+        Returns:
+            pd.DataFrame: The single and batch correctness score per output.
+        """
+        self.judge.label = "evaluation"
+        # The judge replaces the context of the outputs, so every mode gets its own copy.
+        start = time.perf_counter()
+        single = [
+            self.judge.execute(output)
+            for output in tqdm(copy.deepcopy(self.llm_outputs), desc="Single judging")
+        ]
+        self.seconds["single"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batch = self.judge.judge_batch(
+            copy.deepcopy(self.llm_outputs), max_batch_size=max_batch_size
+        )
+        self.seconds["batch"] = time.perf_counter() - start
+
+        self.results = pd.DataFrame(
+            {
+                "question": [output["question"] for output in self.llm_outputs],
+                "single_correctness": [
+                    (output or {}).get("correctness") for output in single
+                ],
+                "batch_correctness": [
+                    (output or {}).get("correctness") for output in batch
+                ],
+            }
+        )
+        return self.results
+
+    def summary(self) -> pd.Series:
+        """
+        Summarizes the score agreement and the judge wall time of both modes.
+
+        Returns:
+            pd.Series: The agreement rates, the mean absolute score difference and the wall times.
+        """
+        scored = self.results.dropna(subset=["single_correctness", "batch_correctness"])
+        single = scored["single_correctness"].astype(int)
+        batch = scored["batch_correctness"].astype(int)
+        summary = pd.Series(
+            {
+                "scored_outputs": len(scored),
+                "exact_agreement": (single == batch).mean(),
+                "within_one_agreement": ((single - batch).abs() <= 1).mean(),
+                "expert_decision_agreement": ((single < 3) == (batch < 3)).mean(),
+                "mean_absolute_difference": (single - batch).abs().mean(),
+                "single_seconds": self.seconds["single"],
+                "batch_seconds": self.seconds["batch"],
+                "speedup": self.seconds["single"] / self.seconds["batch"],
+            }
+        )
+        logger.info(f"BATCH JUDGE BENCHMARK:\n{summary}")
+        return summary
+
+
+class RequestPathBenchmark:
+    """Measures the allocations and CPU time of the per-request path of the DocumentChain around the LLM call.
+
+    The legacy path builds the chain graph per request, copies every retrieved document with doc.dict(),
+    rebuilds the sorted result dictionary and logs it pformatted. The current path uses the prebuilt graph and
+    a ChainResult that references the documents, serialized only at the edges, and logs a summary of it.
+    Both paths log through the configured logger, so the cost of its sinks is included.
+    """
+
+    def __init__(self, document_chain: DocumentChain, qa_pair_dataset: pd.DataFrame):
+        """
+        Initializes a RequestPathBenchmark object.
+
+        Args:
+            document_chain (DocumentChain): The chain, its retriever provides the documents of the questions.
+            qa_pair_dataset (pd.DataFrame): The QA pair dataset with the questions.
+        """
+        self.chain = document_chain
+        self.qa_pair_dataset = qa_pair_dataset
+        self.llm_output = '{"answer": "Die Lampe ist dimmbar und hat eine Lebensdauer von 25000 Stunden."}'
+        self.results: pd.DataFrame = None
+
+    def legacy_request(self, question: str, docs: list) -> dict:
+        """The per-request work of the chain before the prebuilt graphs and typed results."""
+        RunnablePassthrough.assign(
+            context=(lambda x: self.chain.concat_docs(x["context"]))
+        ) | self.chain.prompt | self.chain.generator
+        output = {"context": [doc.dict() for doc in docs], "question": question}
+        output["question_type"] = "DOCUMENT"
+        output["answer"] = parse_json_output(self.llm_output)["answer"]
+        output["question_id"] = "Dbenchmark"
+        key_order = [
+            "question_id",
+            "question_type",
+            "solved",
+            "question",
+            "answer",
+            "context",
+        ]
+        output = {k: output.get(k, None) for k in key_order}
+        logger.info(f"RESULT:\n{pformat(output, sort_dicts=False)}")
+        return output
+
+    def current_request(self, question: str, docs: list):
+        """The per-request work of the current chain, including the logging of the result summary."""
+        result = self.chain.convert_llm_output(
+            {"context": docs, "question": question, "llm_output": self.llm_output},
+            "benchmark",
+        )
+        log_result(result)
+        return result
+
+    def measure(self, request, requests: list, repeats: int) -> dict:
+        """Runs the requests and measures the retained and peak allocations and the CPU time per request."""
+        # The results are kept, as the chat history and the evaluation keep them.
+        kept = []
+        n_requests = len(requests) * repeats
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        start = time.process_time()
+        for _ in range(repeats):
+            for question, docs in requests:
+                kept.append(request(question, docs))
+        cpu_seconds = time.process_time() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {
+            "retained_bytes_per_request": (current - before) / n_requests,
+            "peak_bytes": peak - before,
+            # The CPU time includes the tracing overhead, it is only comparable between the paths.
+            "cpu_us_per_request": cpu_seconds / n_requests * 1e6,
+        }
+
+    def run(self, repeats: int = 20) -> pd.DataFrame:
+        """
+        Measures both paths on the retrieved documents of the questions.
+
+        Args:
+            repeats (int): The number of times every question is processed. Defaults to 20.
+
+        Returns:
+            pd.DataFrame: The measurements per path and the reduction of the current path.
+        """
+        requests = [
+            (question, self.chain.retriever.invoke(question))
+            for question in tqdm(
+                get_questions(self.qa_pair_dataset), desc="Retrieving contexts"
+            )
+        ]
+        rows = {
+            "legacy": self.measure(self.legacy_request, requests, repeats),
+            "current": self.measure(self.current_request, requests, repeats),
+        }
+        self.results = pd.DataFrame(rows).T
+        self.results.loc["reduction"] = 1 - (
+            self.results.loc["current"] / self.results.loc["legacy"]
+        )
+        logger.info(f"REQUEST PATH BENCHMARK:\n{self.results}")
+        return self.results
+
+
+class ServingBenchmark:
+    """Measures the throughput and memory of the ServingPool for an increasing number of workers."""
+
+    def __init__(
+        self, path_kb: str, qa_pair_dataset: pd.DataFrame, embedding_model=None
+    ):
+        """
+        Initializes a ServingBenchmark object.
+
+        Args:
+            path_kb (str): The knowledge base directory.
+            qa_pair_dataset (pd.DataFrame): The QA pair dataset with the questions.
+            embedding_model (HuggingFaceEmbeddings, optional): The embedding model shared by all runs.
+        """
+        self.path_kb = path_kb
+        self.qa_pair_dataset = qa_pair_dataset
+        self.embedding_model = embedding_model or setup_embeddings()
+        self.results: pd.DataFrame = None
+
+    def run_workers(self, n_workers: int, questions: list) -> dict:
+        """Answers all questions concurrently with the given number of workers."""
+        pool = ServingPool(
+            self.path_kb, n_workers=n_workers, embedding_model=self.embedding_model
+        ).start()
+        try:
+            # One request per worker loads the models before the measurement.
+            wait(
+                [
+                    pool.submit("DocumentChain", query=question)
+                    for question in questions[:n_workers]
+                ]
+            )
+            start = time.perf_counter()
+            futures = [
+                pool.submit("DocumentChain", query=question) for question in questions
+            ]
+            wait(futures)
+            seconds = time.perf_counter() - start
+            stats = pool.stats()
+        finally:
+            pool.close()
+        return {
+            "workers": n_workers,
+            "questions": len(questions),
+            "failed": sum(future.exception() is not None for future in futures),
+            "seconds": seconds,
+            "questions_per_second": len(questions) / seconds,
+            "total_rss_mb": stats["total_rss_bytes"] / 1024**2,
+            "total_pss_mb": stats["total_pss_bytes"] / 1024**2,
+        }
+
+    def run(self, worker_counts: tuple = (1, 2, 4), sets: int = None) -> pd.DataFrame:
+        """
+        Runs the questions with every number of workers.
+
+        Args:
+            worker_counts (tuple): The numbers of workers. Defaults to (1, 2, 4).
+            sets (int, optional): The number of questions to use. Defaults to all questions.
+
+        Returns:
+            pd.DataFrame: Throughput, memory and the scaling over one worker per number of workers.
+        """
+        questions = get_questions(self.qa_pair_dataset)[:sets]
+        rows = [self.run_workers(n, questions) for n in worker_counts]
+        self.results = pd.DataFrame(rows).set_index("workers")
+        baseline = self.results["questions_per_second"].iloc[0]
+        self.results["speedup"] = self.results["questions_per_second"] / baseline
+        self.results["scaling_efficiency"] = self.results["speedup"] / (
+            self.results.index / self.results.index[0]
+        )
+        logger.info(f"SERVING BENCHMARK:\n{self.results}")
+        return self.results
+
+
+def answer_overlap(answer_a: str, answer_b: str) -> float:
+    """Returns the Jaccard similarity of the normalized tokens of two answers."""
+    tokens_a = set(normalize_tokens(answer_a or ""))
+    tokens_b = set(normalize_tokens(answer_b or ""))
+    if not tokens_a and not tokens_b:
+        return 1.0
+    return len(tokens_a & tokens_b) / len(tokens_a | tokens_b)
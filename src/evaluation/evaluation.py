@@ -1,6 +1,6 @@
 import datetime
-import json
 import random
+import time
 
 import pandas as pd
 from evaluation.eval_templates import (
@@ -9,9 +9,16 @@ from evaluation.eval_templates import (
     bing_chat_template,
     bing_chat_response_schema,
 )
+from application.results import page_content
+from application.generation import (
+    GenerationController,
+    get_generation_config,
+    parse_json_output,
+)
 from langchain.output_parsers import StructuredOutputParser
 from langchain.prompts import PromptTemplate
 from langchain_community.llms import LlamaCpp
+from application.models import LazyModel, ModelRegistry
 from langchain_community.embeddings import HuggingFaceEmbeddings
 from tqdm import tqdm
 from utils.logging_utils import logger
@@ -42,15 +49,23 @@ METRIC_MAP = {
 
 class QAPairDatasetGenerator:
     """Class to generate a QA pair dataset for evaluation of the application.
-    The dataset is generated by prompting a LLM."""
+    The dataset is generated by prompting a LLM, by default the model routed to the generator.
+    """
 
-    def __init__(self, vector_store: Chroma, llm: LlamaCpp):
+    def __init__(
+        self, vector_store: Chroma, llm: LlamaCpp = None, models: ModelRegistry = None
+    ):
         self.vector_store = vector_store
-        self.llm = llm
+        self.llm = llm or (models or ModelRegistry()).lazy(self.__class__.__name__)
         self.response_schema = qa_response_schema
         self.prompt_template = qa_generation_prompt
         self.parser = self.create_parser()
         self.prompt = self.create_prompt()
+        self.generator = GenerationController(
+            llm=self.llm,
+            config=get_generation_config(self.__class__.__name__),
+            chain_name=self.__class__.__name__,
+        )
         self.dataset = None
 
     def create_parser(self) -> StructuredOutputParser:
@@ -115,7 +130,7 @@ class QAPairDatasetGenerator:
         """
         logger.info(f"Generating {sets} QA couples.".upper())
 
-        chain = self.prompt | self.llm
+        chain = self.prompt | self.generator
         sampled_documents = random.sample(document_list, sets)
 
         # Generates list of dicts with context, context_id, question, and answer
@@ -144,11 +159,7 @@ class QAPairDatasetGenerator:
                 - 'answer': The generated answer.
         """
         output_QA_couple = chain.invoke({"context": sampled_context})
-        output_QA_couple = (
-            json.loads(output_QA_couple)
-            if isinstance(output_QA_couple, str)
-            else output_QA_couple
-        )
+        output_QA_couple = parse_json_output(output_QA_couple)
         output_QA_couple = {k.lower(): v for k, v in output_QA_couple.items()}
 
         answer_key = "antwort" if "antwort" in output_QA_couple else "answer"
@@ -178,11 +189,19 @@ class QAPairDatasetGenerator:
 class LLMAnswerGenerator:
     """Generates answers to a given set of questions using a LLM chain."""
 
-    def __init__(self, chain, qa_pair_dataset: pd.DataFrame = None, judge=None):
+    def __init__(
+        self,
+        chain,
+        qa_pair_dataset: pd.DataFrame = None,
+        judge=None,
+        batch_judge: bool = False,
+    ):
         self.chain = chain
         self.judge = judge
+        self.batch_judge = batch_judge
         self.qa_pair_dataset = qa_pair_dataset
         self.eval_dataset: Dataset = None
+        self.judge_seconds: float = 0.0
 
     def execute_chain(self, question: str) -> dict:
         """
@@ -196,7 +215,12 @@ class LLMAnswerGenerator:
         """
         self.chain.question_id = uuid.uuid4().hex
         chain_output = self.chain.execute(question)
-        return self.judge.execute(chain_output) if self.judge else chain_output
+        if self.judge is None or self.batch_judge:
+            return chain_output
+        start = time.perf_counter()
+        judged_output = self.judge.execute(chain_output)
+        self.judge_seconds += time.perf_counter() - start
+        return judged_output
 
     def generate_contexts(self, llm_outputs: dict) -> list:
         """
@@ -210,13 +234,10 @@ class LLMAnswerGenerator:
             list: A list of generated contexts.
 
         """
-        if self.judge:
-            return [output["context"] for output in llm_outputs]
-        else:
-            return [
-                [item["page_content"] for item in output["context"]]
-                for output in llm_outputs
-            ]
+        # The judge replaces the documents by their page content, expert answers keep their documents.
+        return [
+            [page_content(item) for item in output["context"]] for output in llm_outputs
+        ]
 
     def generate_outputs(self) -> Dataset:
         """
@@ -230,10 +251,17 @@ class LLMAnswerGenerator:
 
         questions = self.qa_pair_dataset["questions"].tolist()
         ground_truths = self.qa_pair_dataset["ground_truth"].tolist()
+        self.judge_seconds = 0.0
         llm_outputs = [
             self.execute_chain(question)
             for question in tqdm(questions, desc="Generating LLM answers")
         ]
+        if self.judge and self.batch_judge:
+            start = time.perf_counter()
+            llm_outputs = self.judge.judge_batch(llm_outputs)
+            self.judge_seconds = time.perf_counter() - start
+        if self.judge:
+            logger.info(f"JUDGE WALL TIME: {self.judge_seconds:.1f}s")
 
         contexts = self.generate_contexts(llm_outputs)
         # Dict of lists for each key.
@@ -250,10 +278,14 @@ class LLMAnswerGenerator:
             ]
             data["send_to_expert"] = [
                 (
-                    1
-                    if output.get("correctness", None) is None
-                    or output["correctness"] < 3
-                    else 0
+                    0
+                    if output["question_type"] == "EXPERT"
+                    else (
+                        1
+                        if output.get("correctness", None) is None
+                        or output["correctness"] < 3
+                        else 0
+                    )
                 )
                 for output in llm_outputs
             ]
@@ -271,10 +303,16 @@ class LLMAnswerGenerator:
 
 
 class Evaluator:
-    """Evaluator class to evaluate the LLM outputs on RAGAS metrics."""
-
-    def __init__(self, llm: LlamaCpp, embedding_model: HuggingFaceEmbeddings):
-        self.llm = llm
+    """Evaluator class to evaluate the LLM outputs on RAGAS metrics.
+    By default, the metrics are computed with the model routed to the evaluator."""
+
+    def __init__(
+        self,
+        embedding_model: HuggingFaceEmbeddings,
+        llm: LlamaCpp = None,
+        models: ModelRegistry = None,
+    ):
+        self.llm = llm or (models or ModelRegistry()).lazy(self.__class__.__name__)
         self.embedding_model = embedding_model
         self.eval_dataset = None
         self.result_data = None
@@ -321,7 +359,8 @@ class Evaluator:
         self.result_data = evaluate(
             dataset=self.eval_dataset,
             metrics=selected_metrics,
-            llm=self.llm,
+            # RAGAS checks the type of the model, the routed model is loaded here.
+            llm=self.llm.resolve() if isinstance(self.llm, LazyModel) else self.llm,
             embeddings=self.embedding_model,
         )
         return self.result_data.to_pandas()
@@ -0,0 +1,248 @@
+import argparse
+import itertools
+import os
+import shutil
+import tempfile
+import time
+from typing import List
+
+import numpy as np
+import pandas as pd
+from chromadb import PersistentClient
+from chromadb.api.client import SharedSystemClient
+from chromadb.api.models.Collection import Collection
+
+from application.knowledge_base import KnowledgeBase
+from application.models import setup_embeddings
+from evaluation.retrieval import get_question_column
+from utils.logging_utils import logger
+
+DEFAULT_HNSW_GRID = {
+    "space": ["cosine", "l2"],
+    "M": [8, 16, 32],
+    "construction_ef": [100, 200],
+    "search_ef": [10, 50, 100],
+}
+
+
+def hnsw_metadata(config: dict) -> dict:
+    """Converts a tuning configuration to the HNSW metadata of a Chroma collection."""
+    return {f"hnsw:{key}": value for key, value in config.items()}
+
+
+def copy_collection(
+    source: Collection, target: Collection, batch_size: int = 1000
+) -> None:
+    """Copies the chunks of a collection with their embeddings into another collection."""
+    for offset in range(0, source.count(), batch_size):
+        data = source.get(
+            include=["documents", "metadatas", "embeddings"],
+            limit=batch_size,
+            offset=offset,
+        )
+        target.add(
+            ids=data["ids"],
+            documents=data["documents"],
+            metadatas=data["metadatas"],
+            embeddings=data["embeddings"],
+        )
+
+
+def directory_size(path: str) -> int:
+    """Returns the size of all files in a directory in bytes."""
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(path)
+        for name in files
+    )
+
+
+class HnswTuner:
+    """Tunes the HNSW settings of the technical documents collection on the generated QA questions.
+
+    Each configuration of the grid is built offline in a temporary Chroma store and compared with an
+    exact brute-force search on recall@k, query latency, build time and disk size. The chosen
+    configuration is written back by rebuilding the collection of the knowledge base.
+    """
+
+    def __init__(
+        self, knowledge_base: KnowledgeBase, qa_pair_dataset: pd.DataFrame, k: int = 5
+    ):
+        """
+        Initializes a HnswTuner object.
+
+        Args:
+            knowledge_base (KnowledgeBase): The knowledge base to tune.
+            qa_pair_dataset (pd.DataFrame): The generated QA pair dataset with the questions.
+            k (int): The number of results the recall is measured on. Defaults to 5.
+        """
+        self.kb = knowledge_base
+        self.qa_pair_dataset = qa_pair_dataset
+        self.k = k
+        self.results: pd.DataFrame = None
+
+        data = self.kb.vector_store._collection.get(include=["embeddings"])
+        self.ids = np.array(data["ids"])
+        self.embeddings = np.asarray(data["embeddings"], dtype=np.float32)
+        questions = qa_pair_dataset[get_question_column(qa_pair_dataset)].tolist()
+        self.query_embeddings = np.asarray(
+            self.kb.embed_queries(questions), dtype=np.float32
+        )
+
+    def exact_neighbors(self, space: str) -> List[set]:
+        """Returns the exact top-k chunk IDs of every question in the given distance space."""
+        if space == "l2":
+            distances = (
+                (self.query_embeddings**2).sum(axis=1, keepdims=True)
+                - 2 * self.query_embeddings @ self.embeddings.T
+                + (self.embeddings**2).sum(axis=1)
+            )
+        elif space == "cosine":
+            queries = self.query_embeddings / np.linalg.norm(
+                self.query_embeddings, axis=1, keepdims=True
+            )
+            docs = self.embeddings / np.linalg.norm(
+                self.embeddings, axis=1, keepdims=True
+            )
+            distances = 1 - queries @ docs.T
+        elif space == "ip":
+            distances = 1 - self.query_embeddings @ self.embeddings.T
+        else:
+            raise ValueError(f"Unknown distance space: {space}")
+        k = min(self.k, len(self.ids))
+        top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        return [set(self.ids[row]) for row in top]
+
+    def evaluate_config(self, config: dict, exact: List[set]) -> dict:
+        """Builds the configuration in a temporary store and measures it."""
+        path = tempfile.mkdtemp(prefix="hnsw_tuning_")
+        client = PersistentClient(path)
+        try:
+            start = time.perf_counter()
+            collection = client.create_collection(
+                name="tuning", metadata=hnsw_metadata(config)
+            )
+            for offset in range(0, len(self.ids), 1000):
+                collection.add(
+                    ids=self.ids[offset : offset + 1000].tolist(),
+                    embeddings=self.embeddings[offset : offset + 1000].tolist(),
+                )
+            build_seconds = time.perf_counter() - start
+
+            latencies, recalls = [], []
+            for query_embedding, exact_ids in zip(self.query_embeddings, exact):
+                start = time.perf_counter()
+                result = collection.query(
+                    query_embeddings=[query_embedding.tolist()],
+                    n_results=self.k,
+                    include=[],
+                )
+                latencies.append(time.perf_counter() - start)
+                recalls.append(len(exact_ids & set(result["ids"][0])) / len(exact_ids))
+
+            # The index files are complete on disk once the system is stopped.
+            client._system.stop()
+            SharedSystemClient._identifer_to_system.pop(client._identifier, None)
+            disk_bytes = directory_size(path)
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+        return {
+            **config,
+            f"recall@{self.k}": float(np.mean(recalls)),
+            "latency_p50_ms": float(np.percentile(latencies, 50) * 1000),
+            "latency_p95_ms": float(np.percentile(latencies, 95) * 1000),
+            "build_seconds": build_seconds,
+            "disk_mb": disk_bytes / 1024**2,
+        }
+
+    def tune(self, grid: dict = None, min_recall: float = 0.99) -> dict:
+        """
+        Evaluates every configuration of the grid and chooses the fastest one with enough recall.
+
+        Args:
+            grid (dict, optional): The values per HNSW setting. Defaults to DEFAULT_HNSW_GRID.
+            min_recall (float): The minimum recall@k of the chosen configuration. Defaults to 0.99.
+
+        Returns:
+            dict: The chosen configuration. The configuration with the highest recall if none is good enough.
+        """
+        grid = grid or DEFAULT_HNSW_GRID
+        exact = {space: self.exact_neighbors(space) for space in grid["space"]}
+        rows = []
+        for values in itertools.product(*grid.values()):
+            config = dict(zip(grid.keys(), values))
+            rows.append(self.evaluate_config(config, exact[config["space"]]))
+            logger.info(f"HNSW CONFIG EVALUATED: {rows[-1]}")
+        self.results = pd.DataFrame(rows)
+
+        recall = f"recall@{self.k}"
+        candidates = self.results[self.results[recall] >= min_recall]
+        if candidates.empty:
+            best = self.results.sort_values(
+                [recall, "latency_p95_ms"], ascending=[False, True]
+            ).iloc[0]
+        else:
+            best = candidates.sort_values(["latency_p95_ms", "disk_mb"]).iloc[0]
+        chosen = {key: best[key] for key in grid}
+        chosen = {
+            key: value.item() if hasattr(value, "item") else value
+            for key, value in chosen.items()
+        }
+        logger.info(f"RECOMMENDED HNSW CONFIG: {chosen}\n{self.results}")
+        return chosen
+
+    def apply_config(self, config: dict) -> None:
+        """
+        Rebuilds the collection of the knowledge base with the given HNSW configuration.
+        The collection is copied with its embeddings and renamed, and existing shards are rebuilt.
+
+        Args:
+            config (dict): The HNSW configuration, e.g. the result of tune.
+        """
+        client = self.kb.vector_store._client
+        source = self.kb.vector_store._collection
+        name = source.name
+        target = client.create_collection(
+            name=f"{name}__rebuild", metadata=hnsw_metadata(config)
+        )
+        copy_collection(source, target)
+        client.delete_collection(name)
+        target.modify(name=name)
+
+        for collection in client.list_collections():
+            if (collection.metadata or {}).get("shard_of") == name:
+                client.delete_collection(collection.name)
+
+        self.kb.vector_store = self.kb.setup_vector_store()
+        if self.kb.shard_index is not None:
+            self.kb.shard_index = self.kb.setup_shard_index()
+        logger.info(f"COLLECTION {name} REBUILT WITH {hnsw_metadata(config)}")
+
+
+def main():
+    """Tunes the HNSW settings of a knowledge base from the command line."""
+    parser = argparse.ArgumentParser(description=HnswTuner.__doc__)
+    parser.add_argument("--path-kb", required=True, help="Knowledge base directory.")
+    parser.add_argument("--qa-dataset", required=True, help="QA pair dataset (csv).")
+    parser.add_argument("--k", type=int, default=5, help="Recall@k.")
+    parser.add_argument("--min-recall", type=float, default=0.99)
+    parser.add_argument(
+        "--apply", action="store_true", help="Write the chosen config back."
+    )
+    args = parser.parse_args()
+
+    kb = KnowledgeBase(
+        path_sql_db=args.path_kb + "/sqlite_db.db",
+        path_vector_store=args.path_kb + "/chroma_db",
+        path_email_storage=args.path_kb + "/email_storage",
+        embedding_model=setup_embeddings(),
+    )
+    tuner = HnswTuner(kb, pd.read_csv(args.qa_dataset), k=args.k)
+    config = tuner.tune(min_recall=args.min_recall)
+    if args.apply:
+        tuner.apply_config(config)
+
+
+if __name__ == "__main__":
+    main()
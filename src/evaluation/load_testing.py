@@ -0,0 +1,493 @@
+import argparse
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+
+from application.chains import DocumentChain, Judge, ProductChain
+from application.knowledge_base import KnowledgeBase
+from application.memory import MemoryAccountant, memory_profiler
+from application.models import ROUTING_PROFILES, setup_embeddings, setup_model_registry
+from evaluation.retrieval import get_question_column
+from utils.logging_utils import logger
+
+QUESTION_TYPES = ("DOCUMENT", "PRODUCT")
+
+
+class FakeLLM(LLM):
+    """LLM with the latency profile of a local model and valid JSON answers for every chain.
+
+    The prefill time grows with the prompt length, the decode time with the generated tokens.
+    Like a single LlamaCpp instance, it generates for max_concurrency requests at a time.
+    """
+
+    prefill_seconds_per_token: float = 0.002
+    decode_seconds_per_token: float = 0.05
+    max_concurrency: int = 1
+    n_ctx: int = 4096
+    semaphore: Any = None
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.semaphore = threading.Semaphore(self.max_concurrency)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def get_num_tokens(self, text: str) -> int:
+        """Estimates the number of tokens without a tokenizer."""
+        return int(len(text.split()) * 1.3) + 1
+
+    def create_output(self, prompt: str) -> str:
+        """Creates a JSON answer that matches the schema of the chain of the prompt."""
+        if "grading_function" in prompt:
+            if "JSON array" in prompt:
+                n_items = prompt.count("Provided question:")
+                item = '{"reasoning_for_correctness": "Die Antwort ist korrekt.", "correctness": 4}'
+                return "[" + ", ".join([item] * n_items) + "]"
+            return '{"reasoning_for_correctness": "Die Antwort beantwortet die Frage korrekt.", "correctness": 4}'
+        if "Product information" in prompt:
+            return '{"question": "Frage", "answer": "Die Leistung der Lampe betraegt 12 W.", "solved": true}'
+        return '{"answer": "Laut Datenblatt ist die Lampe dimmbar und hat eine Lebensdauer von 25000 Stunden."}'
+
+    def _stream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[GenerationChunk]:
+        output = self.create_output(prompt)
+        # About four characters per token.
+        tokens = [output[i : i + 4] for i in range(0, len(output), 4)]
+        tokens = tokens[: kwargs.get("max_tokens", len(tokens))]
+        with self.semaphore:
+            time.sleep(self.get_num_tokens(prompt) * self.prefill_seconds_per_token)
+            for token in tokens:
+                time.sleep(self.decode_seconds_per_token)
+                if run_manager:
+                    run_manager.on_llm_new_token(token)
+                yield GenerationChunk(text=token)
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        return "".join(
+            chunk.text for chunk in self._stream(prompt, stop, run_manager, **kwargs)
+        )
+
+
+@dataclass
+class LoadRequest:
+    """A user session: a document question, or a product code with one or more product questions."""
+
+    question_type: str
+    questions: List[str]
+    product_code: Optional[int] = None
+
+
+@dataclass
+class LoadResult:
+    """The measurement of one question."""
+
+    question_type: str
+    scheduled_at: float
+    latency: float = None
+    ttft: float = None
+    error: Optional[str] = None
+    queue_seconds: float = 0.0
+    stop_reason: Optional[str] = field(default=None)
+
+
+def load_qa_requests(qa_pair_dataset: pd.DataFrame) -> List[LoadRequest]:
+    """Creates document requests from the questions of a QA pair dataset."""
+    column = get_question_column(qa_pair_dataset)
+    return [
+        LoadRequest("DOCUMENT", [question])
+        for question in qa_pair_dataset[column].dropna().tolist()
+    ]
+
+
+def load_product_requests(product_questions: pd.DataFrame) -> List[LoadRequest]:
+    """Creates product requests from a dataset with the columns "product_code" and "question", one session per code."""
+    return [
+        LoadRequest("PRODUCT", group["question"].tolist(), int(product_code))
+        for product_code, group in product_questions.groupby("product_code")
+    ]
+
+
+def load_log_requests(path_log: str) -> List[LoadRequest]:
+    """
+    Extracts the chat sessions from the application log. A numeric user input opens a product session,
+    whose product questions are logged by the ProductChain; other user inputs are document questions.
+
+    Args:
+        path_log (str): The path to the log file.
+
+    Returns:
+        List[LoadRequest]: The requests in the order of the log.
+    """
+    user_input = re.compile(r"USER INPUT: (.*)$")
+    product_query = re.compile(r"EXECUTING ProductChain WITH QUERY: (.*)$")
+    requests, session = [], None
+    with open(path_log, "r") as file:
+        for line in file:
+            if match := user_input.search(line):
+                query = match.group(1).strip()
+                if query in ("", "exit", "quit"):
+                    continue
+                if query.isdigit():
+                    session = LoadRequest("PRODUCT", [], int(query))
+                    requests.append(session)
+                else:
+                    requests.append(LoadRequest("DOCUMENT", [query]))
+            elif (match := product_query.search(line)) and session is not None:
+                session.questions.append(match.group(1).strip())
+    return [request for request in requests if request.questions]
+
+
+class ChatPipeline:
+    """The non-interactive chat pipeline: chain and judge per question, as in ChatBot."""
+
+    def __init__(
+        self,
+        knowledge_base: KnowledgeBase,
+        document_chain: DocumentChain,
+        product_chain: ProductChain,
+        judge: Judge,
+    ):
+        self.kb = knowledge_base
+        self.document_chain = document_chain
+        self.product_chain = product_chain
+        self.judge = judge
+        # The evaluation label keeps the judge from asking for user input.
+        self.judge.label = "evaluation"
+
+    def answer(self, question_type: str, question: str, product_info: dict) -> tuple:
+        """
+        Answers and judges a question.
+
+        Returns:
+            tuple: The output of the judge and the generation report of the answering chain.
+        """
+        if question_type == "DOCUMENT":
+            chain = self.document_chain
+            chain.question_id = f"load{time.perf_counter_ns()}"
+            output = chain.execute(query=question)
+        else:
+            chain = self.product_chain
+            chain.question_id = f"load{time.perf_counter_ns()}"
+            output = chain.execute(query=question, product_info=product_info)
+        report = chain.generator.last_report
+        chain.generator.last_report = None
+        answered_at = time.perf_counter()
+        self.judge.execute(output)
+        memory_profiler.end_request()
+        return answered_at, report
+
+
+class LoadGenerator:
+    """Replays questions against the chat pipeline with open-loop arrivals and reports latency percentiles.
+
+    Sessions arrive independently of the completion of earlier sessions (Poisson or constant rate),
+    so queueing under overload shows up in the latency. Product sessions ask their questions one
+    after another with think times in between.
+    """
+
+    def __init__(
+        self,
+        pipeline_factory: Callable[[], ChatPipeline],
+        workers: int = 4,
+        seed: int = 42,
+    ):
+        """
+        Initializes a LoadGenerator object.
+
+        Args:
+            pipeline_factory (Callable[[], ChatPipeline]): Creates the pipeline of a worker thread. The chains
+                keep per-request state, so every worker gets its own. With a real LlamaCpp model shared by the
+                pipelines, use one worker, since the model generates one answer at a time.
+            workers (int): The number of sessions served at the same time. Defaults to 4.
+            seed (int): The seed of the arrivals, the request mix and the think times. Defaults to 42.
+        """
+        self.pipeline_factory = pipeline_factory
+        self.workers = workers
+        self.rng = random.Random(seed)
+        self.local = threading.local()
+        self.results: List[LoadResult] = []
+        self._lock = threading.Lock()
+        self.duration: float = None
+
+    def get_pipeline(self) -> ChatPipeline:
+        if not hasattr(self.local, "pipeline"):
+            self.local.pipeline = self.pipeline_factory()
+        return self.local.pipeline
+
+    def schedule(
+        self,
+        document_requests: List[LoadRequest],
+        product_requests: List[LoadRequest],
+        qps: float,
+        duration: float,
+        product_share: float = 0.3,
+        arrival: str = "poisson",
+    ) -> List[tuple]:
+        """
+        Creates the arrival times and requests of a run.
+
+        Args:
+            document_requests (List[LoadRequest]): The document requests to sample from.
+            product_requests (List[LoadRequest]): The product requests to sample from.
+            qps (float): The target rate of arriving sessions per second.
+            duration (float): The length of the arrival window in seconds.
+            product_share (float): The share of product sessions. Defaults to 0.3.
+            arrival (str): "poisson" or "constant" inter-arrival times. Defaults to "poisson".
+
+        Returns:
+            List[tuple]: The arrival offset in seconds and the request per session.
+        """
+        if not product_requests:
+            product_share = 0.0
+        if not document_requests:
+            product_share = 1.0
+        schedule, offset = [], 0.0
+        while True:
+            offset += self.rng.expovariate(qps) if arrival == "poisson" else 1 / qps
+            if offset > duration:
+                return schedule
+            pool = (
+                product_requests
+                if self.rng.random() < product_share
+                else document_requests
+            )
+            schedule.append((offset, self.rng.choice(pool)))
+
+    def run_session(
+        self, request: LoadRequest, scheduled_at: float, think_time: float
+    ) -> None:
+        """Runs the questions of a session and records one result per question."""
+        pipeline = self.get_pipeline()
+        product_info = None
+        for turn, question in enumerate(request.questions):
+            if turn > 0 and think_time:
+                time.sleep(self.rng.expovariate(1 / think_time))
+            # The first question is measured from its scheduled arrival, so the queueing time counts.
+            start = scheduled_at if turn == 0 else time.perf_counter()
+            result = LoadResult(
+                request.question_type,
+                scheduled_at=start,
+                queue_seconds=time.perf_counter() - start,
+            )
+            try:
+                if request.question_type == "PRODUCT" and product_info is None:
+                    product_info = pipeline.kb.execute_sql_query(request.product_code)
+                answered_at, report = pipeline.answer(
+                    request.question_type, question, product_info
+                )
+                result.latency = time.perf_counter() - start
+                if report is not None and report.first_token_seconds is not None:
+                    decode_seconds = report.seconds - report.first_token_seconds
+                    result.ttft = answered_at - start - decode_seconds
+                    result.stop_reason = report.stop_reason
+                else:
+                    # Answered without generation (expert answer or no relevant context).
+                    result.ttft = answered_at - start
+            except Exception as e:
+                result.latency = time.perf_counter() - start
+                result.error = f"{e.__class__.__name__}: {e}"
+            with self._lock:
+                self.results.append(result)
+
+    def run(
+        self,
+        document_requests: List[LoadRequest],
+        product_requests: List[LoadRequest] = None,
+        qps: float = 0.5,
+        duration: float = 60,
+        product_share: float = 0.3,
+        arrival: str = "poisson",
+        think_time: float = 5.0,
+    ) -> pd.DataFrame:
+        """
+        Replays the requests with open-loop arrivals and waits for all sessions to finish.
+
+        Args:
+            document_requests (List[LoadRequest]): The document requests, e.g. from load_qa_requests or load_log_requests.
+            product_requests (List[LoadRequest], optional): The product requests.
+            qps (float): The target rate of arriving sessions per second. Defaults to 0.5.
+            duration (float): The length of the arrival window in seconds. Defaults to 60.
+            product_share (float): The share of product sessions. Defaults to 0.3.
+            arrival (str): "poisson" or "constant" inter-arrival times. Defaults to "poisson".
+            think_time (float): The mean think time between the questions of a session in seconds. Defaults to 5.0.
+
+        Returns:
+            pd.DataFrame: The report per question type, see report.
+        """
+        schedule = self.schedule(
+            document_requests,
+            product_requests or [],
+            qps,
+            duration,
+            product_share,
+            arrival,
+        )
+        logger.info(f"LOAD TEST WITH {len(schedule)} SESSIONS AT {qps} QPS")
+        self.results = []
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for offset, request in schedule:
+                delay = start + offset - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(self.run_session, request, start + offset, think_time)
+        self.duration = time.perf_counter() - start
+        return self.report()
+
+    def report(self) -> pd.DataFrame:
+        """
+        Summarizes the results per question type and overall.
+
+        Returns:
+            pd.DataFrame: Questions, error rate, throughput and p50/p95/p99 latency and time-to-first-token.
+        """
+        data = pd.DataFrame([result.__dict__ for result in self.results])
+        rows = {}
+        groups = [(t, data[data["question_type"] == t]) for t in QUESTION_TYPES]
+        for name, group in groups + [("ALL", data)]:
+            if group.empty:
+                continue
+            succeeded = group[group["error"].isna()]
+            row = {
+                "questions": len(group),
+                "error_rate": 1 - len(succeeded) / len(group),
+                "throughput_qps": len(succeeded) / self.duration,
+            }
+            for metric in ("latency", "ttft"):
+                values = succeeded[metric].dropna()
+                for percentile in (50, 95, 99):
+                    row[f"{metric}_p{percentile}"] = (
+                        float(np.percentile(values, percentile))
+                        if not values.empty
+                        else np.nan
+                    )
+            row["mean_queue_seconds"] = group["queue_seconds"].mean()
+            rows[name] = row
+        report = pd.DataFrame(rows).T
+        logger.info(f"LOAD TEST REPORT:\n{report}")
+        return report
+
+
+def main():
+    """Runs a load test against the chat pipeline of a knowledge base from the command line."""
+    parser = argparse.ArgumentParser(description=LoadGenerator.__doc__)
+    parser.add_argument("--path-kb", required=True, help="Knowledge base directory.")
+    parser.add_argument("--qa-dataset", help="QA pair dataset (csv).")
+    parser.add_argument("--product-questions", help="Product questions (csv).")
+    parser.add_argument("--log", help="Application log to replay.")
+    parser.add_argument("--qps", type=float, default=0.5)
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--product-share", type=float, default=0.3)
+    parser.add_argument("--arrival", choices=["poisson", "constant"], default="poisson")
+    parser.add_argument("--think-time", type=float, default=5.0)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Concurrent requests. Generations of a shared LlamaCpp model run one at a time.",
+    )
+    parser.add_argument(
+        "--fake-llm", action="store_true", help="Use FakeLLM instead of LlamaCpp."
+    )
+    parser.add_argument(
+        "--routing-profile",
+        choices=list(ROUTING_PROFILES),
+        default="single",
+        help="Routing profile of the models.",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="Sample the allocations per request stage and report the memory by component.",
+    )
+    args = parser.parse_args()
+    if args.profile_memory:
+        memory_profiler.enable()
+
+    if args.fake_llm:
+        embedding_model = setup_embeddings()
+        fake_llm = FakeLLM()
+        llms = {name: fake_llm for name in ("DocumentChain", "ProductChain", "Judge")}
+        models = None
+    else:
+        embedding_model, models = setup_model_registry(args.routing_profile)
+        llms = {
+            name: models.lazy(name)
+            for name in ("DocumentChain", "ProductChain", "Judge")
+        }
+    kb = KnowledgeBase(
+        path_sql_db=args.path_kb + "/sqlite_db.db",
+        path_vector_store=args.path_kb + "/chroma_db",
+        path_email_storage=args.path_kb + "/email_storage",
+        embedding_model=embedding_model,
+    )
+
+    def pipeline_factory() -> ChatPipeline:
+        return ChatPipeline(
+            knowledge_base=kb,
+            document_chain=DocumentChain(
+                retriever=kb.retriever,
+                llm=llms["DocumentChain"],
+                expert_index=kb.expert_index,
+            ),
+            product_chain=ProductChain(
+                llm=llms["ProductChain"], answer_table=kb.product_answers
+            ),
+            judge=Judge(llm=llms["Judge"]),
+        )
+
+    document_requests = []
+    product_requests = []
+    if args.qa_dataset:
+        document_requests += load_qa_requests(pd.read_csv(args.qa_dataset))
+    if args.product_questions:
+        product_requests += load_product_requests(pd.read_csv(args.product_questions))
+    if args.log:
+        for request in load_log_requests(args.log):
+            pool = (
+                product_requests
+                if request.question_type == "PRODUCT"
+                else document_requests
+            )
+            pool.append(request)
+
+    LoadGenerator(pipeline_factory, workers=args.workers).run(
+        document_requests,
+        product_requests,
+        qps=args.qps,
+        duration=args.duration,
+        product_share=args.product_share,
+        arrival=args.arrival,
+        think_time=args.think_time,
+    )
+    if args.profile_memory:
+        MemoryAccountant(
+            models=models, embeddings=embedding_model, knowledge_bases=lambda: [kb]
+        ).report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+import time
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from application.expert_index import number_tokens
+from application.knowledge_base import KnowledgeBase
+from application.retrievers import ScoredRetriever
+from utils.logging_utils import logger
+
+
+def get_question_column(dataset: pd.DataFrame) -> str:
+    """Returns the question column of a generated ("question") or curated ("questions") QA pair dataset."""
+    return "questions" if "questions" in dataset.columns else "question"
+
+
+class ThresholdTuner:
+    """Tunes the relevance threshold of the ScoredRetriever on the generated QA pair dataset.
+
+    Every QA question was generated from a known chunk (context_id), so it should clear the threshold.
+    Optional off-topic questions should not clear it and are short-circuited before the LLM.
+    """
+
+    def __init__(
+        self,
+        knowledge_base: KnowledgeBase,
+        qa_pair_dataset: pd.DataFrame,
+        off_topic_questions: list = None,
+    ):
+        """
+        Initializes a ThresholdTuner object.
+
+        Args:
+            knowledge_base (KnowledgeBase): The knowledge base to search.
+            qa_pair_dataset (pd.DataFrame): The generated QA pair dataset with the columns "question" and "context_id".
+            off_topic_questions (list, optional): Questions that can not be answered from the knowledge base.
+        """
+        self.kb = knowledge_base
+        self.qa_pair_dataset = qa_pair_dataset
+        self.off_topic_questions = off_topic_questions or []
+        self.results: pd.DataFrame = None
+
+    def evaluate_threshold(
+        self, retriever: ScoredRetriever, qa_results: list, off_topic_results: list
+    ) -> dict:
+        """Evaluates the retriever settings on the precomputed search results."""
+        context_ids = self.qa_pair_dataset["context_id"].tolist()
+        selected = [retriever.select(result) for result in qa_results]
+        hits = [
+            context_id in [doc.metadata["chunk_id"] for doc in docs]
+            for context_id, docs in zip(context_ids, selected)
+        ]
+        off_topic_selected = [retriever.select(result) for result in off_topic_results]
+        return {
+            "score_threshold": retriever.score_threshold,
+            "answered_rate": np.mean([bool(docs) for docs in selected]),
+            "source_recall": np.mean(hits),
+            "mean_k": np.mean([len(docs) for docs in selected]),
+            "off_topic_rejection": (
+                np.mean([not docs for docs in off_topic_selected])
+                if off_topic_selected
+                else np.nan
+            ),
+        }
+
+    def tune(
+        self,
+        thresholds: list = None,
+        min_answered_rate: float = 0.95,
+        save: bool = False,
+    ) -> float:
+        """
+        Evaluates a grid of thresholds and returns the highest threshold that still answers enough QA questions.
+
+        Args:
+            thresholds (list, optional): The thresholds to evaluate. Defaults to 0.50 to 0.95 in steps of 0.01.
+            min_answered_rate (float): The minimum share of QA questions that must not be short-circuited. Defaults to 0.95.
+            save (bool): Whether the threshold is saved with the knowledge base, so its retrievers use it.
+                Defaults to False.
+
+        Returns:
+            float: The recommended threshold.
+        """
+        thresholds = (
+            thresholds if thresholds is not None else np.arange(0.5, 0.96, 0.01)
+        )
+        retriever = self.kb.retriever
+        questions = self.qa_pair_dataset[
+            get_question_column(self.qa_pair_dataset)
+        ].tolist()
+
+        # One batched search per question set, the thresholds are applied afterwards.
+        qa_results = self.kb.search_with_scores(questions, k=retriever.max_k)
+        off_topic_results = self.kb.search_with_scores(
+            self.off_topic_questions, k=retriever.max_k
+        )
+
+        rows = [
+            self.evaluate_threshold(
+                retriever.copy(update={"score_threshold": float(threshold)}),
+                qa_results,
+                off_topic_results,
+            )
+            for threshold in thresholds
+        ]
+        self.results = pd.DataFrame(rows)
+
+        candidates = self.results[self.results["answered_rate"] >= min_answered_rate]
+        best = (
+            candidates["score_threshold"].max()
+            if not candidates.empty
+            else self.results["score_threshold"].min()
+        )
+        logger.info(f"RECOMMENDED SCORE THRESHOLD: {best:.2f}")
+        if save:
+            self.kb.save_retriever_settings(score_threshold=float(best))
+            self.kb.retriever = self.kb.create_retriever()
+        return best
+
+
+class ExpertThresholdTuner:
+    """Tunes the similarity threshold of the expert answer index on the stored expert questions.
+
+    Two different expert questions must not match each other, so the threshold is set above the similarity
+    of every expert question to its most similar other question with the same numbers (questions with other
+    numbers are never matched). Optional paraphrases of expert questions measure how many rephrased
+    questions are still answered at the tuned threshold.
+    """
+
+    def __init__(self, knowledge_base: KnowledgeBase, paraphrases: pd.DataFrame = None):
+        """
+        Initializes an ExpertThresholdTuner object.
+
+        Args:
+            knowledge_base (KnowledgeBase): The knowledge base with the expert answer index.
+            paraphrases (pd.DataFrame, optional): Rephrased expert questions with the columns "question" and
+                "question_id" of the expert question they ask.
+        """
+        self.kb = knowledge_base
+        self.paraphrases = paraphrases
+        self.results: dict = None
+
+    def nearest_other_scores(self) -> np.ndarray:
+        """Returns per expert question the cosine similarity of the most similar other question with the same numbers."""
+        data = self.kb.expert_index.collection.get(include=["embeddings", "metadatas"])
+        embeddings = np.asarray(data["embeddings"], dtype=np.float32)
+        if len(embeddings) < 2:
+            return np.array([])
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings = embeddings / np.where(norms == 0, 1, norms)
+        similarities = embeddings @ embeddings.T
+        numbers = [
+            number_tokens(metadata["question"]) for metadata in data["metadatas"]
+        ]
+        question_ids = [metadata["question_id"] for metadata in data["metadatas"]]
+        scores = []
+        for i in range(len(embeddings)):
+            others = [
+                similarities[i, j]
+                for j in range(len(embeddings))
+                if question_ids[j] != question_ids[i] and numbers[j] == numbers[i]
+            ]
+            if others:
+                scores.append(max(others))
+        return np.array(scores)
+
+    def paraphrase_recall(self, threshold: float) -> float:
+        """Returns the share of paraphrases matched to their expert question at the threshold."""
+        expert_index = self.kb.expert_index
+        previous = expert_index.score_threshold
+        expert_index.score_threshold = threshold
+        try:
+            matches = [
+                expert_index.match(question)
+                for question in self.paraphrases["question"].tolist()
+            ]
+        finally:
+            expert_index.score_threshold = previous
+        return float(
+            np.mean(
+                [
+                    match is not None and str(match["question_id"]) == str(question_id)
+                    for match, question_id in zip(
+                        matches, self.paraphrases["question_id"].tolist()
+                    )
+                ]
+            )
+        )
+
+    def tune(
+        self, quantile: float = 1.0, margin: float = 0.01, save: bool = False
+    ) -> float:
+        """
+        Sets the threshold above the similarities between different expert questions.
+
+        Args:
+            quantile (float): The quantile of the nearest-other similarities the threshold is set above.
+                Defaults to 1.0, no two stored questions match each other.
+            margin (float): Added to the quantile. Defaults to 0.01.
+            save (bool): Whether the threshold is saved with the knowledge base and used by its expert index.
+                Defaults to False.
+
+        Returns:
+            float or None: The recommended threshold, None if there are no two comparable expert questions.
+        """
+        scores = self.nearest_other_scores()
+        if not len(scores):
+            logger.warning(
+                "NO EXPERT QUESTIONS WITH THE SAME NUMBERS, THE EXPERT THRESHOLD IS NOT TUNED"
+            )
+            return None
+        threshold = min(float(np.quantile(scores, quantile)) + margin, 1.0)
+        self.results = {
+            "expert_questions": self.kb.expert_index.collection.count(),
+            "max_other_similarity": float(scores.max()),
+            "expert_score_threshold": threshold,
+            "paraphrase_recall": (
+                self.paraphrase_recall(threshold)
+                if self.paraphrases is not None
+                else np.nan
+            ),
+        }
+        logger.info(f"EXPERT THRESHOLD TUNING: {self.results}")
+        if save:
+            self.kb.save_retriever_settings(expert_score_threshold=threshold)
+            self.kb.expert_index.score_threshold = threshold
+        return threshold
+
+
+class RetrievalBenchmark:
+    """Measures the retrieval quality on the generated QA pair dataset without any LLM call.
+
+    Every QA question was generated from a known chunk (context_id), which is the single relevant
+    document of the question. The questions are searched in batches and the metrics are computed
+    from the rank of the relevant chunk.
+    """
+
+    def __init__(
+        self,
+        knowledge_base: KnowledgeBase,
+        qa_pair_dataset: pd.DataFrame,
+        retriever: ScoredRetriever = None,
+    ):
+        """
+        Initializes a RetrievalBenchmark object.
+
+        Args:
+            knowledge_base (KnowledgeBase): The knowledge base to search.
+            qa_pair_dataset (pd.DataFrame): The generated QA pair dataset with the columns "question" and "context_id".
+            retriever (ScoredRetriever, optional): A retriever whose threshold and adaptive k are applied
+                to the search results. Defaults to the plain top-k search.
+        """
+        self.kb = knowledge_base
+        self.qa_pair_dataset = qa_pair_dataset
+        self.retriever = retriever
+        self.ranks: np.ndarray = None
+        self.latencies: np.ndarray = None
+
+    def search(self, questions: list, k: int, batch_size: int) -> list:
+        """Searches the questions in batches and records the latency per question."""
+        results, latencies = [], []
+        for start in range(0, len(questions), batch_size):
+            batch = questions[start : start + batch_size]
+            started = time.perf_counter()
+            batch_results = self.kb.search_with_scores(batch, k=k)
+            if self.retriever is not None:
+                batch_results = [
+                    [(doc, doc.metadata["relevance_score"]) for doc in selected]
+                    for selected in map(self.retriever.select, batch_results)
+                ]
+            seconds = time.perf_counter() - started
+            results.extend(batch_results)
+            latencies.extend([seconds / len(batch)] * len(batch))
+        self.latencies = np.array(latencies)
+        return results
+
+    def run(self, k: int = 10, batch_size: int = 64) -> dict:
+        """
+        Runs all questions and computes hit@k, MRR and nDCG against the known context_id, plus latency percentiles.
+
+        Args:
+            k (int): The number of retrieved documents per question. Defaults to 10.
+            batch_size (int): The number of questions per search. Use 1 for the latency of single requests. Defaults to 64.
+
+        Returns:
+            dict: The retrieval metrics.
+        """
+        questions = self.qa_pair_dataset[
+            get_question_column(self.qa_pair_dataset)
+        ].tolist()
+        context_ids = self.qa_pair_dataset["context_id"].astype(str).to_numpy()
+        # Cached query embeddings of an earlier run would hide the embedding latency.
+        with self.kb._cache_lock:
+            self.kb.query_embedding_cache.clear()
+        results = self.search(questions, k, batch_size)
+
+        # Matrix of the retrieved chunk IDs, padded for questions with less than k results.
+        retrieved = np.full((len(questions), k), "", dtype=object)
+        for i, scored_docs in enumerate(results):
+            chunk_ids = [str(doc.metadata["chunk_id"]) for doc, _ in scored_docs]
+            retrieved[i, : len(chunk_ids)] = chunk_ids
+        relevant = retrieved == context_ids[:, None]
+        found = relevant.any(axis=1)
+        # Rank (0-based) of the relevant chunk, k if it was not retrieved.
+        self.ranks = np.where(found, relevant.argmax(axis=1), k)
+
+        metrics = {
+            f"hit@{cutoff}": float(np.mean(self.ranks < cutoff))
+            for cutoff in sorted({1, 3, 5, k})
+            if cutoff <= k
+        }
+        metrics["mrr"] = float(np.mean(np.where(found, 1 / (self.ranks + 1), 0)))
+        # With one relevant document the ideal DCG is 1.
+        metrics[f"ndcg@{k}"] = float(
+            np.mean(np.where(found, 1 / np.log2(self.ranks + 2), 0))
+        )
+        metrics["mean_k"] = float(np.mean([len(result) for result in results]))
+        for percentile in (50, 95, 99):
+            metrics[f"latency_p{percentile}_ms"] = float(
+                np.percentile(self.latencies, percentile) * 1000
+            )
+        metrics["questions"] = len(questions)
+        logger.info(f"RETRIEVAL BENCHMARK: {metrics}")
+        return metrics
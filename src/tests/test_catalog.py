@@ -0,0 +1,54 @@
+import sqlite3
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+pytest.importorskip("langchain")
+
+from application.catalog import CatalogChangeLog, CatalogSync, product_code_aliases
+
+
+def test_ean_and_eoc_aliases_are_synchronized(tmp_path):
+    raw = pd.DataFrame(
+        {
+            "Philips_BestellNr": [43168300, None],
+            "EAN1": [8719514431683, 8719514431706],
+            "EOC": [871951443168300, None],
+        }
+    )
+    aliases = product_code_aliases(raw)
+    assert sorted(aliases.itertuples(index=False, name=None)) == [
+        ("8719514431683", 43168300),
+        ("8719514431706", 43170600),
+        ("871951443168300", 43168300),
+        ("871951443170600", 43170600),
+    ]
+
+    path_sql_db = str(tmp_path / "sqlite_db.db")
+    catalog = pd.DataFrame({"Bestell_Nr": [43168300, 43170600]})
+    sync = CatalogSync(path_sql_db)
+    sync.sync(catalog, code_aliases=aliases)
+    conn = sqlite3.connect(path_sql_db)
+    assert dict(conn.execute("SELECT code, Bestell_Nr FROM product_code_aliases;")) == {
+        code: bestell_nr
+        for code, bestell_nr in aliases.itertuples(index=False, name=None)
+    }
+    conn.close()
+
+
+def test_alias_changes_are_logged(tmp_path):
+    path_sql_db = str(tmp_path / "sqlite_db.db")
+    catalog = pd.DataFrame({"Bestell_Nr": [43168300, 43170600]})
+    aliases = pd.DataFrame({"code": ["8719514431683"], "Bestell_Nr": [43168300]})
+    sync = CatalogSync(path_sql_db)
+    sync.sync(catalog, code_aliases=aliases)
+    change_log = CatalogChangeLog(path_sql_db)
+    version = change_log.latest_version()
+
+    aliases = pd.DataFrame({"code": ["8719514431706"], "Bestell_Nr": [43170600]})
+    diff = sync.sync(catalog, code_aliases=aliases)
+    assert len(diff) == 0
+    assert change_log.changes_since(version) == (
+        version + 1,
+        {43168300: "alias", 43170600: "alias"},
+    )
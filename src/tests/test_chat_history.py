@@ -0,0 +1,78 @@
+import pytest
+
+pytest.importorskip("langchain_core")
+
+from application.chat_history import ChatHistoryStore
+
+PRODUCT = {"Bestell_Nr": 43168300, "Bezeichnung_lang": "MASTER LEDtube"}
+
+
+class VectorCollection:
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def get(self, ids, include):
+        ids = [chunk_id for chunk_id in ids if chunk_id in self.chunks]
+        return {
+            "ids": ids,
+            "documents": [self.chunks[chunk_id][0] for chunk_id in ids],
+            "metadatas": [self.chunks[chunk_id][1] for chunk_id in ids],
+        }
+
+
+class KnowledgeBase:
+    """Serves the chunks and product rows like KnowledgeBase, missing products raise an IndexError."""
+
+    def __init__(self, chunks, products):
+        self.vector_store = type(
+            "VectorStore", (), {"_collection": VectorCollection(chunks)}
+        )()
+        self.products = products
+
+    def execute_sql_query(self, product_code):
+        return [row for row in self.products if row["Bestell_Nr"] == product_code][0]
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ChatHistoryStore(str(tmp_path / "chat_history.db"))
+    yield store
+    store.close()
+
+
+def test_product_context_round_trip(store):
+    session_id = store.start_session()
+    store.append(
+        session_id,
+        {
+            "question": "Wie lange hält die 43168300?",
+            "answer": "50000 Stunden.",
+            "context": PRODUCT,
+        },
+    )
+    (record,) = store.get_turns(session_id)
+    assert record["context_refs"] == [{"product_code": 43168300}]
+
+    knowledge_base = KnowledgeBase({}, [PRODUCT])
+    assert store.resolve_context(record, knowledge_base) == [PRODUCT]
+
+
+def test_removed_products_and_chunks_are_left_out(store):
+    session_id = store.start_session()
+    store.append(
+        session_id,
+        {
+            "answer": "...",
+            "context": [
+                {"page_content": "Kept", "metadata": {"chunk_id": "a"}},
+                {"page_content": "Removed", "metadata": {"chunk_id": "b"}},
+                PRODUCT,
+            ],
+        },
+    )
+    (record,) = store.get_turns(session_id)
+
+    knowledge_base = KnowledgeBase({"a": ("Kept", {"source": "faq"})}, [])
+    assert store.resolve_context(record, knowledge_base) == [
+        {"page_content": "Kept", "metadata": {"source": "faq", "chunk_id": "a"}}
+    ]
@@ -0,0 +1,54 @@
+import pytest
+
+pytest.importorskip("langchain")
+
+from application.column_selection import ColumnSelector
+
+COLUMNS = (
+    "Bestell_Nr",
+    "Bezeichnung_lang",
+    "Bezeichnung_kurz",
+    "Sockel",
+    "Ersatz_fuer",
+    "Nutzlebensdauer",
+    "LEDtube_Laenge_in_mm",
+    "EEL",
+    "EEL_Label",
+)
+
+
+@pytest.fixture
+def selector():
+    return ColumnSelector()
+
+
+@pytest.mark.parametrize(
+    "question",
+    [
+        "Wie lange hält die Lampe?",
+        "Wie lange leuchtet die Lampe?",
+        "Wie lang ist die Röhre?",
+    ],
+)
+def test_short_name_parts_do_not_match(selector, question):
+    assert "Bezeichnung_lang" not in selector.match_columns(question, COLUMNS)
+
+
+def test_fuer_does_not_select_ersatz_fuer(selector):
+    matched = selector.match_columns("Ist die Lampe für Feuchträume geeignet?", COLUMNS)
+    assert "Ersatz_fuer" not in matched
+
+
+@pytest.mark.parametrize(
+    "question, column",
+    [
+        ("Welche Energieeffizienzklasse hat die Lampe?", "EEL"),
+        ("Wo finde ich das Energielabel?", "EEL_Label"),
+        ("Welchen Sockel hat die Lampe?", "Sockel"),
+        ("Passt die Lampe in eine E27 Fassung?", "Sockel"),
+        ("Welche Lampe wird damit ersetzt?", "Ersatz_fuer"),
+        ("Wie lange hält die Lampe?", "Nutzlebensdauer"),
+    ],
+)
+def test_columns_are_matched_by_synonyms(selector, question, column):
+    assert selector.match_columns(question, COLUMNS) == [column]
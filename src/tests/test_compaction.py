@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("chromadb")
+pytest.importorskip("langchain_community")
+
+from application.compaction import IndexCompactor, number_tokens
+
+DATASHEET = "MASTER LEDtube {watt} W, {lumen} lm, Bestell-Nr. {code}, Sockel G13, Lichtfarbe 840, Lebensdauer 50000 h."
+
+
+@pytest.fixture
+def compactor():
+    kb = SimpleNamespace(vector_store=SimpleNamespace(_collection=None))
+    return IndexCompactor(kb)
+
+
+def load(compactor, texts, metadatas, embeddings):
+    """Sets the chunks like load and checks every pair."""
+    compactor.ids = [f"c{i}" for i in range(len(texts))]
+    compactor.texts = texts
+    compactor.metadatas = metadatas
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    compactor.embeddings = embeddings / np.linalg.norm(
+        embeddings, axis=1, keepdims=True
+    )
+    compactor.signatures = np.stack([compactor.minhash(text) for text in texts])
+    compactor.numbers = [number_tokens(text) for text in texts]
+    pairs = {(i, j) for i in range(len(texts)) for j in range(i + 1, len(texts))}
+    compactor.text_candidates = lambda: pairs
+    compactor.embedding_candidates = lambda: set()
+
+
+def test_product_variants_are_not_merged(compactor):
+    texts = [
+        DATASHEET.format(watt=16, lumen=2500, code=43168300),
+        DATASHEET.format(watt=14, lumen=2100, code=43170600),
+    ]
+    load(compactor, texts, [{}, {}], [[1.0, 0.0], [1.0, 0.001]])
+    assert compactor.find_duplicate_groups() == []
+
+
+def test_exact_duplicates_are_merged(compactor):
+    text = DATASHEET.format(watt=16, lumen=2500, code=43168300)
+    load(compactor, [text, text + " "], [{}, {}], [[1.0, 0.0], [1.0, 0.0]])
+    assert compactor.find_duplicate_groups() == [[1, 0]]
+
+
+def test_duplicates_are_not_chained(compactor):
+    # A~B and B~C, but A and C are not similar enough.
+    text = DATASHEET.format(watt=16, lumen=2500, code=43168300)
+    load(
+        compactor,
+        [text, text + " Neu", text + " Neu Neu"],
+        [{}, {}, {}],
+        [[1.0, 0.0], [0.985, 0.17], [0.85, 0.527]],
+    )
+    groups = compactor.find_duplicate_groups()
+    assert all(not ({0, 2} <= set(group)) for group in groups)
+
+
+def test_expert_answers_to_different_questions_are_not_merged(compactor):
+    metadatas = [
+        {"keywords": "expert_answer", "question_id": "Da"},
+        {"keywords": "expert_answer", "question_id": "Db"},
+    ]
+    text = "Ja, die Lampe ist dimmbar."
+    load(compactor, [text, text], metadatas, [[1.0, 0.0], [1.0, 0.0]])
+    assert compactor.find_duplicate_groups() == []
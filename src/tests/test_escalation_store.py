@@ -0,0 +1,41 @@
+import pytest
+
+pytest.importorskip("langchain")
+pytest.importorskip("langchain_core")
+
+from application.escalation_store import STATUS_OPEN, EscalationStore
+
+LLM_OUTPUT = {
+    "question_id": "Dabc",
+    "question_type": "DOCUMENT",
+    "question": "Ist die Lampe dimmbar?",
+    "answer": "Ich weiß es nicht.",
+    "solved": False,
+    "context": [],
+}
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = EscalationStore(str(tmp_path / "escalations.db"))
+    yield store
+    store.close()
+
+
+def test_escalation_email_is_written(store, tmp_path):
+    store.add(LLM_OUTPUT)
+    path = store.write_email("Dabc", str(tmp_path / "outbox"))
+    assert path.endswith("/outbox/mail_Dabc.txt")
+    with open(path) as file:
+        email = file.read()
+    assert "'question_id': 'Dabc'" in email
+    assert store.count_by_status() == {STATUS_OPEN: 1}
+
+
+def test_open_escalations_are_exported(store, tmp_path):
+    store.add_many([LLM_OUTPUT, {**LLM_OUTPUT, "question_id": "Ddef"}])
+    paths = store.export_emails(str(tmp_path / "export"))
+    assert sorted(path.rsplit("/", 1)[1] for path in paths) == [
+        "mail_Dabc.txt",
+        "mail_Ddef.txt",
+    ]
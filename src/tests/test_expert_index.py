@@ -0,0 +1,76 @@
+import pytest
+
+pytest.importorskip("chromadb")
+pytest.importorskip("langchain_core")
+
+from application.expert_index import ExpertAnswerIndex
+
+ENTRY = {
+    "question_id": "Da",
+    "question": "Ist die Lampe 43168300 dimmbar?",
+    "answer": "Ja.",
+    "source": "mail_Da.txt",
+}
+
+
+class Collection:
+    """Returns the stored expert question with the given distance."""
+
+    def __init__(self, distance):
+        self.distance = distance
+
+    def count(self):
+        return 1
+
+    def query(self, query_embeddings, n_results, include):
+        return {
+            "ids": [["expert_Da"]],
+            "metadatas": [[ENTRY]],
+            "distances": [[self.distance]],
+        }
+
+
+class Client:
+    def __init__(self, distance):
+        self.collection = Collection(distance)
+
+    def get_or_create_collection(self, name, metadata):
+        return self.collection
+
+
+def create_index(distance, score_threshold, embedded, lexical_check=None):
+    def embed_queries(texts):
+        embedded.extend(texts)
+        return [[1.0, 0.0] for _ in texts]
+
+    return ExpertAnswerIndex(
+        Client(distance),
+        embed_queries,
+        score_threshold=score_threshold,
+        lexical_check=lexical_check,
+    )
+
+
+def test_matching_is_off_until_tuned():
+    embedded = []
+    index = create_index(0.0, None, embedded)
+    assert index.match(ENTRY["question"]) is None
+    assert embedded == []
+
+
+def test_similar_question_with_the_same_numbers_matches():
+    index = create_index(0.02, 0.95, [])
+    match = index.match("Ist die Lampe 43168300 dimmbar")
+    assert match["answer"] == "Ja."
+
+
+def test_question_about_another_product_is_rejected():
+    index = create_index(0.01, 0.95, [])
+    assert index.match("Ist die Lampe 43170600 dimmbar?") is None
+
+
+def test_strong_lexical_match_is_not_embedded():
+    embedded = []
+    index = create_index(0.0, 0.95, embedded, lexical_check=lambda query: True)
+    assert index.match(ENTRY["question"]) is None
+    assert embedded == []
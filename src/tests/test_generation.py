@@ -0,0 +1,38 @@
+import pytest
+
+pytest.importorskip("llama_cpp")
+
+from application.generation import GenerationConfig, find_repetition
+
+CONFIG = GenerationConfig()
+
+
+def repetition(tokens):
+    return find_repetition(
+        tokens,
+        CONFIG.repetition_max_period,
+        CONFIG.repetition_min_repeats,
+        CONFIG.repetition_min_period,
+    )
+
+
+@pytest.mark.parametrize(
+    "tokens",
+    [
+        # llama tokenizers emit digits as single tokens.
+        ['{"', "answer", '":', ' "', "Die", " Lebens", "dauer", " beträgt", " "]
+        + list("50000"),
+        ['{"', "answer", '":', ' "', "Die", " Lebens", "dauer", " beträgt", " "]
+        + list("50000")
+        + [" Stunden", "."],
+        ["Die", " EAN", " ist", " "] + list("8719514444444"),
+        ["Die", " EAN", " ist", " "] + list("8719514444444") + ["."] * 4,
+    ],
+)
+def test_numbers_are_not_repetitions(tokens):
+    assert repetition(tokens) == 0
+
+
+def test_repeated_phrases_are_dropped():
+    tokens = ["Die", " Lampe"] + [" ist", " dimmbar", "."] * 4
+    assert repetition(tokens) == 9
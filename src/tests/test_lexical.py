@@ -0,0 +1,41 @@
+import pytest
+
+pytest.importorskip("chromadb")
+
+from application.lexical import ProductCodeMatcher
+
+
+@pytest.fixture
+def matcher():
+    return ProductCodeMatcher(
+        [43168300, 43170600],
+        {"8719514431683": 43168300, "871951443170600": 43170600},
+    )
+
+
+@pytest.mark.parametrize(
+    "text, product_code",
+    [
+        ("Wie lange hält die 43168300?", 43168300),
+        ("Ist die 8719514431683 dimmbar?", 43168300),
+        ("Ist die 871951443170600 dimmbar?", 43170600),
+        ("Ist die 8719514 43170600 dimmbar?", 43170600),
+        # EOC without an alias, ending with the Bestell_Nr
+        ("Ist die 871951443168300 dimmbar?", 43168300),
+    ],
+)
+def test_product_codes_are_matched(matcher, text, product_code):
+    assert matcher.match(text) == product_code
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "Wie lange hält die Lampe?",
+        "Die Lampe hält 50000 Stunden.",
+        "Ist die 12345678 dimmbar?",
+        "Ist die 8719514499999 dimmbar?",
+    ],
+)
+def test_unknown_codes_are_not_matched(matcher, text):
+    assert matcher.match(text) is None
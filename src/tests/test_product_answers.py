@@ -0,0 +1,107 @@
+import sqlite3
+
+import pytest
+
+pytest.importorskip("langchain")
+
+from application.product_answers import IntentClassifier, ProductAnswerTable
+
+
+@pytest.fixture
+def classifier():
+    return IntentClassifier()
+
+
+@pytest.mark.parametrize(
+    "question",
+    [
+        "Wie lange leuchtet die Lampe?",
+        "Wie lang ist die Röhre?",
+        "Ist die Lampe für Feuchträume geeignet?",
+        "Welche Leistung und welchen Lichtstrom hat die Lampe?",
+        "Welche Lampe ist besser, die 43168300 oder die 43170600?",
+        "Brauche ich einen speziellen Dimmer?",
+        "Geht die Lampe auch ohne Dimmer?",
+    ],
+)
+def test_unclear_questions_go_to_the_llm(classifier, question):
+    assert classifier.classify(question) is None
+
+
+@pytest.mark.parametrize(
+    "question, intent",
+    [
+        ("Wie lange hält die Lampe?", "lifetime"),
+        ("Welche Energieeffizienzklasse hat die Lampe?", "energy_class"),
+        ("Wo finde ich das Energielabel?", "energy_label"),
+        ("Wie viel Watt hat die Lampe?", "wattage"),
+        ("Ist die Lampe dimmbar?", "dimmable"),
+        ("Wie heißt das Produkt?", "name"),
+        ("Welche Farbtemperatur hat die 43168300?", "color_temperature"),
+    ],
+)
+def test_intents_are_recognized_by_their_synonyms(classifier, question, intent):
+    assert classifier.classify(question) == intent
+
+
+def test_energy_class_is_answered_with_the_class(tmp_path):
+    path_sql_db = str(tmp_path / "sqlite_db.db")
+    conn = sqlite3.connect(path_sql_db)
+    conn.execute(
+        "CREATE TABLE lamps (Bestell_Nr INTEGER, Bezeichnung_lang TEXT, EEL TEXT, EEL_Label TEXT);"
+    )
+    conn.execute(
+        "INSERT INTO lamps VALUES (43168300, 'MASTER LEDtube', 'C', 'https://example.org/eel');"
+    )
+    conn.commit()
+    conn.close()
+
+    table = ProductAnswerTable(path_sql_db)
+    table.build()
+    assert (
+        table.lookup(43168300, "energy_class")
+        == "MASTER LEDtube hat die Energieeffizienzklasse C."
+    )
+    assert "https://example.org/eel" in table.lookup(43168300, "energy_label")
+    table.close()
+
+
+@pytest.mark.parametrize(
+    "intent, row",
+    [
+        ("wattage", {"Bezeichnung_lang": "MASTER LEDtube", "Leistung": 0.0}),
+        ("warranty", {"Bezeichnung_lang": "MASTER LEDtube", "Garantie": 0}),
+        ("dimmable", {"Bezeichnung_lang": "MASTER LEDtube", "Dimmbar": "nein"}),
+    ],
+)
+def test_placeholders_of_unknown_values_go_to_the_llm(tmp_path, intent, row):
+    table = ProductAnswerTable(str(tmp_path / "sqlite_db.db"))
+    assert table.render(intent, row) is None
+    table.close()
+
+
+def test_updating_products_keeps_the_answers_of_other_products(tmp_path):
+    path_sql_db = str(tmp_path / "sqlite_db.db")
+    conn = sqlite3.connect(path_sql_db)
+    conn.execute("CREATE TABLE lamps (Bestell_Nr INTEGER, Bezeichnung_lang TEXT);")
+    conn.execute("INSERT INTO lamps VALUES (43168300, 'MASTER LEDtube');")
+    conn.execute("INSERT INTO lamps VALUES (43170600, 'CorePro LEDtube');")
+    conn.commit()
+
+    table = ProductAnswerTable(path_sql_db)
+    table.build()
+    table.conn.execute(
+        "INSERT INTO product_answers VALUES (43170600, 'wattage', '8 W', 'llm');"
+    )
+    table.conn.commit()
+    conn.execute(
+        "UPDATE lamps SET Bezeichnung_lang = 'MASTER LEDtube T8' WHERE Bestell_Nr = 43168300;"
+    )
+    conn.commit()
+    conn.close()
+
+    table.update_products([43168300])
+    assert "MASTER LEDtube T8" in table.lookup(43168300, "name")
+    assert table.lookup(43170600, "wattage") == "8 W"
+    assert not table.is_stale()
+    table.close()
@@ -0,0 +1,35 @@
+import pytest
+
+pytest.importorskip("langchain_core")
+
+from langchain_core.documents.base import Document
+
+from application.results import ChainResult, result_summary
+
+
+def test_summary_references_the_context():
+    result = ChainResult(
+        question_id="D1",
+        question_type="DOCUMENT",
+        answer="Die Lampe ist dimmbar.",
+        context=[
+            Document(page_content="x" * 10000, metadata={"chunk_id": "faq_3"}),
+            {"page_content": "y", "metadata": {"chunk_id": "faq_4"}},
+        ],
+    )
+    summary = result_summary(result)
+    assert "question_id=D1" in summary
+    assert "'Die Lampe ist dimmbar.'" in summary
+    assert "['faq_3', 'faq_4']" in summary
+    assert "x" * 100 not in summary
+
+
+def test_summary_of_product_result():
+    result = {
+        "question_id": "P1",
+        "answer": "Ja.",
+        "context": {"Bestell_Nr": 43168300, "Bezeichnung_lang": "MASTER LEDtube"},
+    }
+    summary = result_summary(result)
+    assert "Bestell_Nr 43168300" in summary
+    assert "MASTER LEDtube" not in summary
@@ -0,0 +1,28 @@
+import pytest
+
+pytest.importorskip("langchain_core.retrievers")
+
+from langchain_core.documents.base import Document
+
+from application.retrievers import ScoredRetriever
+
+SCORED_DOCS = [
+    (Document(page_content=str(score), metadata={"relevance_score": score}), score)
+    for score in (0.6, 0.5, 0.4, 0.3)
+]
+
+
+def test_threshold_is_off_by_default():
+    retriever = ScoredRetriever(knowledge_base=None)
+    assert [doc.page_content for doc in retriever.select(SCORED_DOCS)] == [
+        "0.6",
+        "0.5",
+        "0.4",
+    ]
+
+
+def test_tuned_threshold_filters_documents():
+    retriever = ScoredRetriever(knowledge_base=None, score_threshold=0.55)
+    assert [doc.page_content for doc in retriever.select(SCORED_DOCS)] == ["0.6"]
+    retriever = ScoredRetriever(knowledge_base=None, score_threshold=0.75)
+    assert retriever.select(SCORED_DOCS) == []
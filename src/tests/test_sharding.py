@@ -0,0 +1,56 @@
+import pytest
+
+pytest.importorskip("chromadb")
+pytest.importorskip("langchain_core")
+
+from application.sharding import ShardedIndex, ShardRouter
+
+
+class Collection:
+    """Stores the upserted chunks like a Chroma collection."""
+
+    def __init__(self, name, metadata=None, data=None):
+        self.name = name
+        self.metadata = metadata
+        self.data = data or {}
+
+    def upsert(self, ids, documents, metadatas, embeddings):
+        for entry in zip(ids, documents, metadatas, embeddings):
+            self.data[entry[0]] = entry[1:]
+
+    def get(self, ids, include):
+        entries = [(chunk_id, *self.data[chunk_id]) for chunk_id in ids]
+        return {
+            key: [entry[index] for entry in entries]
+            for index, key in enumerate(["ids", "documents", "metadatas", "embeddings"])
+        }
+
+
+class Client:
+    def __init__(self):
+        self.collections = {}
+
+    def list_collections(self):
+        return list(self.collections.values())
+
+    def get_or_create_collection(self, name, metadata):
+        return self.collections.setdefault(name, Collection(name, metadata))
+
+
+def test_added_chunks_keep_the_embeddings_of_the_vector_store():
+    def embed_queries(texts):
+        raise AssertionError("chunks are embedded again")
+
+    source = Collection(
+        "technical_documents",
+        data={"a": ("Die Röhre ist dimmbar.", {"source": "a.pdf"}, [0.1, 0.2])},
+    )
+    index = ShardedIndex(
+        client=Client(),
+        embed_queries=embed_queries,
+        relevance_score_fn=lambda distance: 1 - distance,
+        router=ShardRouter({}),
+    )
+    index.add_from_collection(source, ["a"])
+    (shard,) = index.collections.values()
+    assert shard.data["a"] == source.data["a"]
@@ -0,0 +1,60 @@
+import time
+
+import pytest
+
+pytest.importorskip("langchain_community")
+pytest.importorskip("chromadb")
+
+from application.tenants import TenantConfig, TenantManager, TenantState
+
+
+class KnowledgeBase:
+    def __init__(self):
+        self.closed = False
+
+    def memory_usage(self):
+        return {"total_bytes": 1024**2}
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def tenants(monkeypatch):
+    manager = TenantManager(
+        embedding_model=None,
+        models=None,
+        tenants={name: TenantConfig(path_kb=f"/{name}") for name in "abc"},
+        max_open=1,
+    )
+
+    def open_tenant(tenant_id):
+        now = time.time()
+        return TenantState(
+            knowledge_base=KnowledgeBase(), bot=None, opened_at=now, last_used=now
+        )
+
+    monkeypatch.setattr(manager, "open_tenant", open_tenant)
+    return manager
+
+
+def test_idle_tenants_are_evicted(tenants):
+    kb = tenants.get_knowledge_base("a")
+    tenants.get("b")
+    assert kb.closed
+    assert list(tenants.open_tenants) == ["b"]
+
+
+def test_leased_tenants_are_kept_until_released(tenants):
+    with tenants.lease("a") as state:
+        tenants.get("b")
+        assert not state.knowledge_base.closed
+        assert set(tenants.open_tenants) == {"a", "b"}
+    assert state.knowledge_base.closed
+    assert list(tenants.open_tenants) == ["b"]
+
+
+def test_release_without_lease_fails(tenants):
+    tenants.get("a")
+    with pytest.raises(ValueError):
+        tenants.release("a")
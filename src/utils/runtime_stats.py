@@ -0,0 +1,69 @@
+import threading
+from collections import defaultdict, deque
+from typing import Any, Deque, Dict
+
+
+class RuntimeStats:
+    """Thread-safe collection of runtime statistics grouped by component."""
+
+    def __init__(self, max_events: int = 500):
+        """
+        Initializes a RuntimeStats object.
+
+        Args:
+            max_events (int): The number of recent events kept per component. Defaults to 500.
+        """
+        self.max_events = max_events
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[str, float]] = defaultdict(
+            lambda: defaultdict(float)
+        )
+        self._events: Dict[str, Deque[dict]] = defaultdict(
+            lambda: deque(maxlen=self.max_events)
+        )
+        self._gauges: Dict[str, Dict[str, Any]] = defaultdict(dict)
+
+    def increment(self, component: str, name: str, value: float = 1) -> None:
+        """Adds the value to the counter of the given component."""
+        with self._lock:
+            self._counters[component][name] += value
+
+    def set_gauge(self, component: str, name: str, value: Any) -> None:
+        """Sets the current value of a gauge of the given component."""
+        with self._lock:
+            self._gauges[component][name] = value
+
+    def record_event(self, component: str, event: dict) -> None:
+        """Appends an event (e.g. a per-call report) to the component's recent events."""
+        with self._lock:
+            self._events[component].append(event)
+
+    def get_events(self, component: str) -> list:
+        """Returns the recent events of the given component."""
+        with self._lock:
+            return list(self._events.get(component, []))
+
+    def snapshot(self) -> dict:
+        """
+        Returns a copy of all statistics.
+
+        Returns:
+            dict: A dictionary with the keys 'counters', 'gauges' and 'events'.
+        """
+        with self._lock:
+            return {
+                "counters": {k: dict(v) for k, v in self._counters.items()},
+                "gauges": {k: dict(v) for k, v in self._gauges.items()},
+                "events": {k: list(v) for k, v in self._events.items()},
+            }
+
+    def reset(self) -> None:
+        """Removes all collected statistics."""
+        with self._lock:
+            self._counters.clear()
+            self._events.clear()
+            self._gauges.clear()
+
+
+# Shared instance used throughout the application
+runtime_stats = RuntimeStats()